@@ -0,0 +1,302 @@
+'''
+Throughput benchmarks of the stages of main() on synthetic data, sized to run on CPU.
+
+    python bench.py --models vit resnet18 --out bench.json
+    python bench.py --baseline bench.json --tolerance 0.1   # exit code 1 on regression
+
+Each stage reports samples/sec, step latency percentiles (ms) and peak memory (MB): allocated device memory
+on cuda, process peak RSS otherwise (a high-water mark over the whole run, so only increases between stages).
+'''
+import argparse
+import json
+import platform
+import resource
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from PIL import Image
+from torch.utils.data import DataLoader, TensorDataset
+import torchvision.transforms as transforms
+
+from sot_torchvision_models import resnet18, resnet50
+from sot_modif_resnet import modify_resnet_model
+from vit_models import ViT
+from data import ContrastiveTransformations, BatchAugment, simclr_aug
+from loss import info_nce_loss, compute_saliency_map, canny_edge_detector, edge2blob, kl_divergence
+from main import test, eval_bias_embed, eval_views_embed_dist
+from utils import MetricsSink, set_metrics_sink
+
+CIFAR_NORM = [(0.4914, 0.4822, 0.4465), (0.2471, 0.2435, 0.2616)]
+
+def build_model(name, nb_classes=10):
+    if name == 'vit':
+        return ViT(hidden=128, mlp_hidden=512, img_size=32, patch=8, num_layers=2, head=4)
+    elif name == 'resnet18':
+        return modify_resnet_model(resnet18(num_classes=nb_classes))
+    elif name == 'resnet50':
+        return modify_resnet_model(resnet50(num_classes=nb_classes))
+    raise ValueError('Unknown model: {}'.format(name))
+
+class SyntheticImages(torch.utils.data.Dataset):
+    '''
+    Random uint8 PIL images with labels, decoded from memory (no disk reads).
+    '''
+    def __init__(self, size=512, img_size=32, nb_classes=10, transform=None, seed=0):
+        rng = np.random.default_rng(seed)
+        self.images = rng.integers(0, 256, (size, img_size, img_size, 3), dtype=np.uint8)
+        self.labels = rng.integers(0, nb_classes, size)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        img = Image.fromarray(self.images[idx])
+        return self.transform(img) if self.transform is not None else img, int(self.labels[idx])
+
+class ProbeImages(torch.utils.data.Dataset):
+    '''
+    Random tensors with (shape, texture) ids, as the Geirhos probe datasets.
+    '''
+    def __init__(self, size=160, img_size=32, seed=0):
+        g = torch.Generator().manual_seed(seed)
+        self.images = torch.randn(size, 3, img_size, img_size, generator=g)
+        self.shapes = torch.randint(0, 16, (size,), generator=g)
+        self.textures = torch.randint(0, 16, (size,), generator=g)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return self.images[idx], self.shapes[idx], self.textures[idx]
+
+def sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def timed_steps(step, nb_steps, warmup, device):
+    '''
+    Run step() warmup + nb_steps times, return the latencies (s) of the timed steps.
+    '''
+    times = []
+    for i in range(warmup + nb_steps):
+        sync(device)
+        start = time.perf_counter()
+        step()
+        sync(device)
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return times
+
+def timed_iter(loader, nb_steps, warmup):
+    '''
+    Latencies (s) of fetching nb_steps batches from loader, after warmup batches.
+    '''
+    times = []
+    it = iter(loader)
+    for i in range(warmup + nb_steps):
+        start = time.perf_counter()
+        try: next(it)
+        except StopIteration:
+            it = iter(loader)
+            next(it)
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return times
+
+# Stages: fn(model, args) -> (latencies of timed steps, samples per step)
+def bench_data_loading(model, args):
+    ds = SyntheticImages(size=args.bs * 8, transform=transforms.Compose([transforms.ToTensor(), transforms.Normalize(*CIFAR_NORM)]))
+    loader = DataLoader(ds, batch_size=args.bs, shuffle=True, num_workers=args.workers)
+    return timed_iter(loader, args.steps, args.warmup), args.bs
+
+def bench_augmentation(model, args):
+    # SimCLR 2 views, per-sample PIL pipeline as in load_data
+    transform = ContrastiveTransformations(transforms.Compose(simclr_aug(32, norm=CIFAR_NORM)), n_views=2)
+    ds = SyntheticImages(size=args.bs * 8, transform=transform)
+    loader = DataLoader(ds, batch_size=args.bs, shuffle=True, num_workers=args.workers)
+    return timed_iter(loader, args.steps, args.warmup), args.bs
+
+def bench_batch_augmentation(model, args):
+    # Same 2 views with BatchAugment, as in InMemoryLoader
+    augment = BatchAugment(transforms.Compose(simclr_aug(32, norm=CIFAR_NORM)))
+    x = torch.rand(args.bs, 3, 32, 32, device=args.device)
+    return timed_steps(lambda: [augment(x) for _ in range(2)], args.steps, args.warmup, args.device), args.bs
+
+def bench_forward_backward(model, args):
+    # Supervised step of pretext_train
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    inputs = torch.randn(args.bs, 3, 32, 32, device=args.device)
+    labels = torch.randint(0, 10, (args.bs,), device=args.device)
+    model.train()
+    def step():
+        optimizer.zero_grad()
+        loss = criterion(model(inputs), labels)
+        loss.backward()
+        optimizer.step()
+    return timed_steps(step, args.steps, args.warmup, args.device), args.bs
+
+def bench_info_nce(model, args):
+    # Contrastive step of pretext_train, 2 views of bs / 2 images
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    inputs = torch.randn(args.bs, 3, 32, 32, device=args.device)
+    model.train()
+    def step():
+        optimizer.zero_grad()
+        loss, _ = info_nce_loss(out=model(inputs, return_embed=True), temperature=0.5)
+        loss.backward()
+        optimizer.step()
+    return timed_steps(step, args.steps, args.warmup, args.device), args.bs
+
+def bench_saliency(model, args):
+    # Saliency-guided supervised step of pretext_train, on a smaller batch (one backward per image)
+    bs = max(2, args.bs // 8)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    labels = torch.randint(0, 10, (bs,), device=args.device)
+    model.train()
+    def step():
+        inputs = torch.rand(bs, 3, 32, 32, device=args.device, requires_grad=True)
+        optimizer.zero_grad()
+        out = model(inputs)
+        loss = criterion(out, labels)
+        saliency_maps = compute_saliency_map(outputs=out, model=model, input_images=inputs, embedding=False, normalized=True)
+        canny_edges = canny_edge_detector(input_images=inputs, low_threshold=75, high_threshold=175).to(args.device)
+        saliency_gt = edge2blob(canny_edges, kernel_size=5, sigma=2.0, device=args.device)
+        loss += kl_divergence(P=saliency_gt, Q=saliency_maps, forward=True)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return timed_steps(step, args.steps, args.warmup, args.device), bs
+
+def bench_test(model, args):
+    # Pretext test pass over a synthetic test set
+    loader = DataLoader(TensorDataset(torch.randn(args.bs * 4, 3, 32, 32), torch.randint(0, 10, (args.bs * 4,))), batch_size=args.bs)
+    step = lambda: test(0, model=model, test_loader=loader, is_vit=args.model == 'vit', log=False, device=args.device)
+    return timed_steps(step, max(1, args.steps // 4), 1, args.device), len(loader.dataset)
+
+def bench_knn_bias_eval(model, args):
+    # Leave-one-out KNN shape bias eval (eval_bias_embed) over a small probe set
+    loader = DataLoader(ProbeImages(size=args.probe_size), batch_size=args.bs)
+    step = lambda: eval_bias_embed(model=model, loader=loader, nb_neigh=5, log=False, device=args.device)
+    return timed_steps(step, 1, 0, args.device), len(loader.dataset)
+
+def bench_view_distances(model, args):
+    # Embedding distances of 3 views (eval_views_embed_dist)
+    views = torch.randn(args.bs * 4, 3, 3, 32, 32)
+    loader = DataLoader(TensorDataset(views, torch.zeros(len(views))), batch_size=args.bs,
+                        collate_fn=lambda batch: [list(torch.stack([b[0] for b in batch]).unbind(1)), torch.stack([b[1] for b in batch])])
+    step = lambda: eval_views_embed_dist(0, model=model, test_loader=loader, log=False, device=args.device)
+    return timed_steps(step, max(1, args.steps // 4), 1, args.device), len(views)
+
+# Stages that do not depend on the model run once, under the 'data' model name
+DATA_STAGES = {
+    'data_loading': bench_data_loading,
+    'augmentation': bench_augmentation,
+    'batch_augmentation': bench_batch_augmentation,
+}
+MODEL_STAGES = {
+    'forward_backward': bench_forward_backward,
+    'info_nce': bench_info_nce,
+    'saliency': bench_saliency,
+    'test': bench_test,
+    'knn_bias_eval': bench_knn_bias_eval,
+    'view_distances': bench_view_distances,
+}
+
+def peak_memory_mb(device):
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10 # KB on Linux
+
+def summarize(times, samples):
+    times = np.asarray(times)
+    return {
+        'samples_per_sec': samples * len(times) / times.sum(),
+        'p50_ms': 1000 * np.percentile(times, 50),
+        'p90_ms': 1000 * np.percentile(times, 90),
+        'p99_ms': 1000 * np.percentile(times, 99),
+        'steps': len(times),
+        'samples_per_step': samples,
+    }
+
+def run(args):
+    torch.manual_seed(0)
+    results = {}
+    jobs = [('data', name, fn) for name, fn in DATA_STAGES.items()] + \
+           [(model, name, fn) for model in args.models for name, fn in MODEL_STAGES.items()]
+    models = {}
+    for model_name, stage, fn in jobs:
+        if args.stages and stage not in args.stages:
+            continue
+        if model_name != 'data' and model_name not in models:
+            models[model_name] = build_model(model_name).to(args.device)
+        args.model = model_name
+        if torch.device(args.device).type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(args.device)
+
+        times, samples = fn(models.get(model_name), args)
+        result = summarize(times, samples)
+        result['peak_mem_mb'] = peak_memory_mb(args.device)
+        results['{}/{}'.format(model_name, stage)] = result
+        print('{:<28} {:>10.1f} samples/s  p50 {:>8.2f} ms  p99 {:>8.2f} ms  peak {:>8.1f} MB'.format(
+            model_name + '/' + stage, result['samples_per_sec'], result['p50_ms'], result['p99_ms'], result['peak_mem_mb']))
+
+    return {
+        'meta': {
+            'date': time.strftime('%Y-%m-%d-%H-%M'),
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'device': str(args.device),
+            'threads': torch.get_num_threads(),
+            'bs': args.bs,
+        },
+        'results': results,
+    }
+
+def compare(report, baseline, tolerance=0.1):
+    '''
+    Compare samples/sec with a baseline report, return the stages slower by more than tolerance.
+    '''
+    regressions = []
+    print('\n{:<28} {:>12} {:>12} {:>8}'.format('stage', 'baseline', 'current', 'ratio'))
+    for key, result in report['results'].items():
+        if key not in baseline['results']:
+            continue
+        base = baseline['results'][key]['samples_per_sec']
+        ratio = result['samples_per_sec'] / base
+        flag = ' <- regression' if ratio < 1 - tolerance else ''
+        print('{:<28} {:>12.1f} {:>12.1f} {:>8.2f}{}'.format(key, base, result['samples_per_sec'], ratio, flag))
+        if flag:
+            regressions.append(key)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the training and evaluation stages on synthetic data')
+    parser.add_argument('--models', nargs='+', default=['vit', 'resnet18'], choices=['vit', 'resnet18', 'resnet50'])
+    parser.add_argument('--stages', nargs='+', default=None, choices=list(DATA_STAGES) + list(MODEL_STAGES), help='default: all')
+    parser.add_argument('--bs', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--probe-size', type=int, default=160, help='images of the synthetic Geirhos probe set')
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--out', default=None, help='write the report to this JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as regression')
+    args = parser.parse_args()
+
+    set_metrics_sink(MetricsSink(['none'])) # eval functions log metrics, dropped here
+    report = run(args)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit(1)
@@ -1,5 +1,14 @@
 from PIL import Image
 from time import sleep
+import time
+import queue
+import threading
+import zlib
+import copy
+import hashlib
+from functools import lru_cache, partial
+from collections import OrderedDict
+from collections.abc import Mapping
 import cv2
 import numpy as np
 import os
@@ -9,10 +18,11 @@ import torch
 import pandas as pd
 import torchvision.datasets as datasets
 from torchvision.datasets import CIFAR10, ImageNet, STL10, Cityscapes, ImageFolder
-from torch.utils.data.sampler import SubsetRandomSampler
 from torch.utils.data import DataLoader, random_split
 import torch.nn.functional as F
 
+from utils import remove_int
+
 dict = {0: 'tench, Tinca tinca',
     1: 'goldfish, Carassius auratus',
     2: 'great white shark, white shark, man-eater, man-eating shark, Carcharodon carcharias',
@@ -1015,15 +1025,73 @@ dict = {0: 'tench, Tinca tinca',
     999: 'toilet tissue, toilet paper, bathroom tissue'}
     
 
+def _is_deterministic(op):
+    return isinstance(op, (transforms.Resize, transforms.CenterCrop, transforms.Grayscale, transforms.ToTensor, 
+                           transforms.PILToTensor, transforms.Normalize, BilateralFilterTransform, BilateralFilterTensor))
+
+def split_views(pipelines):
+    '''
+    Split Compose pipelines into the ops they share at their start, then for each pipeline 
+    its remaining deterministic ops and its random suffix (from the first random op on).
+    '''
+    ops = [list(p.transforms) if isinstance(p, transforms.Compose) else [p] for p in pipelines]
+    shared = []
+    while all(len(o) > len(shared) and _is_deterministic(o[len(shared)]) for o in ops) and \
+            len(set(repr(o[len(shared)]) for o in ops)) == 1:
+        shared.append(ops[0][len(shared)])
+
+    branches = []
+    for o in ops:
+        o = o[len(shared):]
+        n = 0
+        while n < len(o) and _is_deterministic(o[n]): n += 1
+        branches.append((o[:n], o[n:]))
+    return shared, branches
+
 class ContrastiveTransformations:
-    def __init__(self, base_transforms, n_views=2, spe_transforms=None):
+    '''
+    Views of an image: n_views of base_transforms, or the pair [base_transforms, spe_transforms].
+    The deterministic ops the pipelines start with (e.g. Resize + CenterCrop) run once per image instead of once per view,
+    only the random suffixes are run per view. With cache_size > 0, the deterministic part of each view is kept for the
+    cache_size most recently seen images, e.g. the whole Resize + CenterCrop + ToTensor base view of large image pair loaders.
+    The cache is keyed by the sample the image is (see CachedViewsDataset, which make_loader wraps the dataset in),
+    images transformed without a key are not cached. Each loader worker has its own cache, kept across epochs by
+    persistent workers.
+    '''
+    def __init__(self, base_transforms, n_views=2, spe_transforms=None, cache_size=0):
         self.base_transforms = base_transforms
         self.n_views = n_views
         self.spe_transforms = spe_transforms
-
-    def __call__(self, x):
-        if self.spe_transforms is None: return [self.base_transforms(x) for i in range(self.n_views)] # return n_views versions of an image following base_transforms
-        else: return [self.base_transforms(x), self.spe_transforms(x)] # return only pair of [base_transforms, specific_transforms] augmented image
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        pipelines = [base_transforms] if spe_transforms is None else [base_transforms, spe_transforms]
+        shared, branches = split_views(pipelines)
+        self.shared = transforms.Compose(shared)
+        self.deterministic = [transforms.Compose(det) for det, _ in branches]
+        self.random = [transforms.Compose(rand) for _, rand in branches]
+
+    def prepare(self, x, key=None):
+        '''
+        Deterministic part of each pipeline, from the cache if possible.
+        '''
+        if self.cache_size > 0 and key is not None:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        x = self.shared(x)
+        prepared = [det(x) for det in self.deterministic]
+        if self.cache_size > 0 and key is not None:
+            self.cache[key] = prepared
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return prepared
+
+    def __call__(self, x, key=None):
+        prepared = self.prepare(x, key)
+        if self.spe_transforms is None: return [self.random[0](prepared[0]) for i in range(self.n_views)] # return n_views versions of an image following base_transforms
+        else: return [self.random[0](prepared[0]), self.random[1](prepared[1])] # return only pair of [base_transforms, specific_transforms] augmented image
 
 def simclr_aug(size, *args, norm, bilateral=False):
     '''
@@ -1032,6 +1100,7 @@ def simclr_aug(size, *args, norm, bilateral=False):
     Note:
         RandomResizedCrop & GaussianBlur do not have p as parameter, must pass:  (aug, None)
         Bilateral filter takes three parameters, must pass: ('bilateral', diameter, sigma_color, sigma_space)
+        and optionally 'tensor' as fifth element, to filter tensors with BilateralFilterTensor instead of cv2 (same for bilateral='tensor')
     Possible examples:
         ('hflip', p)
         ('crop', None)
@@ -1043,8 +1112,18 @@ def simclr_aug(size, *args, norm, bilateral=False):
     # Return standard simCLR augmentations
     if not args:
    
+        # Use Bilateral filtering, on tensors
+        if bilateral == 'tensor':
+            return [transforms.RandomHorizontalFlip(),
+                    transforms.RandomResizedCrop(size=size),
+                    transforms.RandomApply([transforms.ColorJitter(brightness=0.5, contrast=0.5, saturation=0.5, hue=0.1)], p=0.8),
+                    transforms.RandomGrayscale(p=0.2),
+                    transforms.ToTensor(),
+                    BilateralFilterTensor(d=9, sigma_color=125, sigma_space=125),
+                    transforms.Normalize(norm[0], norm[1]),]
+
         # Use Bilateral filtering
-        if bilateral:
+        elif bilateral:
             return [transforms.RandomHorizontalFlip(),
                     transforms.RandomResizedCrop(size=size),
                     transforms.RandomApply([transforms.ColorJitter(brightness=0.5, contrast=0.5, saturation=0.5, hue=0.1)], p=0.8),
@@ -1087,24 +1166,708 @@ def simclr_aug(size, *args, norm, bilateral=False):
             elif des_aug[0] == 'gray':
                 aug += [transforms.RandomGrayscale(p=des_aug[1])]
 
+            elif des_aug[0] == 'bilateral' and len(des_aug) > 4 and des_aug[4] == 'tensor':
+                # Following augmentations are applied on tensors as well
+                if not any(isinstance(a, transforms.ToTensor) for a in aug): aug += [transforms.ToTensor()]
+                aug += [BilateralFilterTensor(d=des_aug[1], sigma_color=des_aug[2], sigma_space=des_aug[3])]
+
             elif des_aug[0] == 'bilateral':
                 aug += [BilateralFilterTransform(d=des_aug[1], sigma_color=des_aug[2], sigma_space=des_aug[3])]
 
             elif des_aug[0] == 'g_blur':
                 aug += [transforms.GaussianBlur(kernel_size=9)]
         
-        aug += [transforms.ToTensor(),
-                transforms.Normalize(norm[0], norm[1]),]
+        if not any(isinstance(a, transforms.ToTensor) for a in aug): aug += [transforms.ToTensor()]
+        aug += [transforms.Normalize(norm[0], norm[1]),]
 
         return aug
 
+# DataLoader settings per dataset: (num_workers, prefetch_factor)
+LOADER_SETTINGS = {
+    'CIFAR10'       : (4, 2), # small images, cheap decode
+    'STL10'         : (4, 2),
+    'tiny'          : (6, 2),
+    'ImageNetO'     : (6, 2),
+    'cityscapes'    : (6, 2),
+    'ImageNet'      : (8, 4), # large JPEG decode dominates
+    'counterfactual': (8, 4),
+    'noise'         : (8, 4),
+    'fractal'       : (8, 4),
+    'geirhos'       : (4, 2), # 512px PNG probes, re-read at each test interval
+}
+_autotuned_settings = {}
+
+def loader_config(dataset, stage='pre', num_workers=None, prefetch_factor=None, persistent=False):
+    '''
+    Return the DataLoader kwargs for dataset at stage ('pre', 'down' or 'eval').
+    Workers are capped to the available cores, memory is pinned (and device copies can be
+    non-blocking, see loader.pin_memory) when training on cuda. With persistent, workers are kept
+    alive between epochs, for the train loaders iterated every epoch.
+    Downstream/eval loaders only run every test interval, they get half the workers, started at each
+    iteration rather than held (with their memory) in between.
+    '''
+    if (dataset, stage) in _autotuned_settings:
+        num_workers = _autotuned_settings[(dataset, stage)][0] if num_workers is None else num_workers
+        default_prefetch = _autotuned_settings[(dataset, stage)][1]
+    else:
+        default_workers, default_prefetch = LOADER_SETTINGS.get(dataset, (4, 2))
+        if num_workers is None:
+            num_workers = default_workers if stage == 'pre' else max(default_workers // 2, 1)
+    num_workers = min(num_workers, os.cpu_count() or 1)
+
+    return {
+        'num_workers': num_workers,
+        'pin_memory': torch.cuda.is_available(),
+        'persistent_workers': persistent and num_workers > 0,
+        'prefetch_factor': (prefetch_factor or default_prefetch) if num_workers > 0 else None,
+    }
+
+def autotune_loader(ds, dataset, stage='pre', bs=64, candidates=((0, 2), (2, 2), (4, 2), (4, 4), (8, 2), (8, 4)),
+                    nb_batches=10, verbose=False):
+    '''
+    Measure batches/sec of ds for each (num_workers, prefetch_factor) candidate and keep the fastest
+    for (dataset, stage): later loader_config calls use it. Worker start-up and the first batch are excluded.
+    Datasets of at most one batch can not be measured, loader_config then keeps its defaults (returns None).
+    '''
+    if (dataset, stage) in _autotuned_settings:
+        return _autotuned_settings[(dataset, stage)]
+    if len(ds) <= bs: # the warm-up batch would be the only one
+        return None
+
+    best, best_rate = None, 0
+    for workers, prefetch in candidates:
+        if workers > (os.cpu_count() or 1): continue
+        loader = DataLoader(ds, batch_size=bs, shuffle=True, num_workers=workers, pin_memory=torch.cuda.is_available(),
+                            prefetch_factor=prefetch if workers > 0 else None)
+        it = iter(loader)
+        next(it) # warm up
+        start = time.perf_counter()
+        nb = 0
+        for _ in range(nb_batches):
+            try: next(it)
+            except StopIteration: break
+            nb += 1
+        rate = nb / (time.perf_counter() - start)
+        del it, loader
+
+        if verbose: print('Loader autotune {} ({}): workers={}, prefetch={}: {:.1f} batches/s'.format(dataset, stage, workers, prefetch, rate))
+        if rate > best_rate:
+            best, best_rate = (workers, prefetch), rate
+
+    _autotuned_settings[(dataset, stage)] = best
+    return best
+
+def _no_transform(img):
+    return img
+
+class CachedViewsDataset(torch.utils.data.Dataset):
+    '''
+    ds (or a Subset of it) with its ContrastiveTransformations applied here, keyed by the sample: (the dataset holding
+    the transform, index in it). Splits sharing a transform (Subsets of one dataset, or train/test datasets built with
+    the same transform) then share its cache without mixing their images. Items of ds are (image, targets...).
+    '''
+    def __init__(self, ds):
+        owner, attr = _transform_owner(ds)
+        self.indices = ds.indices if isinstance(ds, torch.utils.data.Subset) else None
+        self.views = getattr(owner, attr)
+        self.owner_key = id(owner) # taken in the main process, kept as is by the copies of the loader workers
+        # Shallow copy returning untransformed images, the owner is left as is for other loaders
+        self.raw = copy.copy(owner)
+        setattr(self.raw, attr, _no_transform)
+
+    def __len__(self):
+        return len(self.raw) if self.indices is None else len(self.indices)
+
+    def __getitem__(self, idx):
+        sample = int(idx if self.indices is None else self.indices[idx])
+        item = self.raw[sample]
+        return (self.views(item[0], key=(self.owner_key, sample)),) + tuple(item[1:])
+
+def make_loader(ds, dataset, stage='pre', bs=64, shuffle=False, sampler=None, num_workers=None, autotune=False, persistent=False):
+    '''
+    DataLoader over ds with the settings of loader_config, autotuned first if autotune.
+    persistent: keep the workers between epochs, for train loaders.
+    Datasets with a caching ContrastiveTransformations are wrapped in CachedViewsDataset, and their workers are kept
+    too: the caches live in the workers, they would be empty at every pass otherwise.
+    '''
+    owner, attr = _transform_owner(ds)
+    if isinstance(getattr(owner, attr, None), ContrastiveTransformations) and getattr(owner, attr).cache_size > 0:
+        ds = CachedViewsDataset(ds)
+        persistent = True
+    if autotune and num_workers is None:
+        autotune_loader(ds, dataset, stage=stage, bs=bs)
+    return DataLoader(ds, batch_size=bs, shuffle=shuffle, sampler=sampler, **loader_config(dataset, stage, num_workers, persistent=persistent))
+
+def batch_to_device(batch, device, non_blocking=False):
+    '''
+    Move every tensor of a (nested) batch to device, other elements are returned as is.
+    '''
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=non_blocking)
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(batch_to_device(b, device, non_blocking) for b in batch)
+    elif isinstance(batch, Mapping):
+        return {k: batch_to_device(b, device, non_blocking) for k, b in batch.items()}
+    return batch
+
+def _pin_batch(batch):
+    if torch.is_tensor(batch):
+        # Only dense CPU tensors can be pinned, device-resident ones are returned as is
+        return batch if batch.device.type != 'cpu' or batch.is_pinned() else batch.pin_memory()
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(_pin_batch(b) for b in batch)
+    elif isinstance(batch, Mapping):
+        return {k: _pin_batch(b) for k, b in batch.items()}
+    return batch
+
+def _on_device(batch):
+    # True if the (nested) batch has tensors and none of them is on cpu, e.g. batches of an InMemoryLoader on cuda
+    if torch.is_tensor(batch):
+        return batch.device.type != 'cpu'
+    elif isinstance(batch, (list, tuple, Mapping)):
+        elements = [_on_device(b) for b in (batch.values() if isinstance(batch, Mapping) else batch)]
+        elements = [e for e in elements if e is not None]
+        return all(elements) if elements else None
+    return None
+
+def _record_stream(batch, stream):
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for b in batch: _record_stream(b, stream)
+    elif isinstance(batch, Mapping):
+        for b in batch.values(): _record_stream(b, stream)
+
+class ResumableSampler(torch.utils.data.Sampler):
+    '''
+    Seeded sampler over a list of indices, with (epoch, offset) state that can be checkpointed and restored.
+    The order of an epoch only depends on (seed, epoch), using a local generator (global RNGs are left untouched),
+    so a restored sampler continues at the exact sample it stopped at.
+    Shardable across data-parallel ranks: every rank draws the same permutation (padded to a multiple 
+    of num_replicas) and keeps every num_replicas-th index, from rank on.
+    '''
+    def __init__(self, indices, shuffle=True, seed=42, num_replicas=1, rank=0):
+        assert 0 <= rank < num_replicas, 'rank must be in [0, num_replicas)'
+        self.indices = np.asarray(indices)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(np.ceil(len(self.indices) / num_replicas))
+        self.epoch = 0
+        self.offset = 0 # samples of the current epoch already drawn by this rank
+        self._iter_epoch, self._iter_start = 0, 0
+
+    def __len__(self):
+        return self.num_samples - self.offset
+
+    def set_epoch(self, epoch):
+        self.epoch, self.offset = epoch, 0
+
+    def epoch_indices(self, epoch):
+        '''
+        Indices drawn by this rank during epoch.
+        '''
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, epoch]).permutation(len(self.indices))
+        else:
+            order = np.arange(len(self.indices))
+        # Pad by wrapping around so every rank draws num_samples
+        order = np.resize(order, self.num_samples * self.num_replicas)
+        return self.indices[order[self.rank::self.num_replicas]]
+
+    def __iter__(self):
+        if self.offset >= self.num_samples:
+            self.set_epoch(self.epoch + 1)
+        self._iter_epoch, self._iter_start = self.epoch, self.offset
+
+        for idx in self.epoch_indices(self.epoch)[self.offset:]:
+            self.offset += 1
+            yield int(idx)
+        self.set_epoch(self._iter_epoch + 1)
+
+    def state_dict(self, nb_consumed=None):
+        '''
+        nb_consumed: samples consumed by the training loop since the start of the current iteration.
+        Loader workers draw indices ahead of the loop, so pass it to checkpoint mid-epoch: the state 
+        then points at the first sample not yet trained on, not at the first sample not yet drawn.
+        '''
+        if nb_consumed is None:
+            epoch, offset = self.epoch, self.offset
+        else:
+            epoch, offset = self._iter_epoch, self._iter_start + nb_consumed
+            if offset >= self.num_samples:
+                epoch, offset = epoch + 1, 0
+        return {'seed': self.seed, 'epoch': epoch, 'offset': offset}
+
+    def load_state_dict(self, state):
+        self.seed, self.epoch, self.offset = state['seed'], state['epoch'], state['offset']
+
+class DevicePrefetcher(object):
+    '''
+    Wrap a loader so that its batches come out already on device, the next batch being prepared while the current one is used.
+    On cuda, the next batch is pinned and copied with a non-blocking copy on a side stream.
+    Otherwise, batches are fetched ahead by a background thread (queue of queue_size batches).
+    Other attributes (dataset, batch_size, pin_memory...) are the wrapped loader's, so it can replace it transparently.
+    '''
+    def __init__(self, loader, device='cuda:0', queue_size=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.queue_size = queue_size
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['loader'], name)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+
+        def preload():
+            try: batch = next(loader_iter)
+            except StopIteration: return None
+            if _on_device(batch): # already on device, no copy to overlap
+                return batch_to_device(batch, self.device)
+            with torch.cuda.stream(stream):
+                return batch_to_device(_pin_batch(batch), self.device, non_blocking=True)
+
+        next_batch = preload()
+        while next_batch is not None:
+            # Wait for the copy, and keep the memory alive for the compute stream
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            _record_stream(batch, torch.cuda.current_stream(self.device))
+            next_batch = preload()
+            yield batch
+
+    def _thread_iter(self):
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # Give up if the consumer stopped iterating
+            while not stop.is_set():
+                try: 
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full: continue
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    if not put(batch_to_device(batch, self.device)): return
+                put(done)
+            except BaseException as e: # re-raised in the consumer (KeyboardInterrupt, SystemExit... too), not lost with the thread
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done: break
+                if isinstance(batch, BaseException): raise batch
+                yield batch
+        finally:
+            stop.set()
+
+TENSOR_STORE_ROOT = os.path.join("data", "tensor_store")
+
+def split_transform(transform):
+    '''
+    Split an eval transform Compose([deterministic PIL ops..., ToTensor(), Normalize()]) into 
+    (PIL ops, mean, std), mean and std being None without Normalize. Returns None for other transforms
+    (random augmentations, multiple views, ops on tensors), which cannot be preprocessed once.
+    '''
+    if not isinstance(transform, transforms.Compose):
+        return None
+    ops = list(transform.transforms)
+    mean, std = None, None
+    if ops and isinstance(ops[-1], transforms.Normalize):
+        mean, std = ops[-1].mean, ops[-1].std
+        ops = ops[:-1]
+    if not ops or not isinstance(ops[-1], transforms.ToTensor):
+        return None
+    ops = ops[:-1]
+    if not all(isinstance(op, (transforms.Resize, transforms.CenterCrop, transforms.Grayscale)) for op in ops):
+        return None
+    return ops, mean, std
+
+def _transform_owner(ds):
+    '''
+    Dataset holding the transform of ds (the full dataset of a Subset), and the name of its transform attribute.
+    '''
+    owner = ds.dataset if isinstance(ds, torch.utils.data.Subset) else ds
+    return owner, 'transforms' if isinstance(owner, MyDataset) else 'transform'
+
+def _source_signature(owner):
+    '''
+    What the images of a dataset are read from: its decode size (see open_image), root, and a digest
+    of its file list (samples, imgs, images, img_list) or in-memory data (e.g. CIFAR's data array).
+    '''
+    loader = getattr(owner, 'loader', None) # ImageFolder-style datasets, decode size in an open_image partial
+    decode_size = getattr(owner, 'decode_size', getattr(loader, 'keywords', {}).get('decode_size'))
+    root = getattr(owner, 'root', None)
+    root = os.path.abspath(root) if isinstance(root, str) else None
+    digest = hashlib.sha1()
+    for attr in ['samples', 'imgs', 'images', 'img_list']:
+        if isinstance(getattr(owner, attr, None), list):
+            digest.update('\n'.join(str(item) for item in getattr(owner, attr)).encode())
+            break
+    else:
+        if isinstance(getattr(owner, 'data', None), np.ndarray):
+            digest.update(np.ascontiguousarray(owner.data).tobytes())
+    return '{}|{}|{}'.format(decode_size, root, digest.hexdigest())
+
+def uint8_batches(ds, name, ops, bs=256):
+    '''
+    Iterate over ds with its transform temporarily replaced by the PIL ops and PILToTensor, 
+    yielding (uint8 NCHW images, [target arrays]) batches.
+    '''
+    owner, attr = _transform_owner(ds)
+    transform = getattr(owner, attr)
+    setattr(owner, attr, transforms.Compose(list(ops) + [transforms.PILToTensor()]))
+    try:
+        for batch in make_loader(ds, name, 'eval', bs=bs):
+            yield batch[0].numpy(), [np.asarray(t) for t in batch[1:]]
+    finally:
+        setattr(owner, attr, transform)
+
+class TensorStore(object):
+    '''
+    Eval split preprocessed once into a uint8 NCHW memmap (output of the deterministic PIL ops, before ToTensor), 
+    plus its targets, under TENSOR_STORE_ROOT/<name>-<key>, the key hashing the PIL ops, the split size and indices,
+    and the source of the images (decode size, root and file list or data, see _source_signature).
+    batch() slices the memmap and applies ToTensor and Normalize to the whole batch, giving the same tensors as the dataset.
+    '''
+    def __init__(self, ds, name, root=TENSOR_STORE_ROOT):
+        owner, attr = _transform_owner(ds)
+        split = split_transform(getattr(owner, attr))
+        assert split is not None, 'The transform of {} is not a deterministic eval transform'.format(name)
+        ops, mean, std = split
+        self.mean = None if mean is None else torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        self.std = None if std is None else torch.tensor(std, dtype=torch.float32).view(-1, 1, 1)
+
+        signature = '{}|{}|{}|{}'.format(name, len(ds), repr(ops), _source_signature(owner))
+        if isinstance(ds, torch.utils.data.Subset):
+            signature += '|' + hashlib.sha1(np.asarray(ds.indices, dtype=np.int64).tobytes()).hexdigest()
+        self.path = os.path.join(root, '{}-{}'.format(name, hashlib.sha1(signature.encode()).hexdigest()[:12]))
+
+        if not os.path.exists(os.path.join(self.path, 'targets.npz')):
+            self.build(ds, name, owner, attr, ops)
+        self.images = np.load(os.path.join(self.path, 'images.npy'), mmap_mode='r')
+        targets = np.load(os.path.join(self.path, 'targets.npz'))
+        self.targets = [targets['t{}'.format(i)] for i in range(len(targets.files))]
+
+    def build(self, ds, name, owner, attr, ops):
+        os.makedirs(self.path, exist_ok=True)
+        images, targets, start = None, [], 0
+        for imgs, batch_targets in uint8_batches(ds, name, ops):
+            if images is None:
+                images = np.lib.format.open_memmap(os.path.join(self.path, 'images.npy'), mode='w+', dtype=np.uint8, 
+                                                   shape=(len(ds),) + imgs.shape[1:])
+            images[start:start + len(imgs)] = imgs
+            start += len(imgs)
+            targets.append(batch_targets)
+        images.flush()
+        # Written last, marks the store as complete
+        np.savez(os.path.join(self.path, 'targets.npz'), **{'t{}'.format(i): np.concatenate(t) for i, t in enumerate(zip(*targets))})
+
+    def __len__(self):
+        return len(self.images)
+
+    def batch(self, start, end):
+        imgs = torch.from_numpy(np.array(self.images[start:end])).float().div(255)
+        if self.mean is not None:
+            imgs = imgs.sub_(self.mean).div_(self.std)
+        targets = [t[start:end] for t in self.targets]
+        return [imgs] + [torch.from_numpy(t) if t.dtype.kind in 'biuf' else list(t) for t in targets]
+
+class StoreLoader(object):
+    '''
+    Loader over a TensorStore reading whole batches by slicing, in order, without worker processes.
+    Has the dataset, batch_size and pin_memory attributes of a DataLoader used by the eval loops.
+    '''
+    def __init__(self, store, bs=64):
+        self.dataset = store
+        self.batch_size = bs
+        self.pin_memory = torch.cuda.is_available()
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.dataset), self.batch_size):
+            yield self.dataset.batch(start, start + self.batch_size)
+
+def eval_loader(ds, dataset, stage='eval', bs=64, num_workers=None, autotune=False, tensor_store=False):
+    '''
+    Loader of an eval split: a StoreLoader if tensor_store and its transform is deterministic, make_loader otherwise.
+    '''
+    owner, attr = _transform_owner(ds)
+    if tensor_store and split_transform(getattr(owner, attr)) is not None:
+        return StoreLoader(TensorStore(ds, dataset), bs=bs)
+    return make_loader(ds, dataset, stage, bs=bs, num_workers=num_workers, autotune=autotune)
+
+# Batched augmentations: float (B, C, H, W) batches in [0, 1], random parameters drawn per image
+def _gray(x):
+    return (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+def batch_hflip(x, p=0.5):
+    flip = torch.rand(x.shape[0], device=x.device) < p
+    return torch.where(flip[:, None, None, None], x.flip(-1), x)
+
+def batch_resized_crop(x, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), attempts=10):
+    '''
+    RandomResizedCrop with a crop per image, all resized at once with grid_sample (bilinear, no antialiasing).
+    Images without a valid crop in attempts draws keep the whole image.
+    '''
+    B, C, H, W = x.shape
+    size = (size, size) if isinstance(size, int) else tuple(size)
+    area = H * W * torch.empty(B, attempts, device=x.device).uniform_(*scale)
+    aspect = torch.exp(torch.empty(B, attempts, device=x.device).uniform_(np.log(ratio[0]), np.log(ratio[1])))
+    w, h = torch.sqrt(area * aspect).round(), torch.sqrt(area / aspect).round()
+    valid = (w > 0) & (w <= W) & (h > 0) & (h <= H)
+    first = valid.float().argmax(dim=1, keepdim=True)
+    found = valid.any(dim=1)
+    w = torch.where(found, w.gather(1, first).squeeze(1), torch.full_like(found, W, dtype=x.dtype))
+    h = torch.where(found, h.gather(1, first).squeeze(1), torch.full_like(found, H, dtype=x.dtype))
+    top = torch.floor(torch.rand(B, device=x.device) * (H - h + 1))
+    left = torch.floor(torch.rand(B, device=x.device) * (W - w + 1))
+
+    # Affine map from the output grid to the crop, in normalized coordinates
+    theta = torch.zeros(B, 2, 3, device=x.device, dtype=x.dtype)
+    theta[:, 0, 0], theta[:, 0, 2] = w / W, (2 * left + w) / W - 1
+    theta[:, 1, 1], theta[:, 1, 2] = h / H, (2 * top + h) / H - 1
+    grid = F.affine_grid(theta, (B, C) + size, align_corners=False)
+    return F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+_RGB2YIQ = torch.tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]])
+
+def batch_color_jitter(x, brightness=None, contrast=None, saturation=None, hue=None, p=1.):
+    '''
+    ColorJitter with factors drawn per image, applied with probability p (RandomApply), in a fixed order.
+    Ranges as stored by ColorJitter: (min, max) factors, (-h, h) for hue, None to skip.
+    Hue is shifted by a rotation of the chroma plane in YIQ space, close to ColorJitter's HSV shift.
+    '''
+    B = x.shape[0]
+    applied = (torch.rand(B, 1, 1, 1, device=x.device) < p).to(x.dtype)
+    def factor(bounds, neutral=1.):
+        f = torch.empty(B, 1, 1, 1, device=x.device, dtype=x.dtype).uniform_(*bounds)
+        return neutral + applied * (f - neutral)
+
+    if brightness is not None:
+        x = (x * factor(brightness)).clamp(0, 1)
+    if contrast is not None:
+        f = factor(contrast)
+        x = (f * x + (1 - f) * _gray(x).mean(dim=(1, 2, 3), keepdim=True)).clamp(0, 1)
+    if saturation is not None:
+        f = factor(saturation)
+        x = (f * x + (1 - f) * _gray(x)).clamp(0, 1)
+    if hue is not None:
+        angle = factor(hue, neutral=0.).view(B) * 2 * np.pi
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        rotation = torch.zeros(B, 3, 3, device=x.device, dtype=x.dtype)
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1], rotation[:, 1, 2], rotation[:, 2, 1], rotation[:, 2, 2] = cos, -sin, sin, cos
+        yiq = _RGB2YIQ.to(device=x.device, dtype=x.dtype)
+        mix = torch.linalg.inv(yiq) @ rotation @ yiq
+        x = torch.einsum('bij,bjhw->bihw', mix, x).clamp(0, 1)
+    return x
+
+def batch_grayscale(x, p=0.1):
+    gray = torch.rand(x.shape[0], device=x.device) < p
+    return torch.where(gray[:, None, None, None], _gray(x).expand_as(x), x)
+
+def batch_gaussian_blur(x, kernel_size=9, sigma=(0.1, 2.0)):
+    '''
+    GaussianBlur with a sigma per image: separable grouped convolutions, reflect padding.
+    '''
+    B, C, H, W = x.shape
+    kx, ky = (kernel_size, kernel_size) if isinstance(kernel_size, int) else kernel_size
+    sig = torch.empty(B, 1, device=x.device, dtype=x.dtype).uniform_(*sigma).repeat_interleave(C, dim=0)
+    def kernel(k):
+        t = torch.arange(k, device=x.device, dtype=x.dtype) - (k - 1) / 2
+        kern = torch.exp(-t ** 2 / (2 * sig ** 2))
+        return kern / kern.sum(dim=1, keepdim=True)
+
+    y = F.pad(x.reshape(1, B * C, H, W), (kx // 2, kx // 2, ky // 2, ky // 2), mode='reflect')
+    y = F.conv2d(y, kernel(kx)[:, None, None, :], groups=B * C)
+    y = F.conv2d(y, kernel(ky)[:, None, :, None], groups=B * C)
+    return y.view(B, C, H, W)
+
+def batch_shuffle_patches(x, ps):
+    '''
+    ShufflePatches with a permutation of the patches per image.
+    '''
+    u = F.unfold(x, kernel_size=ps, stride=ps)
+    perm = torch.rand(u.shape[0], u.shape[2], device=x.device).argsort(dim=1)
+    u = u.gather(2, perm[:, None, :].expand_as(u))
+    return F.fold(u, x.shape[-2:], kernel_size=ps, stride=ps)
+
+def batch_normalize(x, mean, std):
+    mean = torch.as_tensor(mean, device=x.device, dtype=x.dtype).view(1, -1, 1, 1)
+    std = torch.as_tensor(std, device=x.device, dtype=x.dtype).view(1, -1, 1, 1)
+    return (x - mean) / std
+
+class BatchAugment(object):
+    '''
+    Batched version of a Compose of torchvision transforms (those of simclr_aug and the eval transforms),
+    applied to a float batch in [0, 1] instead of PIL images, with random parameters drawn per image.
+    Raises ValueError for transforms without a batched version.
+    '''
+    def __init__(self, transform):
+        ops = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+        self.ops = [op for op in (self.convert(op) for op in ops) if op is not None]
+
+    @staticmethod
+    def convert(op):
+        if isinstance(op, transforms.ToTensor):
+            return None # batches are already float tensors in [0, 1]
+        elif isinstance(op, transforms.RandomHorizontalFlip):
+            return partial(batch_hflip, p=op.p)
+        elif isinstance(op, transforms.RandomResizedCrop):
+            return partial(batch_resized_crop, size=op.size, scale=op.scale, ratio=op.ratio)
+        elif isinstance(op, transforms.ColorJitter):
+            return partial(batch_color_jitter, brightness=op.brightness, contrast=op.contrast, saturation=op.saturation, hue=op.hue)
+        elif isinstance(op, transforms.RandomApply) and len(op.transforms) == 1 and isinstance(op.transforms[0], transforms.ColorJitter):
+            jitter = op.transforms[0]
+            return partial(batch_color_jitter, brightness=jitter.brightness, contrast=jitter.contrast, 
+                           saturation=jitter.saturation, hue=jitter.hue, p=op.p)
+        elif isinstance(op, transforms.RandomGrayscale):
+            return partial(batch_grayscale, p=op.p)
+        elif isinstance(op, transforms.GaussianBlur):
+            return partial(batch_gaussian_blur, kernel_size=op.kernel_size, sigma=op.sigma)
+        elif isinstance(op, ShufflePatches):
+            return partial(batch_shuffle_patches, ps=op.ps)
+        elif isinstance(op, (BilateralFilterTransform, BilateralFilterTensor)):
+            return partial(batch_bilateral, d=op.d, sigma_color=op.sigma_color, sigma_space=op.sigma_space)
+        elif isinstance(op, transforms.Normalize):
+            return partial(batch_normalize, mean=op.mean, std=op.std)
+        elif isinstance(op, transforms.Resize):
+            return partial(transforms.functional.resize, size=op.size, antialias=True)
+        elif isinstance(op, transforms.CenterCrop):
+            return partial(transforms.functional.center_crop, output_size=op.size)
+        raise ValueError('No batched version of {}'.format(op))
+
+    def __call__(self, x):
+        for op in self.ops:
+            x = op(x)
+        return x
+
+def _deterministic_prefix(ops):
+    '''
+    Leading ops that give the same output for every call (resizes and center crops), applied once when loading in memory.
+    '''
+    prefix = []
+    for op in ops:
+        if not isinstance(op, (transforms.Resize, transforms.CenterCrop)): break
+        prefix.append(op)
+    return prefix
+
+class InMemoryLoader(object):
+    '''
+    Loader of a dataset held in memory as a uint8 NCHW tensor, on the host or directly on the device.
+    Batches are gathered by indexing and augmented as a whole with BatchAugment, without worker processes.
+    Yields the same structure as a DataLoader over the dataset (views list for ContrastiveTransformations, then targets).
+    '''
+    def __init__(self, images, targets, augments, spe_pair=False, bs=64, shuffle=False, sampler=None, dataset=None):
+        self.images = images
+        self.targets = targets
+        self.augments = augments
+        self.spe_pair = spe_pair
+        self.batch_size = bs
+        self.shuffle = shuffle
+        self.sampler = sampler
+        self.dataset = dataset if dataset is not None else images
+        self.pin_memory = False # batches are built where the images are
+
+    @classmethod
+    def from_dataset(cls, ds, name, bs=64, shuffle=False, sampler=None, device='cpu'):
+        '''
+        Load ds in memory on device. Returns None if its transform has no batched version.
+        '''
+        owner, attr = _transform_owner(ds)
+        transform = getattr(owner, attr)
+        spe_pair = isinstance(transform, ContrastiveTransformations) and transform.spe_transforms is not None
+        if isinstance(transform, ContrastiveTransformations):
+            pipelines = [transform.base_transforms] * (1 if spe_pair else transform.n_views)
+            if spe_pair: pipelines.append(transform.spe_transforms)
+        else:
+            pipelines = [transform]
+        if not all(isinstance(p, transforms.Compose) for p in pipelines):
+            return None
+
+        # Common deterministic prefix applied once, with PIL as the regular pipeline
+        prefix = _deterministic_prefix(pipelines[0].transforms)
+        if any(repr(_deterministic_prefix(p.transforms)[:len(prefix)]) != repr(prefix) for p in pipelines):
+            prefix = []
+        try:
+            augments = [BatchAugment(transforms.Compose(p.transforms[len(prefix):])) for p in pipelines]
+        except ValueError:
+            return None
+
+        if isinstance(ds, CIFAR10) and not prefix: # already decoded
+            images, targets = torch.from_numpy(ds.data).permute(0, 3, 1, 2), [np.asarray(ds.targets)]
+        else:
+            batches = list(uint8_batches(ds, name, prefix))
+            images = torch.from_numpy(np.concatenate([imgs for imgs, _ in batches]))
+            targets = [np.concatenate(t) for t in zip(*[t for _, t in batches])]
+        images = images.contiguous().to(device)
+        targets = [torch.from_numpy(t).to(device) if t.dtype.kind in 'biuf' else t for t in targets]
+
+        return cls(images, targets, augments, spe_pair=spe_pair, bs=bs, shuffle=shuffle, sampler=sampler, dataset=ds)
+
+    def __len__(self):
+        return (len(self.sampler if self.sampler is not None else self.images) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.sampler is not None:
+            order = torch.as_tensor(list(self.sampler), dtype=torch.long)
+        elif self.shuffle:
+            order = torch.randperm(len(self.images))
+        else:
+            order = torch.arange(len(self.images))
+
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size].to(self.images.device)
+            x = self.images[idx].float().div(255)
+            views = [augment(x) for augment in self.augments]
+            targets = [t[idx] if torch.is_tensor(t) else list(t[idx.cpu().numpy()]) for t in self.targets]
+            imgs = views if len(views) > 1 else views[0]
+            yield [imgs] + targets if targets else imgs
+
+def memory_loader(ds, dataset, stage='pre', bs=64, shuffle=False, sampler=None, num_workers=None, autotune=False, 
+                  in_memory=False, device='cpu', persistent=False):
+    '''
+    InMemoryLoader of ds on device if in_memory and its transform has a batched version, make_loader otherwise.
+    '''
+    if in_memory:
+        loader = InMemoryLoader.from_dataset(ds, dataset, bs=bs, shuffle=shuffle, sampler=sampler, device=device)
+        if loader is not None:
+            return loader
+    return make_loader(ds, dataset, stage, bs=bs, shuffle=shuffle, sampler=sampler, num_workers=num_workers, autotune=autotune, persistent=persistent)
+
 def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views=1, 
               spe_pair=False, aug=False,                                                                      # simclr
-              pre_type='supervised', noise_path=None, fractal_path=None, resize_image=False, shuffle_noise=True, random_seed=42, # counterfact & noise & fractal
+              pre_type='supervised', noise_path=None, fractal_path=None, resize_image=False, shuffle_noise=True, random_seed=42, # counterfact & noise & fractal (& ImageNetO split)
               jigsaw_ps=None, # mix patches
-              bilateral=False, # replace gauss blur by bilateral filtering
-              num_workers=4):
-    # TODO: pin_memory = True
+              bilateral=False, # replace gauss blur by bilateral filtering ('tensor': filter tensors instead of cv2 on PIL images)
+              num_workers=None, autotune=False, # loader settings, see loader_config
+              num_replicas=1, rank=0, # data-parallel sharding of the noise/fractal/counterfactual samplers
+              decode_size=None, # ImageNet/tiny: decode images at reduced size, see open_image
+              tensor_store=False, # CIFAR10/ImageNet/tiny/ImageNetO: read deterministic test splits from a TensorStore
+              in_memory=False, memory_device='cpu', # CIFAR10/ImageNetO: hold the splits in memory, see InMemoryLoader
+              transform_cache=0): # spe_pair: images whose deterministic views are cached, see ContrastiveTransformations (worth it for large images if the split fits)
     cifar_norm = [(0.4914, 0.4822, 0.4465), (0.2471, 0.2435, 0.2616)]
     ImageNet_norm = [(0.485, 0.456, 0.406), (0.229, 0.224, 0.225)]
     transform_array = []
@@ -1139,7 +1902,7 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
                 transform = ContrastiveTransformations(transforms.Compose([transforms.ToTensor(),
                                                                            transforms.Normalize(mean=cifar_norm[0],
                                                                                                 std=cifar_norm[1])]),
-                                                       spe_transforms=transforms.Compose(spe_transform_array))
+                                                       spe_transforms=transforms.Compose(spe_transform_array), cache_size=transform_cache)
             else: # custom aug for any nb of views
                 transform_array = simclr_aug(32, args_simclr, norm=cifar_norm)
                 transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views)
@@ -1150,19 +1913,28 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
         # for bigger test set, set train=True
         if stage=='down' and not finetune:
             ds_test = CIFAR10(root='./data', train=False, download=True, transform=transform)
-            test_loader = DataLoader(ds_test, batch_size=bs, shuffle=False, num_workers=num_workers)
+            if in_memory:
+                test_loader = memory_loader(ds_test, 'CIFAR10', stage, bs=bs, num_workers=num_workers, autotune=autotune, in_memory=True, device=memory_device)
+            else:
+                test_loader = eval_loader(ds_test, 'CIFAR10', stage, bs=bs, num_workers=num_workers, autotune=autotune, tensor_store=tensor_store)
 
             return None, test_loader
 
         else:
             ds_train = CIFAR10(root='./data', train=True, download=True, transform=transform)
             ds_test = CIFAR10(root='./data', train=False, download=True, transform=transform)
-            train_loader = DataLoader(ds_train, batch_size=bs, shuffle=True, num_workers=num_workers)
-            test_loader = DataLoader(ds_test, batch_size=bs, shuffle=False, num_workers=num_workers)
+            train_loader = memory_loader(ds_train, 'CIFAR10', 'pre', bs=bs, shuffle=True, num_workers=num_workers, autotune=autotune, 
+                                         in_memory=in_memory, device=memory_device, persistent=True)
+            if in_memory:
+                test_loader = memory_loader(ds_test, 'CIFAR10', stage, bs=bs, num_workers=num_workers, autotune=autotune, in_memory=True, device=memory_device)
+            else:
+                test_loader = eval_loader(ds_test, 'CIFAR10', stage, bs=bs, num_workers=num_workers, autotune=autotune, tensor_store=tensor_store)
 
             return train_loader, test_loader
     
     elif dataset=='ImageNet': # TODO: load test manually
+        # Decode images at reduced size if decode_size is given, it should not exceed the first resize of the transforms (256)
+        image_loader = partial(open_image, decode_size=decode_size, mode='RGB')
         transform_array += [
             transforms.Resize(256),
             transforms.CenterCrop(224),
@@ -1192,23 +1964,23 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
             elif spe_pair: # test embed distance for specific pair of normal/augmented combinaiton
                 spe_transform_array = simclr_aug(224, args_simclr, norm=ImageNet_norm)
                 transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views, 
-                                                       spe_transforms=transforms.Compose(spe_transform_array))
+                                                       spe_transforms=transforms.Compose(spe_transform_array), cache_size=transform_cache)
             else: # custom set of augmentations
                 transform_array = simclr_aug(224, args_simclr, norm=ImageNet_norm)
                 transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views)
         
         # On downstream without finetuning, no need to load train and test sets separately, for more exhaustive test set, set train=True
         if stage=='down' and not finetune:
-            ds_test = ImageNet(root='./data', split='val', transform=transform)
-            test_loader = DataLoader(ds_test, batch_size=bs, shuffle=False, num_workers=num_workers)
+            ds_test = ImageNet(root='./data', split='val', transform=transform, loader=image_loader)
+            test_loader = eval_loader(ds_test, 'ImageNet', stage, bs=bs, num_workers=num_workers, autotune=autotune, tensor_store=tensor_store)
 
             return None, test_loader
         
         else:
-            ds_train = ImageNet(root='./data', split='train', transform=transform)
-            ds_test = ImageNet(root='./data', split='val', transform=transform)
-            train_loader = DataLoader(ds_train, batch_size=bs, shuffle=True, num_workers=num_workers)
-            test_loader = DataLoader(ds_test, batch_size=bs, shuffle=False, num_workers=num_workers)
+            ds_train = ImageNet(root='./data', split='train', transform=transform, loader=image_loader)
+            ds_test = ImageNet(root='./data', split='val', transform=transform, loader=image_loader)
+            train_loader = make_loader(ds_train, 'ImageNet', 'pre', bs=bs, shuffle=True, num_workers=num_workers, autotune=autotune, persistent=True)
+            test_loader = eval_loader(ds_test, 'ImageNet', stage, bs=bs, num_workers=num_workers, autotune=autotune, tensor_store=tensor_store)
 
             return train_loader, test_loader
 
@@ -1238,23 +2010,23 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
             elif spe_pair: # test embed distance for specific pair of normal/augmented combinaiton
                 spe_transform_array = simclr_aug(64, args_simclr, norm=ImageNet_norm)
                 transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views, 
-                                                       spe_transforms=transforms.Compose(spe_transform_array))
+                                                       spe_transforms=transforms.Compose(spe_transform_array), cache_size=transform_cache)
             else: # custom set of augmentations
                 transform_array = simclr_aug(64, args_simclr, norm=ImageNet_norm)
                 transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views)
 
         # On downstream without finetuning, no need to load train and test sets separately, for more exhaustive test set, set train=True
         if stage=='down' and not finetune:
-            ds_test = TinyImageNetDataset(stage='val', transform=transform)
-            test_loader = DataLoader(ds_test, batch_size=bs, shuffle=False, num_workers=num_workers, pin_memory=True)
+            ds_test = TinyImageNetDataset(stage='val', transform=transform, decode_size=decode_size)
+            test_loader = eval_loader(ds_test, 'tiny', stage, bs=bs, num_workers=num_workers, autotune=autotune, tensor_store=tensor_store)
 
             return None, test_loader
         
         else:
-            ds_train = TinyImageNetDataset(stage='train', transform=transform)
-            ds_test = TinyImageNetDataset(stage='val', transform=transform)
-            train_loader = DataLoader(ds_train, batch_size=bs, shuffle=True, num_workers=num_workers, pin_memory=True)
-            test_loader = DataLoader(ds_test, batch_size=bs, shuffle=False, num_workers=num_workers, pin_memory=True)
+            ds_train = TinyImageNetDataset(stage='train', transform=transform, decode_size=decode_size)
+            ds_test = TinyImageNetDataset(stage='val', transform=transform, decode_size=decode_size)
+            train_loader = make_loader(ds_train, 'tiny', 'pre', bs=bs, shuffle=True, num_workers=num_workers, autotune=autotune, persistent=True)
+            test_loader = eval_loader(ds_test, 'tiny', stage, bs=bs, num_workers=num_workers, autotune=autotune, tensor_store=tensor_store)
 
             return train_loader, test_loader
     
@@ -1277,7 +2049,7 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
                 split="train",
                 download=True,
                 transform=ContrastiveTransformations(contrast_transforms, n_views=2))
-            test_loader = DataLoader(labeled_data_contrast, batch_size=bs, shuffle=False, num_workers=num_workers)
+            test_loader = make_loader(labeled_data_contrast, 'STL10', stage, bs=bs, num_workers=num_workers, autotune=autotune)
 
             return None, test_loader
 
@@ -1292,8 +2064,8 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
                 split="train",
                 download=True,
                 transform=ContrastiveTransformations(contrast_transforms, n_views=2))
-            train_loader = DataLoader(unlabeled_data, batch_size=bs, shuffle=True, num_workers=num_workers)
-            test_loader = DataLoader(labeled_data_contrast, batch_size=bs, shuffle=False, num_workers=num_workers)
+            train_loader = make_loader(unlabeled_data, 'STL10', 'pre', bs=bs, shuffle=True, num_workers=num_workers, autotune=autotune, persistent=True)
+            test_loader = make_loader(labeled_data_contrast, 'STL10', stage, bs=bs, num_workers=num_workers, autotune=autotune)
 
             return train_loader, test_loader
     
@@ -1308,9 +2080,9 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
         ds_train = Cityscapes(root='./data/cityscapes', split='train', mode='fine', target_type='semantic', download=True, transform=transform)
         ds_val = Cityscapes(root='./data/cityscapes', split='val', mode='fine', target_type='semantic', download=True, transform=transform)
         ds_test = Cityscapes(root='./data/cityscapes', split='test', mode='fine', target_type='semantic', download=True, transform=transform)
-        train_loader = DataLoader(ds_train, batch_size=bs, shuffle=True, num_workers=num_workers)
-        val_loader = DataLoader(ds_val, batch_size=bs, shuffle=False, num_workers=num_workers)
-        test_loader = DataLoader(ds_test, batch_size=bs, shuffle=False, num_workers=num_workers)
+        train_loader = make_loader(ds_train, 'cityscapes', 'pre', bs=bs, shuffle=True, num_workers=num_workers, autotune=autotune, persistent=True)
+        val_loader = make_loader(ds_val, 'cityscapes', stage, bs=bs, num_workers=num_workers, autotune=autotune)
+        test_loader = make_loader(ds_test, 'cityscapes', stage, bs=bs, num_workers=num_workers, autotune=autotune)
 
         return train_loader, val_loader, test_loader
 
@@ -1347,7 +2119,7 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
             elif spe_pair: # test embed distance for specific pair of normal/augmented combinaiton
                 spe_transform_array = simclr_aug(64, args_simclr, norm=ImageNet_norm)
                 transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views, 
-                                                       spe_transforms=transforms.Compose(spe_transform_array))
+                                                       spe_transforms=transforms.Compose(spe_transform_array), cache_size=transform_cache)
             else: # custom set of augmentations
                 transform_array = simclr_aug(64, args_simclr, norm=ImageNet_norm)
                 transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views)
@@ -1360,10 +2132,14 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
         val_size = dataset_size - train_size
 
         # Split the dataset into training and validation sets
-        train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
+        train_dataset, val_dataset = random_split(dataset, [train_size, val_size], generator=torch.Generator().manual_seed(random_seed))
 
-        train_loader = DataLoader(train_dataset, batch_size=bs, shuffle=True, num_workers=num_workers, pin_memory=True)
-        test_loader = DataLoader(val_dataset, batch_size=bs, shuffle=False, num_workers=num_workers, pin_memory=True)
+        train_loader = memory_loader(train_dataset, 'ImageNetO', 'pre', bs=bs, shuffle=True, num_workers=num_workers, autotune=autotune, 
+                                     in_memory=in_memory, device=memory_device, persistent=True)
+        if in_memory:
+            test_loader = memory_loader(val_dataset, 'ImageNetO', stage, bs=bs, num_workers=num_workers, autotune=autotune, in_memory=True, device=memory_device)
+        else:
+            test_loader = eval_loader(val_dataset, 'ImageNetO', stage, bs=bs, num_workers=num_workers, autotune=autotune, tensor_store=tensor_store)
 
         return train_loader, test_loader
     
@@ -1393,14 +2169,13 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
         test_size = 0.1
         split = int(np.floor(test_size * dataset_size))
         if shuffle_noise :
-            np.random.seed(random_seed)
-            np.random.shuffle(indices)
+            np.random.RandomState(random_seed).shuffle(indices) # same split as seeding the global state, without touching it
         train_indices, val_indices = indices[split:], indices[:split]
 
-        train_loader = DataLoader(dataset, batch_size=bs, num_workers=num_workers,
-                                  shuffle=False, pin_memory=True, sampler=SubsetRandomSampler(train_indices))
-        test_loader = DataLoader(dataset, batch_size=bs, num_workers=num_workers,
-                                 pin_memory=True, sampler=SubsetRandomSampler(val_indices))
+        train_loader = make_loader(dataset, 'counterfactual', 'pre', bs=bs, num_workers=num_workers, autotune=autotune,
+                                   sampler=ResumableSampler(train_indices, seed=random_seed, num_replicas=num_replicas, rank=rank), persistent=True)
+        test_loader = make_loader(dataset, 'counterfactual', stage, bs=bs, num_workers=num_workers, autotune=autotune,
+                                  sampler=ResumableSampler(val_indices, seed=random_seed, num_replicas=num_replicas, rank=rank))
         
         return train_loader, test_loader
 
@@ -1423,7 +2198,11 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
 
         transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views)
         # dataset = datasets.ImageFolder('./data/noise', transform=transform)
-        dataset = Dataset_no_label(noise_path, transforms=transform)
+        if isinstance(noise_path, torch.utils.data.Dataset): # generated on the fly, e.g. procedural.ProceduralNoiseDataset
+            noise_path.transforms = transform
+            dataset = noise_path
+        else:
+            dataset = Dataset_no_label(noise_path, transforms=transform)
 
         # Split training and validation splits:
         dataset_size = len(dataset)
@@ -1431,19 +2210,18 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
         test_size = 0.1
         split = int(np.floor(test_size * dataset_size))
         if shuffle_noise:
-            np.random.seed(random_seed)
-            np.random.shuffle(indices)
-            if noise_path == 'shaders21k_stylegan':
-                indices = indices[:105000]
-                split = int(np.floor(test_size * len(indices)))
-                
+            np.random.RandomState(random_seed).shuffle(indices) # same split as seeding the global state, without touching it
         train_indices, val_indices = indices[split:], indices[:split]
 
 
-        train_loader = DataLoader(dataset, batch_size=bs, num_workers=num_workers,
-                                                   shuffle=False, pin_memory=True, sampler=SubsetRandomSampler(train_indices))
-        test_loader = DataLoader(dataset, batch_size=bs, num_workers=num_workers,
-                                                  pin_memory=True, sampler=SubsetRandomSampler(val_indices))
+        train_loader = make_loader(dataset, 'noise', 'pre', bs=bs, num_workers=num_workers, autotune=autotune,
+                                   sampler=ResumableSampler(train_indices, seed=random_seed, num_replicas=num_replicas, rank=rank), persistent=True)
+        if hasattr(dataset, 'fixed_copy'): # images drawn anew every epoch (set_epoch), but a fixed validation split
+            test_dataset = dataset.fixed_copy()
+        else:
+            test_dataset = dataset
+        test_loader = make_loader(test_dataset, 'noise', stage, bs=bs, num_workers=num_workers, autotune=autotune,
+                                  sampler=ResumableSampler(val_indices, seed=random_seed, num_replicas=num_replicas, rank=rank))
         
         return train_loader, test_loader
     
@@ -1459,7 +2237,13 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
             transforms.ToTensor(),] #TODO: Normalize?
 
         transform = ContrastiveTransformations(transforms.Compose(transform_array), n_views=n_views)
-        dataset = Dataset_no_label(fractal_path, transforms=transform)
+        if isinstance(fractal_path, torch.utils.data.Dataset): # rendered from IFS parameters, e.g. procedural.FractalDataset
+            fractal_path.transforms = transform
+            if getattr(fractal_path, 'cache', False) is None: # all images rendered once by batches (on cuda if available), not one by one in the workers
+                fractal_path.prerender(device='cuda' if torch.cuda.is_available() else 'cpu')
+            dataset = fractal_path
+        else:
+            dataset = Dataset_no_label(fractal_path, transforms=transform)
 
         # Split training and validation splits:
         dataset_size = len(dataset)
@@ -1467,32 +2251,100 @@ def load_data(dataset, *args_simclr, bs=64, stage='pre', finetune=False, n_views
         test_size = 0.1
         split = int(np.floor(test_size * dataset_size))
         if shuffle_noise :
-            np.random.seed(random_seed)
-            np.random.shuffle(indices)
+            np.random.RandomState(random_seed).shuffle(indices) # same split as seeding the global state, without touching it
         train_indices, val_indices = indices[split:], indices[:split]
 
 
-        train_loader = DataLoader(dataset, batch_size=bs, num_workers=num_workers,
-                                                   shuffle=False, pin_memory=True, sampler=SubsetRandomSampler(train_indices))
-        test_loader = DataLoader(dataset, batch_size=bs, num_workers=num_workers,
-                                                  pin_memory=True, sampler=SubsetRandomSampler(val_indices))
+        train_loader = make_loader(dataset, 'fractal', 'pre', bs=bs, num_workers=num_workers, autotune=autotune,
+                                   sampler=ResumableSampler(train_indices, seed=random_seed, num_replicas=num_replicas, rank=rank), persistent=True)
+        test_loader = make_loader(dataset, 'fractal', stage, bs=bs, num_workers=num_workers, autotune=autotune,
+                                  sampler=ResumableSampler(val_indices, seed=random_seed, num_replicas=num_replicas, rank=rank))
         
         return train_loader, test_loader
 
+REDUCED_ROOT = os.path.join("data", "reduced")
+
+def open_image(path, decode_size=None, mode=None):
+    '''
+    Open an image decoded at reduced size, for images resized to decode_size (shorter side) right after loading.
+    JPEGs are decoded with PIL's draft mode, at the smallest DCT scale (1/2, 1/4, 1/8) still at least decode_size.
+    Other formats are read from a copy resized to decode_size as Resize(decode_size) does, written once (again
+    if the image is modified later) under REDUCED_ROOT/<decode_size>/<absolute path>, so the transform's Resize
+    gives the same image as from the original.
+    mode: convert to this mode (e.g. 'RGB'), decode_size=None: open the image as is.
+    '''
+    if decode_size is not None and not path.lower().endswith(('.jpg', '.jpeg')):
+        # Mirror of the absolute path, so relative paths with .. can not write outside the reduced root
+        reduced_root = os.path.abspath(os.path.join(REDUCED_ROOT, str(decode_size)))
+        reduced_path = os.path.join(reduced_root, os.path.splitdrive(os.path.abspath(path))[1].lstrip(os.sep))
+        assert os.path.commonpath([reduced_root, reduced_path]) == reduced_root, 'Reduced copy of {} outside {}'.format(path, reduced_root)
+        if not os.path.exists(reduced_path) or os.path.getmtime(reduced_path) < os.path.getmtime(path): # missing or stale
+            img = Image.open(path)
+            if min(img.size) <= decode_size: # nothing to gain
+                return img.convert(mode) if mode is not None else img
+            os.makedirs(os.path.dirname(reduced_path), exist_ok=True)
+            tmp_path = reduced_path + '.{}.tmp'.format(os.getpid()) # loader workers may write the same copy
+            transforms.functional.resize(img, decode_size).save(tmp_path, format=img.format)
+            os.replace(tmp_path, reduced_path)
+        path = reduced_path
+
+    img = Image.open(path)
+    if decode_size is not None and img.format == 'JPEG':
+        img.draft('RGB', (decode_size, decode_size))
+    return img.convert(mode) if mode is not None else img
+
 class MyDataset(torch.utils.data.Dataset):
-    def __init__(self, img_list, transforms):
+    def __init__(self, img_list, transforms, decode_size=None):
         super(MyDataset, self).__init__()
         self.img_list = img_list
         self.transforms = transforms
+        self.decode_size = decode_size # reduced size decoding, see open_image
 
     def __len__(self):
         return len(self.img_list)
 
     def __getitem__(self, idx):
         title = self.img_list[idx]
-        img = Image.open(title)
+        img = open_image(title, self.decode_size)
         return self.transforms(img), title
 
+# Label ids of the 16 Geirhos categories (order of Geirhos' list, before sorting)
+GEIRHOS_CATEGORIES = ["knife", "keyboard", "elephant", "bicycle", "airplane", "clock", "oven", "chair", 
+                      "bear", "boat", "cat", "bottle", "truck", "car", "bird", "dog"]
+
+def parse_geirhos_name(path):
+    '''
+    Return the (shape, texture) category names of a Geirhos image, e.g. .../airplane1-bicycle2.png -> (airplane, bicycle).
+    Edge and silhouette images (e.g. .../airplane1.png) only have a shape, returned as texture as well.
+    '''
+    name = os.path.basename(path)
+    if name.endswith('.png'): name = name[:-len('.png')]
+    name_split = name.split("-")
+    shape = remove_int(name_split[0])
+    texture = remove_int(name_split[1]) if len(name_split) > 1 else shape
+    return shape, texture
+
+def geirhos_category_ids(categories):
+    '''
+    Return the GEIRHOS_CATEGORIES ids of a list of category names.
+    '''
+    return np.array([GEIRHOS_CATEGORIES.index(c) for c in categories], dtype=np.int64)
+
+class GeirhosDataset(MyDataset):
+    '''
+    Geirhos probe images, with shape and texture labels parsed once from the filenames.
+    Yields (img, shape_id, texture_id), ids indexing GEIRHOS_CATEGORIES.
+    '''
+    def __init__(self, img_list, transforms, decode_size=None):
+        super(GeirhosDataset, self).__init__(img_list, transforms, decode_size)
+        names = [parse_geirhos_name(title) for title in img_list]
+        self.shapes = geirhos_category_ids([shape for shape, _ in names])
+        self.textures = geirhos_category_ids([texture for _, texture in names])
+
+    def __getitem__(self, idx):
+        img = open_image(self.img_list[idx], self.decode_size)
+        return self.transforms(img), self.shapes[idx], self.textures[idx]
+
 class Dataset_counterfact(torch.utils.data.Dataset):
     def __init__(self, df, transforms, size, pre_type):
         self.df = df
@@ -1541,7 +2393,7 @@ def tiny_class_to_int():
 
 class TinyImageNetDataset(torch.utils.data.Dataset):
     # Adapted from from https://www.kaggle.com/c/thu-deep-learning/overview/tips
-    def __init__(self, root="./data/tiny-imagenet-200", stage='train', transform=transforms.ToTensor()):
+    def __init__(self, root="./data/tiny-imagenet-200", stage='train', transform=transforms.ToTensor(), decode_size=None):
         # root: your_path/TinyImageNet/
         images = []
         map = tiny_class_to_int()
@@ -1572,13 +2424,14 @@ class TinyImageNetDataset(torch.utils.data.Dataset):
         self.root = root
         self.images = images
         self.transform = transform
+        self.decode_size = decode_size # reduced size decoding, see open_image
 
     def __len__(self):
         return len(self.images)
     
     def __getitem__(self, index):
         img_name, label = self.images[index]
-        img = Image.open(os.path.join(self.root, img_name)).convert('RGB')
+        img = open_image(os.path.join(self.root, img_name), self.decode_size, mode='RGB')
 
         return self.transform(img), label
 
@@ -1610,38 +2463,102 @@ def load_noise_brute():
 
     return paths
 
-def load_noise(*args):
-    if not args:
-        noise_list = [
-        'dead_leaves-squares',
-        'dead_leaves-oriented',
-        'dead_leaves-mixed',
-        'dead_leaves-textures',
+NOISE_ROOT = os.path.join("data", "noise")
+NOISE_FAMILIES = [
+    'dead_leaves-squares',
+    'dead_leaves-oriented',
+    'dead_leaves-mixed',
+    'dead_leaves-textures',
 
-        'stat-spectrum',
-        'stat-wmm',
-        'stat-spectrum_color',
-        'stat-spectrum_color_wmm',
+    'stat-spectrum',
+    'stat-wmm',
+    'stat-spectrum_color',
+    'stat-spectrum_color_wmm',
 
-        'stylegan-random',
-        'stylegan-highfreq',
-        'stylegan-sparse',
-        'stylegan-oriented',
-        'shaders21k_stylegan',
+    'stylegan-random',
+    'stylegan-highfreq',
+    'stylegan-sparse',
+    'stylegan-oriented',
+    'shaders21k_stylegan',
 
-        'feature_vis-random',
-        'feature_vis-dead_leaves']
+    'feature_vis-random',
+    'feature_vis-dead_leaves']
+
+# Images drawn from a family when no size is given, to keep families the same size as the 105 x 1000 ones
+NOISE_FAMILY_CAPS = {'shaders21k_stylegan': 105000}
+
+@lru_cache(maxsize=None)
+def noise_manifest(family, root=NOISE_ROOT, rebuild=False):
+    '''
+    Manifest of a noise family: its numbered subfolders, the sorted image names of all subfolders
+    as one numpy string array, and the offset of each subfolder in it.
+    Built by listing the family once, then cached in <root>/<family>/manifest.npz, and rebuilt
+    when subfolders are added or removed or their mtimes change (images added or removed).
+    '''
+    manifest_path = os.path.join(root, family, "manifest.npz")
+    subfolders = sorted(f for f in os.listdir(os.path.join(root, family)) if f.isdigit())
+    mtimes = np.array([os.stat(os.path.join(root, family, subfolder)).st_mtime_ns for subfolder in subfolders], dtype=np.int64)
+    if os.path.exists(manifest_path) and not rebuild:
+        manifest = np.load(manifest_path)
+        manifest = {key: manifest[key] for key in manifest.files}
+        if 'mtimes' in manifest and list(manifest['subfolders']) == subfolders and np.array_equal(manifest['mtimes'], mtimes):
+            return manifest
+
+    names, offsets = [], [0]
+    for subfolder in subfolders:
+        names += sorted(os.listdir(os.path.join(root, family, subfolder)))
+        offsets.append(len(names))
+
+    manifest = {'subfolders': np.array(subfolders), 'names': np.array(names), 'offsets': np.array(offsets, dtype=np.int64), 'mtimes': mtimes}
+    np.savez(manifest_path, **manifest)
+    return manifest
+
+def sample_noise_family(family, size=None, seed=42, root=NOISE_ROOT):
+    '''
+    Paths of size images of a family (all of them if None), drawn from its manifest.
+    The draw is the first size images of a permutation fixed by (seed, family), 
+    so a smaller sample is always included in a larger one.
+    '''
+    manifest = noise_manifest(family, root)
+    nb_images = len(manifest['names'])
+    if size is None:
+        size = min(NOISE_FAMILY_CAPS.get(family, nb_images), nb_images) # partially downloaded families
+    assert size <= nb_images, 'Cannot draw {} images from {}, it has {}'.format(size, family, nb_images)
+
+    if size == nb_images:
+        picked = np.arange(nb_images)
+    else:
+        picked = np.random.default_rng([seed, zlib.crc32(family.encode())]).permutation(nb_images)[:size]
+    subfolder_idx = np.searchsorted(manifest['offsets'], picked, side='right') - 1
+
+    return [os.path.join(root, family, manifest['subfolders'][s], manifest['names'][i]) for s, i in zip(subfolder_idx, picked)]
+
+def load_noise(*args, size=None, proportions=None, seed=42):
+    '''
+    Paths of noise images from the families in args (all families if none given).
+    size: total number of images, split evenly between families (all images, up to NOISE_FAMILY_CAPS, if None)
+    proportions: dict of family: weight, to split size between families unevenly (families default to its keys)
+    '''
+    if proportions is not None:
+        noise_list = list(args) if args else list(proportions)
+        weights = np.array([proportions.get(family, 0) for family in noise_list], dtype=np.float64)
+    else:
+        noise_list = list(args) if args else NOISE_FAMILIES
+        weights = np.ones(len(noise_list))
+
+    if size is None:
+        assert proportions is None, 'Provide the total number of images to split with proportions'
+        family_sizes = [None] * len(noise_list)
     else:
-        noise_list = []
-        for i in args:
-            noise_list.append(i)
+        # Largest remainder rounding, so sizes sum to size
+        exact = size * weights / weights.sum()
+        family_sizes = np.floor(exact).astype(np.int64)
+        family_sizes[np.argsort(family_sizes - exact)[:size - family_sizes.sum()]] += 1
 
     paths = []
-    for folder in noise_list:
-        for subfolder in os.listdir(os.path.join("data", "noise", folder)):
-            if not subfolder.isdigit(): continue
-            for image in os.listdir(os.path.join("data", "noise", folder, subfolder)):
-                paths.append(os.path.join("data", "noise", folder, subfolder, image))
+    for family, family_size in zip(noise_list, family_sizes):
+        if family_size == 0: continue
+        paths += sample_noise_family(family, None if family_size is None else int(family_size), seed=seed)
 
     return paths
 
@@ -1665,11 +2582,7 @@ def load_geirhos_transfer_pre(conflict_only=False):
             
             # disregard images where shape and texture are identical
             if conflict_only:
-                name_split  = img.split("-")
-                shape = name_split[0]
-                texture = name_split[1]
-                shape = shape[:-2] if shape[-2].isdigit() else shape[:-1]
-                texture = texture[:-6] if texture[-6].isdigit() else texture[:-5]
+                shape, texture = parse_geirhos_name(img)
 
                 if shape == texture:
                     continue
@@ -1750,5 +2663,42 @@ class BilateralFilterTransform(object):
         
         return filtered_img
 
+def batch_bilateral(x, d=9, sigma_color=125, sigma_space=125):
+    '''
+    Bilateral filter of a float (B, C, H, W) or (C, H, W) tensor in [0, 1], on its device, as cv2.bilateralFilter on uint8 images:
+    disk of diameter d, color distance as the sum over channels of the absolute differences in 0-255 units, reflect-101 borders.
+    The neighborhood is visited one offset at a time over the whole batch, so memory stays O(B*C*H*W).
+    '''
+    unbatched = x.dim() == 3
+    if unbatched: x = x.unsqueeze(0)
+    H, W = x.shape[-2:]
+    r = d // 2
+    padded = F.pad(x, (r, r, r, r), mode='reflect')
+    num, den = torch.zeros_like(x), torch.zeros_like(x[:, :1])
+    color_coeff = -255 ** 2 / (2 * sigma_color ** 2)
+    for dy in range(-r, r + 1):
+        for dx in range(-r, r + 1):
+            if dy * dy + dx * dx > r * r: continue
+            shifted = padded[..., r + dy:r + dy + H, r + dx:r + dx + W]
+            # In place: exp(color_coeff * dist^2 - r^2 / (2 sigma_space^2))
+            w = (shifted - x).abs_().sum(dim=1, keepdim=True)
+            w = w.mul_(w).mul_(color_coeff).sub_((dy * dy + dx * dx) / (2 * sigma_space ** 2)).exp_()
+            num.addcmul_(w, shifted)
+            den += w
+    out = num.div_(den)
+    return out[0] if unbatched else out
+
+class BilateralFilterTensor(object):
+    '''
+    Drop-in for BilateralFilterTransform on tensors (after ToTensor) or whole batches, see batch_bilateral.
+    '''
+    def __init__(self, d, sigma_color, sigma_space):
+        self.d = d
+        self.sigma_color = sigma_color
+        self.sigma_space = sigma_space
+
+    def __call__(self, x):
+        return batch_bilateral(x, self.d, self.sigma_color, self.sigma_space)
+
 if __name__ == '__main__':
     pass
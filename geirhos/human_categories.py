@@ -9,25 +9,84 @@ experiments.
 
 import numpy as np
 import os
+from functools import lru_cache
 
 import geirhos.wordnet_functions as wf
 
+CATEGORY_TABLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "category_tables.npz")
+CATEGORIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "categories.txt")
 
-def compute_imagenet_indices_for_category(category):
+
+def compute_imagenet_indices_for_category(category, tables_path=CATEGORY_TABLES_PATH):
     """Return list of ImageNet indices that correspond to category.
 
     'category' is part of the 16 classes.
     """
     assert category in get_human_object_recognition_categories()
 
-    categories = HumanCategories()
+    tables = load_category_tables(tables_path)
+    c = get_human_object_recognition_categories().index(category)
+
+    return tables["category_indices"][c]
+
+
+def build_category_tables(categories_file=CATEGORIES_FILE, save_path=CATEGORY_TABLES_PATH):
+    """Parse categories.txt once and save the lookup arrays to save_path.
+
+    Saved arrays:
+    - WNIDs: WNID of each of the 1000 ImageNet indices
+    - index_categories: human category id of each index (-1 if none)
+    - category_WNIDs, WNID_categories: every WNID of HumanCategories and its category id
+    - indices, offsets: ImageNet indices of category c are indices[offsets[c]:offsets[c+1]]
+
+    Category ids follow the order of get_human_object_recognition_categories().
+    """
+
+    categories = get_human_object_recognition_categories()
+    c = HumanCategories()
+
+    category_WNIDs, WNID_categories = [], []
+    for i, category in enumerate(categories):
+        category_WNIDs += getattr(c, category)
+        WNID_categories += [i] * len(getattr(c, category))
+    WNID_to_category = dict(zip(category_WNIDs, WNID_categories))
+
+    WNIDs = np.array(wf.read_categories_file(categories_file)[0])
+    index_categories = np.array([WNID_to_category.get(WNID, -1) for WNID in WNIDs], dtype=np.int64)
 
-    indices = []
-    for i in range(0, 1000):
-        WNID = wf.get_WNID_from_index(i)
-        if categories.get_human_category_from_WNID(WNID) == category:
-            indices.append(i)
-    return indices
+    # category -> indices, stored flat with offsets
+    indices = np.argsort(index_categories, kind="stable")
+    indices = indices[index_categories[indices] >= 0]
+    offsets = np.searchsorted(index_categories[indices], np.arange(len(categories) + 1))
+
+    np.savez(save_path, WNIDs=WNIDs, index_categories=index_categories,
+             category_WNIDs=np.array(category_WNIDs), WNID_categories=np.array(WNID_categories),
+             indices=indices, offsets=offsets)
+
+
+@lru_cache(maxsize=None)
+def load_category_tables(tables_path=CATEGORY_TABLES_PATH, categories_file=CATEGORIES_FILE):
+    """Return the lookup tables saved by build_category_tables, building them first if needed.
+
+    Returns a dict with the saved arrays, plus:
+    - category_indices: list of the ImageNet indices of each category
+    - WNID_to_category: dict WNID -> category name
+    """
+
+    if not os.path.exists(tables_path):
+        build_category_tables(categories_file, tables_path)
+
+    with np.load(tables_path) as f:
+        tables = {k: f[k] for k in f.files}
+
+    categories = get_human_object_recognition_categories()
+    offsets = tables["offsets"]
+    tables["category_indices"] = [tables["indices"][offsets[i]:offsets[i+1]].tolist()
+                                  for i in range(len(categories))]
+    tables["WNID_to_category"] = {WNID: categories[i] for WNID, i in
+                                  zip(tables["category_WNIDs"].tolist(), tables["WNID_categories"].tolist())}
+
+    return tables
 
 
 def get_human_object_recognition_categories():
@@ -174,6 +233,9 @@ class HumanCategories(object):
     oven_indices = [766]
     truck_indices = [555, 569, 656, 675, 717, 734, 864, 867]
 
+    # WNID -> category dict, built on first lookup
+    _WNID_to_category = None
+
     # Custom added CIFAR10 indices, because of 10->7 compression, indices: 5->4, 8->5, 9->6
     CIFAR10_airplane_indices = [0]
     CIFAR10_car_indices = [1]
@@ -213,13 +275,13 @@ class HumanCategories(object):
 
         """
         
-        categories = get_human_object_recognition_categories()
-        for c in categories:
-            attr = getattr(self, c)
-            if wnid in attr:
-                return c
+        if HumanCategories._WNID_to_category is None:
+            HumanCategories._WNID_to_category = {}
+            for c in reversed(get_human_object_recognition_categories()): # first category wins, as in a linear scan
+                for WNID in getattr(self, c):
+                    HumanCategories._WNID_to_category[WNID] = c
 
-        return None
+        return HumanCategories._WNID_to_category.get(wnid)
 
     def get_imagenet_indices_for_category(self, category):
         """Return ImageNet indices that correspond to an entry-level category.
@@ -235,3 +297,7 @@ class HumanCategories(object):
         return getattr(self, category+"_indices")
 
 
+if __name__ == '__main__':
+    # Build step: python -m geirhos.human_categories
+    build_category_tables()
+    print('Category tables saved to {}'.format(CATEGORY_TABLES_PATH))
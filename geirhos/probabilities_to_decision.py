@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import numpy as np
+import torch
 from abc import ABC, abstractmethod
 
 import geirhos.human_categories as hc
@@ -26,13 +27,89 @@ class ProbabilitiesToDecisionMapping(ABC):
         assert (probabilities >= 0.0).all() and (probabilities <= 1.0).all()
 
 
+    def build_aggregation(self, category_indices, nb_outputs):
+        """Precompute the (nb_outputs, 16) matrix averaging the outputs of each category.
+
+        Keyword arguments:
+        category_indices -- list of 16 lists of output indices (or None
+                            if the category has no output), ordered as
+                            get_human_object_recognition_categories()
+        nb_outputs -- number of outputs of the classifier
+        """
+
+        self.categories = hc.get_human_object_recognition_categories()
+        self.category_indices = category_indices
+        self.nb_outputs = nb_outputs
+
+        weights = np.zeros((nb_outputs, len(self.categories)), dtype=np.float32)
+        missing = np.zeros(len(self.categories), dtype=np.float32)
+        for c, indices in enumerate(category_indices):
+            if indices is None:
+                missing[c] = -np.inf # never picked, as when skipped in the loop
+                continue
+            weights[indices, c] = 1. / len(indices)
+
+        self.weights = torch.from_numpy(weights)
+        self.missing = torch.from_numpy(missing)
+        self._device_weights = {}
+
+
+    def probabilities_to_decisions(self, probabilities):
+        """Return the category decision for each row of a batch of probabilities.
+
+        Decisions are indices into get_human_object_recognition_categories(),
+        returned as a torch.LongTensor on the same device as probabilities.
+
+        Keyword arguments:
+        probabilities -- a torch.Tensor of shape (B, nb_outputs)
+                         (softmax output: all values should be
+                         within [0,1])
+        """
+
+        assert probabilities.dim() == 2 and probabilities.shape[1] == self.nb_outputs
+
+        if self.aggregation_function is not np.mean:
+            # Only the mean reduces to a matmul, fall back to the per-image mapping
+            decisions = [self.categories.index(self.probabilities_to_decision(p))
+                         for p in probabilities.detach().cpu().numpy()]
+            return torch.tensor(decisions, dtype=torch.long, device=probabilities.device)
+
+        device = probabilities.device
+        if device not in self._device_weights:
+            self._device_weights[device] = (self.weights.to(device), self.missing.to(device))
+        weights, missing = self._device_weights[device]
+
+        scores = probabilities.to(weights.dtype) @ weights + missing
+        return scores.argmax(dim=1)
+
+
+    def decisions_to_categories(self, decisions):
+        """Return the category names of decisions given as indices."""
+
+        return [self.categories[d] for d in decisions]
+
+
 class ImageNetProbabilitiesTo16ClassesMapping(ProbabilitiesToDecisionMapping):
     """Return the entry-level category decision for probabilities."""
 
-    def __init__(self, aggregation_function=np.mean):
+    def __init__(self, aggregation_function=np.mean, tables_path=None):
+        """tables_path -- if given (e.g. hc.CATEGORY_TABLES_PATH), take the
+                       category indices from the tables of hc.build_category_tables
+                       instead of the hand-curated HumanCategories indices. The
+                       two need not agree (manual exclusions, WNIDs of several
+                       categories), shape bias results use the curated ones.
+        """
 
         self.aggregation_function = aggregation_function
 
+        if tables_path is not None:
+            category_indices = hc.load_category_tables(tables_path)["category_indices"]
+        else:
+            c = hc.HumanCategories()
+            category_indices = [c.get_imagenet_indices_for_category(category)
+                                for category in hc.get_human_object_recognition_categories()]
+        self.build_aggregation(category_indices, nb_outputs=1000)
+
 
     def probabilities_to_decision(self, probabilities):
         """Return one of 16 categories for vector of probabilities.
@@ -48,17 +125,15 @@ class ImageNetProbabilitiesTo16ClassesMapping(ProbabilitiesToDecisionMapping):
 
         max_value = -float("inf")
         category_decision = None
-        c = hc.HumanCategories()
-        for category in hc.get_human_object_recognition_categories():
-            indices = c.get_imagenet_indices_for_category(category)
+        for category, indices in zip(self.categories, self.category_indices):
             values = np.take(probabilities, indices)
             aggregated_value = self.aggregation_function(values)
             if aggregated_value > max_value:
                 max_value = aggregated_value
                 category_decision = category
-   
+
         return category_decision
-    
+
 class CIFAR10ProbabilitiesTo16ClassesMapping(ProbabilitiesToDecisionMapping):
     """Return the entry-level category decision for probabilities."""
 
@@ -66,6 +141,11 @@ class CIFAR10ProbabilitiesTo16ClassesMapping(ProbabilitiesToDecisionMapping):
 
         self.aggregation_function = aggregation_function
 
+        c = hc.HumanCategories()
+        self.build_aggregation([c.get_cifar10_indices_for_category(category)
+                                for category in hc.get_human_object_recognition_categories()],
+                               nb_outputs=7)
+
 
     def probabilities_to_decision(self, probabilities):
         """Return one of 16 categories for vector of probabilities.
@@ -81,15 +161,14 @@ class CIFAR10ProbabilitiesTo16ClassesMapping(ProbabilitiesToDecisionMapping):
 
         max_value = -float("inf")
         category_decision = None
-        c = hc.HumanCategories()
-        for category in hc.get_human_object_recognition_categories():
-            indices = c.get_cifar10_indices_for_category(category)
-            if indices is None: 
+        for category, indices in zip(self.categories, self.category_indices):
+            if indices is None:
                 continue
             values = np.take(probabilities, indices)
             aggregated_value = self.aggregation_function(values)
             if aggregated_value > max_value:
                 max_value = aggregated_value
                 category_decision = category
-   
+
         return category_decision
+
@@ -1,6 +1,7 @@
 
 import numpy as np
 from shutil import copyfile
+from functools import lru_cache
 import os
 import linecache as lc
 
@@ -59,12 +60,10 @@ def get_hypernyms(categories_file, entity):
     """
 
     hypers = []
-    with open(categories_file) as f:
-        for line in f:
-            category = get_category_from_line(line)
-            cat_synset = wn.synsets(category)[0]
-            if is_hypernym(category, entity):
-                hypers.append(category)
+    for category in read_categories_file(categories_file)[1]:
+        cat_synset = wn.synsets(category)[0]
+        if is_hypernym(category, entity):
+            hypers.append(category)
 
     return hypers
 
@@ -83,16 +82,12 @@ def get_ilsvrc2012_training_WNID(entity):
     results = []
 
     hypernyms = hypernyms_in_ilsvrc2012_categories(entity)
+    synsets = read_synsets_mapping("WNID_synsets_mapping.txt")
     
     for hyper in hypernyms:
-
-        with open("WNID_synsets_mapping.txt") as f:
-            for line in f:
-                category = get_category_from_line(line)
-
-                if category == hyper:
-                    print(line[:9])
-                    results.append(line[:9])
+        for WNID in synsets.get(hyper, []):
+            print(WNID)
+            results.append(WNID)
 
     return results
 
@@ -106,13 +101,33 @@ def num_hypernyms_in_ilsvrc2012(entity):
 def get_ilsvrc2012_categories():
     """Return the first item of each synset of the ilsvrc2012 categories."""
 
+    return list(read_categories_file("categories.txt")[1])
+
+
+@lru_cache(maxsize=None)
+def read_categories_file(categories_file="categories.txt"):
+    """Parse categories.txt once, return the tuples (WNIDs, categories) in index order."""
+
+    WNIDs = []
     categories = []
+    with open(categories_file) as f:
+        for line in f:
+            WNIDs.append(line.split(" ")[0])
+            categories.append(get_category_from_line(line))
+
+    return tuple(WNIDs), tuple(categories)
+
+
+@lru_cache(maxsize=None)
+def read_synsets_mapping(mapping_file="WNID_synsets_mapping.txt"):
+    """Parse WNID_synsets_mapping.txt once, return a dict category -> list of WNIDs."""
 
-    with open("categories.txt") as f:
+    synsets = {}
+    with open(mapping_file) as f:
         for line in f:
-           categories.append(get_category_from_line(line))
+            synsets.setdefault(get_category_from_line(line), []).append(line[:9])
 
-    return categories
+    return synsets
 
 
 def get_category_from_line(line):
@@ -130,6 +145,5 @@ def get_WNID_from_index(index):
 
     file_path = "categories.txt" # change depending on location of categories.txt!
     assert(os.path.exists(file_path)), "path to categories.txt wrong!"
-    line = lc.getline(file_path, index+1)
-    return line.split(" ")[0]
+    return read_categories_file(file_path)[0][index]
 
@@ -4,9 +4,14 @@ import torch
 import cv2
 import numpy as np
 
+from utils import log_metrics
+
+RANKING_METRICS = ["acc_top1", "acc_top5", "acc_mean_pos"]
+
 def info_nce_loss(out, temperature=0.5, 
-                  log=False, logger=None, mode="train"):
+                  metrics=None, mode="train"):
     # adapted from https://lightning.ai/docs/pytorch/stable/notebooks/course_UvA-DL/13-contrastive-learning.html
+    # metrics: utils.MetricsAccumulator summing the ranking metrics of the calls, logged with log_ranking_metrics
 
     # Calculate cosine similarity
     cos_sim = F.cosine_similarity(out[:, None, :], out[None, :, :], dim=-1)
@@ -27,14 +32,24 @@ def info_nce_loss(out, temperature=0.5,
     )
     sim_argsort = comb_sim.argsort(dim=-1, descending=True).argmin(dim=-1)
     
-    # Logging ranking metrics
-    if log:
-        logger.info(mode + "_acc_top1: {}".format((sim_argsort == 0).float().mean()))
-        logger.info(mode + "_acc_top5: {}".format((sim_argsort < 5).float().mean()))
-        logger.info(mode + "_acc_mean_pos: {}".format(1 + sim_argsort.item().float().mean()))
+    # Ranking metrics, summed on device (no sync)
+    if metrics is not None:
+        metrics.add(mode + "_acc_top1", (sim_argsort == 0).float().mean())
+        metrics.add(mode + "_acc_top5", (sim_argsort < 5).float().mean())
+        metrics.add(mode + "_acc_mean_pos", 1 + sim_argsort.float().mean())
+        metrics.add(mode + "_nb_batches", 1)
 
     return nll, (sim_argsort == 0).float().mean()
 
+def log_ranking_metrics(metrics, mode="train"):
+    # Log the averages of the ranking metrics summed by info_nce_loss since the last call, and reset them
+    nb_batches = metrics.get(mode + "_nb_batches")
+    if nb_batches == 0:
+        return
+    log_metrics({mode + "_" + name: metrics.get(mode + "_" + name) / nb_batches for name in RANKING_METRICS})
+    for name in RANKING_METRICS + ["nb_batches"]:
+        metrics.totals.pop(mode + "_" + name, None)
+
 def compute_saliency_map(outputs, model, input_images, embedding=True, normalized=True):
     """
     Compute the saliency map of an input image with respect to model's prediction.
@@ -5,6 +5,9 @@ import pandas as pd
 import numpy as np
 from PIL import Image
 import copy
+import queue
+import threading
+import contextlib
 import os
 import matplotlib.pyplot as plt
 import wandb
@@ -17,33 +20,65 @@ from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
 from torchvision.models.feature_extraction import create_feature_extractor
 from sklearn.neighbors import KNeighborsClassifier as KNN
-from scipy.spatial.distance import pdist
 
 from sot_torchvision_models import resnet18, resnet50
 from sot_modif_resnet import modify_resnet_model
 from models import *
 from vit_models import ViT
 
-from data import load_geirhos_transfer_pre, load_data, MyDataset, load_noise, load_fractal, load_geirhos_edge_silhouette
+from data import load_geirhos_transfer_pre, load_data, memory_loader, DevicePrefetcher, MyDataset, GeirhosDataset, GEIRHOS_CATEGORIES, geirhos_category_ids, load_noise, load_fractal, load_geirhos_edge_silhouette
+from procedural import ProceduralNoiseDataset, FractalDataset, search_ifs_categories, save_ifs_params, FRACTAL_PARAMS_PATH
 from geirhos.probabilities_to_decision import ImageNetProbabilitiesTo16ClassesMapping
-from loss import info_nce_loss, compute_saliency_map, canny_edge_detector, edge2blob, kl_divergence
-from utils import create_logger, visualize, norm_calc, find_overlap, remove_int
+from loss import info_nce_loss, log_ranking_metrics, compute_saliency_map, canny_edge_detector, edge2blob, kl_divergence
+from utils import create_logger, visualize, ResultsStore, SuccessiveHalving, norm_calc, cosine_pdist_sum, MetricsAccumulator, bias_statistics, StageTimer, EvalSchedule, timed, MetricsSink, set_metrics_sink, log_metrics
 
 
+def save_checkpoint(path, model, epoch, loader=None, nb_consumed=None, optimizer=None):
+    """
+    Save the model with the training epoch, the optimizer state and, for loaders with a resumable sampler, the position in the epoch.
+    """
+    checkpoint = {'model': model.state_dict(), 'epoch': epoch}
+    if optimizer is not None:
+        checkpoint['optimizer'] = optimizer.state_dict()
+    sampler = getattr(loader, 'sampler', None)
+    if hasattr(sampler, 'state_dict'):
+        checkpoint['sampler'] = sampler.state_dict(nb_consumed=nb_consumed)
+    torch.save(checkpoint, path)
+
+def load_checkpoint(path, model, loader=None):
+    """
+    Load a checkpoint of save_checkpoint or a plain state_dict. Returns the saved epoch and optimizer state, None if unknown.
+    """
+    checkpoint = torch.load(path)
+    if 'model' not in checkpoint: # plain state_dict
+        model.load_state_dict(checkpoint)
+        return None, None
+    model.load_state_dict(checkpoint['model'])
+    sampler = getattr(loader, 'sampler', None)
+    if 'sampler' in checkpoint and hasattr(sampler, 'load_state_dict'):
+        sampler.load_state_dict(checkpoint['sampler'])
+    return checkpoint['epoch'], checkpoint.get('optimizer')
+
 def pretext_train(epoch, pre_type='supervised',  train_loader=DataLoader, model=nn.Module, pre_lr=0.001, saliency=False, saliency_weight=1,
-                  log_interval=100, save_models=False, save_path=None, verbose=False, log=True, logger=None, device='cuda:0'):
+                  log_interval=100, save_models=False, save_path=None, verbose=False, log=True, logger=None, device='cuda:0',
+                  checkpoint_interval=None, checkpoint_path=None, optimizer_state=None, timer=None):
     """
     Modify loss and optimizer inside function because that's not something we need to modify easily. Not project focus.
+    The Adam optimizer is rebuilt every epoch, its moments are only kept within an epoch.
+    checkpoint_interval: save a resumable checkpoint (model, optimizer, sampler position) to checkpoint_path every checkpoint_interval batches.
+    optimizer_state: optimizer state of a checkpoint saved during this epoch, to resume it.
+    timer: utils.StageTimer recording the data wait of the loop in its current stage.
     """
     if log: logger.info('')
     if pre_type=='supervised':
         criterion = nn.CrossEntropyLoss()
         optimizer = optim.Adam(model.parameters(), lr=pre_lr)
-        train_correct = 0
+        if optimizer_state is not None: optimizer.load_state_dict(optimizer_state)
+        metrics = MetricsAccumulator(device=device)
         
         model.train()
-        for i, data in enumerate(train_loader):
-            inputs, labels = data[0].to(device), data[1].to(device)
+        for i, data in enumerate(timed(DevicePrefetcher(train_loader, device), timer)):
+            inputs, labels = data[0], data[1] # already on device (DevicePrefetcher)
             if saliency: inputs.requires_grad = True
             optimizer.zero_grad()
             out = model(inputs)
@@ -62,14 +97,17 @@ def pretext_train(epoch, pre_type='supervised',  train_loader=DataLoader, model=
             optimizer.step()
 
             pred = out.argmax(dim=1, keepdim=True)
-            train_correct += pred.eq(labels.view_as(pred)).sum().item()
+            metrics.add('correct', pred.eq(labels.view_as(pred)).sum())
+
+            if checkpoint_interval and checkpoint_path is not None and (i + 1) % checkpoint_interval == 0:
+                save_checkpoint(checkpoint_path, model, epoch, train_loader, nb_consumed=(i + 1) * train_loader.batch_size, optimizer=optimizer)
 
             if i % log_interval == 0:
                 msg = '[Epoch %d] Batch [%d], Loss: %.3f' % (epoch + 1, i + 1, loss.item())
                 if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
                 if verbose: print(msg)
         
-        train_acc = 100. * train_correct / len(train_loader.dataset)
+        train_acc = 100. * metrics.get('correct') / len(train_loader.dataset)
 
     elif pre_type=='contrastive':
         """ TODO:
@@ -77,16 +115,17 @@ def pretext_train(epoch, pre_type='supervised',  train_loader=DataLoader, model=
         Choose optimizer: SimCLR use LARS
         """
         optimizer = optim.Adam(model.parameters(), lr=pre_lr)
-        train_acc = 0
+        if optimizer_state is not None: optimizer.load_state_dict(optimizer_state)
+        metrics = MetricsAccumulator(device=device)
         model.train()
-        for i, ((im_x, im_y), _) in enumerate(train_loader): # adapted to loaders that include labels, if loader does not have labels, replace with "i, (im_x, im_y)"
+        for i, ((im_x, im_y), _) in enumerate(timed(DevicePrefetcher(train_loader, device), timer)): # adapted to loaders that include labels, if loader does not have labels, replace with "i, (im_x, im_y)"
             optimizer.zero_grad()
-            inputs = torch.cat([im_x, im_y], dim=0).to(device)
+            inputs = torch.cat([im_x, im_y], dim=0)
             if saliency: inputs.requires_grad = True
             h = model(inputs, return_embed=True) # or leave after fc: out = model(inputs)
 
             # Apply InfoNCE loss
-            loss, acc = info_nce_loss(out=h, temperature=0.5, log=log, logger=logger)
+            loss, acc = info_nce_loss(out=h, temperature=0.5, metrics=metrics if log else None)
             
             # Apply saliency-guidance to loss
             if saliency: 
@@ -99,15 +138,19 @@ def pretext_train(epoch, pre_type='supervised',  train_loader=DataLoader, model=
 
             loss.backward()
             optimizer.step()
-            train_acc += acc.item()
+            metrics.add('acc', acc)
+
+            if checkpoint_interval and checkpoint_path is not None and (i + 1) % checkpoint_interval == 0:
+                save_checkpoint(checkpoint_path, model, epoch, train_loader, nb_consumed=(i + 1) * train_loader.batch_size, optimizer=optimizer)
 
             if i % log_interval == 0:
                 msg = '[Epoch %d] Batch [%d], Loss: %.3f' % (epoch + 1, i + 1, loss.item())
                 if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
+                if log: log_ranking_metrics(metrics, mode='train') # averages over the last log_interval batches
                 if verbose: print(msg)
         
         # TODO: Is this correct? is the acc computed in InfoNCE logical?
-        train_acc /= len(train_loader.dataset)
+        train_acc = metrics.get('acc') / len(train_loader.dataset)
         train_acc *= 100
 
     msg = '[Epoch %d] Pre-training complete, Acc: %.3f%%' % (epoch + 1, train_acc)
@@ -122,30 +165,27 @@ def pretext_train(epoch, pre_type='supervised',  train_loader=DataLoader, model=
     return model
         
 def test(epoch, pre_type='supervised', model=nn.Module, is_vit=False, classifier=nn.Module, test_loader=DataLoader, stage='Pre', saliency=False, saliency_weight=1,
-         save_models=False, save_path=None, verbose=False, log=True, logger=None, jig=False, device='cuda:0'):
+         save_models=False, save_path=None, verbose=False, log=True, logger=None, jig=False, device='cuda:0', timer=None):
     
     grad_context = torch.no_grad() if not saliency else torch.enable_grad()
 
     # if pretext objective was contrastive, modify model to adapt to downstream objective
     if pre_type == 'contrastive' and stage == 'Pre':
         # Remain in contrastive framework
-        test_acc = 0
-        test_loss = 0
-        avg_dist = 0
+        metrics = MetricsAccumulator(device=device)
 
         model.eval()
         with grad_context:
-            for i, ((im_x, im_y), _) in enumerate(test_loader): # adapted to loaders that include labels, if loader does not have labels, replace with "i, (im_x, im_y)"
-                inputs = torch.cat([im_x, im_y], dim=0).to(device)
+            for i, ((im_x, im_y), _) in enumerate(timed(DevicePrefetcher(test_loader, device), timer)): # adapted to loaders that include labels, if loader does not have labels, replace with "i, (im_x, im_y)"
+                inputs = torch.cat([im_x, im_y], dim=0)
                 if saliency: inputs.requires_grad = True
                 h = model(inputs, return_embed=True) # or leave after fc: h, out = model(inputs, return_both=True)
 
                 # Compute distance between embeddings of same batch
-                dist_vec = pdist(h.detach().cpu().numpy(), metric='cosine')
-                avg_dist += np.sum(dist_vec) # TODO: need to divide by 2 because 2 views?
+                metrics.add('dist', cosine_pdist_sum(h)) # TODO: need to divide by 2 because 2 views?
 
                 # Standard test classification procedure
-                loss, acc = info_nce_loss(out=h, temperature=0.5, mode='test', log=log, logger=logger)
+                loss, acc = info_nce_loss(out=h, temperature=0.5, mode='test', metrics=metrics if log else None)
                 
                 # Apply saliency-guidance to loss
                 if saliency: 
@@ -155,13 +195,14 @@ def test(epoch, pre_type='supervised', model=nn.Module, is_vit=False, classifier
                     loss += saliency_weight * kl_divergence(P=saliency_gt, Q=saliency_maps, forward=True)
                     # TODO: forward better to teach more shape interpretation? ((forward-> mass seeker, reverse-> mode seeker))
 
-                test_acc += acc.item()
-                test_loss += loss.item()
+                metrics.add('acc', acc)
+                metrics.add('loss', loss)
             
         # TODO: Is this correct? is the acc computed in InfoNCE logical?
-        test_acc = 100. * test_acc / len(test_loader.dataset)
-        test_loss /= len(test_loader.dataset)
-        avg_dist /= len(test_loader.dataset) # * 2 because of 2 views processed ? doesnt scale linearly though
+        test_acc = 100. * metrics.get('acc') / len(test_loader.dataset)
+        test_loss = metrics.get('loss') / len(test_loader.dataset)
+        avg_dist = metrics.get('dist') / len(test_loader.dataset) # * 2 because of 2 views processed ? doesnt scale linearly though
+        if log: log_ranking_metrics(metrics, mode='test')
         
         msg = '[Epoch %d] %s-testing complete, Avg Loss: %.3f, Acc: %.3f%%' % (epoch + 1, stage, test_loss, test_acc)
         if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
@@ -175,9 +216,7 @@ def test(epoch, pre_type='supervised', model=nn.Module, is_vit=False, classifier
       
     else:
         criterion = nn.CrossEntropyLoss()
-        test_correct = 0
-        test_loss = 0
-        avg_dist = 0
+        metrics = MetricsAccumulator(device=device)
 
         # If downstream testing, the nb_classes should be different from the pre_training, 
         # regardless of pre_type and finetune
@@ -187,9 +226,7 @@ def test(epoch, pre_type='supervised', model=nn.Module, is_vit=False, classifier
             classifier.eval()
         model.eval()
         with grad_context:
-            for inputs, labels in test_loader:
-                inputs = inputs.to(device)
-                labels = labels.to(device)
+            for inputs, labels in timed(DevicePrefetcher(test_loader, device), timer):
                 if saliency: inputs.requires_grad = True
                 
                 if stage == 'Pre':
@@ -199,24 +236,23 @@ def test(epoch, pre_type='supervised', model=nn.Module, is_vit=False, classifier
                     out = classifier(h)
                 
                 # Compute distance between embeddings of same batch
-                dist_vec = pdist(h.detach().cpu().numpy(), metric='cosine')
-                avg_dist += np.sum(dist_vec)
+                metrics.add('dist', cosine_pdist_sum(h))
 
                 # Standard test classification procedure
-                test_loss += criterion(out, labels)
+                metrics.add('loss', criterion(out, labels))
                 # Apply saliency-guidance to loss
                 if saliency: 
                     saliency_maps = compute_saliency_map(outputs=out, model=model, input_images=inputs, embedding=False, normalized=True)
                     canny_edges = canny_edge_detector(input_images=inputs, low_threshold=75, high_threshold=175).to(device)
                     saliency_gt = edge2blob(canny_edges, kernel_size=5, sigma=2.0, device=device)
-                    test_loss += saliency_weight * kl_divergence(P=saliency_gt, Q=saliency_maps, forward=True)
+                    metrics.add('loss', saliency_weight * kl_divergence(P=saliency_gt, Q=saliency_maps, forward=True))
                     # TODO: forward better to teach more shape interpretation? ((forward-> mass seeker, reverse-> mode seeker))
 
                 pred = out.argmax(dim=1, keepdim=True)
-                test_correct += pred.eq(labels.view_as(pred)).sum().item() 
-        test_acc = 100. * test_correct / len(test_loader.dataset)
-        test_loss /= len(test_loader.dataset)
-        avg_dist /= len(test_loader.dataset)
+                metrics.add('correct', pred.eq(labels.view_as(pred)).sum())
+        test_acc = 100. * metrics.get('correct') / len(test_loader.dataset)
+        test_loss = metrics.get('loss') / len(test_loader.dataset)
+        avg_dist = metrics.get('dist') / len(test_loader.dataset)
 
         msg = '[Epoch %d] %s-testing complete, Avg Loss: %.3f, Acc: %.3f%%' % (epoch + 1, stage, test_loss, test_acc)
         if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
@@ -227,12 +263,12 @@ def test(epoch, pre_type='supervised', model=nn.Module, is_vit=False, classifier
             if verbose: print(msg)
             if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
 
-    if not jig: wandb.log({'{}_acc'.format(stage):test_acc, '{}_loss'.format(stage):test_loss})
+    if not jig: log_metrics({'{}_acc'.format(stage):test_acc, '{}_loss'.format(stage):test_loss})
     return test_acc, avg_dist
 
 def down_finetune(epoch, finetune_epochs=5, pre_type='supervised', train_loader=DataLoader, 
                   model=nn.Module, is_vit=False, classifier=nn.Module, down_lr=0.001, saliency=False, saliency_weight=1,
-                  log_interval=100, save_models=False, save_path=None, verbose=False, log=True, logger=None, device='cuda:0'):
+                  log_interval=100, save_models=False, save_path=None, verbose=False, log=True, logger=None, device='cuda:0', timer=None):
     '''if pre_type=='supervised':
         # modify fc dimensions and finetune with standard training procedure
         if not is_vit: model.fc = classifier
@@ -250,11 +286,11 @@ def down_finetune(epoch, finetune_epochs=5, pre_type='supervised', train_loader=
     classifier.train()
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(model.parameters(), lr=down_lr)
+    metrics = MetricsAccumulator(device=device)
     for e in range(finetune_epochs):
-        train_correct = 0
-        train_loss = 0
-        for i, data in enumerate(train_loader):
-            inputs, labels = data[0].to(device), data[1].to(device)
+        metrics.reset()
+        for i, data in enumerate(timed(DevicePrefetcher(train_loader, device), timer)):
+            inputs, labels = data[0], data[1] # already on device (DevicePrefetcher)
             if saliency: inputs.requires_grad = True
             optimizer.zero_grad()
             
@@ -278,16 +314,16 @@ def down_finetune(epoch, finetune_epochs=5, pre_type='supervised', train_loader=
             optimizer.step()
 
             pred = out.argmax(dim=1, keepdim=True)
-            train_correct += pred.eq(labels.view_as(pred)).sum().item()
-            train_loss += loss
+            metrics.add('correct', pred.eq(labels.view_as(pred)).sum())
+            metrics.add('loss', loss)
 
             if i % log_interval == 0:
                 msg = '[Finetuning Epoch %d] Batch [%d], Loss: %.3f' % (e + 1, i + 1, loss.item())
                 if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
                 if verbose: print(msg)
 
-    train_acc = 100. * train_correct / len(train_loader.dataset)
-    train_loss /= len(train_loader.dataset)
+    train_acc = 100. * metrics.get('correct') / len(train_loader.dataset)
+    train_loss = metrics.get('loss') / len(train_loader.dataset)
     
     msg = '[Epoch %d] Finetuning complete, Avg Loss: %.3f, Acc: %.3f%%' % (epoch + 1, train_loss, train_acc)
     if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
@@ -301,118 +337,83 @@ def down_finetune(epoch, finetune_epochs=5, pre_type='supervised', train_loader=
     return model
 
 def eval_bias(model, loader, mapping, 
-                  log=True, verbose=False, logger=None, epoch=0, device='cuda:0'):
+                  log=True, verbose=False, logger=None, epoch=0, device='cuda:0', per_category=False, timer=None):
+    '''
+    Returns shape_bias, accuracy (and the bias_statistics dict with per-category breakdowns if per_category)
+    '''
+
+    # Mapping decisions index mapping.categories, labels index GEIRHOS_CATEGORIES
+    decision_ids = torch.from_numpy(geirhos_category_ids(mapping.categories)).to(device)
 
     model.eval()
-    results = []
+    decisions, shapes, textures = [], [], []
     with torch.no_grad():
-        for img, path in loader:
-            labels = pd.Series(path)
-            labels = labels.str.split("/").str.get(-1).str.split("-")
-            labels = pd.DataFrame({'shape': labels.str.get(0), 
-                                   'texture': labels.str.get(1)})
-            labels['texture'] = labels['texture'].str.replace(r'\.png$', '', regex=True)
-            labels['shape'], labels['texture'] = labels['shape'].apply(remove_int), labels['texture'].apply(remove_int)
-
-            out = model(img.to(device))
+        for img, shape, texture in timed(DevicePrefetcher(loader, device), timer):
+            out = model(img)
             out = torch.nn.Softmax(dim=1)(out)
-            out = torch.squeeze(out).detach().cpu().numpy()
-            map = mapping.probabilities_to_decision(out)
-
-            labels['Map'] = map
-            results.append(labels.to_numpy())
+            # Whole batch mapped to the 16 categories on device
+            decisions.append(decision_ids[mapping.probabilities_to_decisions(out)])
+            shapes.append(shape)
+            textures.append(texture)
         
-    results = pd.DataFrame(np.vstack(results), columns=["Shape", "Texture", "Map"])
-    correct_shape = results.loc[results['Map'] == results['Shape']]
-    correct_texture = results.loc[results['Map'] == results['Texture']]
-    
-    nb_shape = len(correct_shape.index)
-    nb_texture = len(correct_texture.index)
-    shape_bias = nb_shape / (nb_shape + nb_texture)
-
-    overlap = find_overlap(correct_shape.index, correct_texture.index)
-    accuracy = (nb_shape + nb_texture - overlap) / len(loader.dataset)
+    stats = bias_statistics(shape=torch.cat(shapes).cpu().numpy(), texture=torch.cat(textures).cpu().numpy(), 
+                            pred_shape=torch.cat(decisions).cpu().numpy(), nb_classes=len(GEIRHOS_CATEGORIES))
+    shape_bias, accuracy = stats['shape_bias'], stats['accuracy']
     
     msg = '[Epoch %d] Standard Bias Eval complete, Shape Bias: %.3f%% Acc: %.3f%%' % (epoch + 1, shape_bias*100, accuracy*100)
     if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
     if verbose: print(msg)
 
-    wandb.log({'shape bias':shape_bias})
+    log_metrics({'shape bias':shape_bias})
+    if per_category: return shape_bias, accuracy, stats
     return shape_bias, accuracy
 
 def eval_bias_embed(model, loader, nb_neigh=5, metric='cosine', is_vit=False,
-                        log=True, verbose=False, logger=None, epoch=0, device='cuda:0'):
-    embed_map = {
-        "knife"    : 0, 
-        "keyboard" : 1, 
-        "elephant" : 2, 
-        "bicycle"  : 3, 
-        "airplane" : 4,
-        "clock"    : 5, 
-        "oven"     : 6, 
-        "chair"    : 7, 
-        "bear"     : 8, 
-        "boat"     : 9, 
-        "cat"      : 10, 
-        "bottle"   : 11,
-        "truck"    : 12, 
-        "car"      : 13,
-        "bird"     : 14, 
-        "dog"      : 15
-    }
+                        log=True, verbose=False, logger=None, epoch=0, device='cuda:0', per_category=False, timer=None):
+    '''
+    Returns shape_bias, accuracy averaged over 1..nb_neigh neighbors 
+    (and the bias_statistics dicts of each number of neighbors if per_category)
+    '''
     
-    model_results = np.ones(shape=(nb_neigh, 2))
+    # collect all embeddings, once for all numbers of neighbors
+    # labels were parsed once by the dataset, ids index GEIRHOS_CATEGORIES
     model.eval()
+    embeddings, gt = [], []
+    with torch.no_grad():
+        for img, shape, texture in timed(DevicePrefetcher(loader, device), timer):
+            embeddings.append(model(img, return_embed=True))
+            gt.append(torch.stack([shape, texture], dim=1))
+    embeddings = torch.cat(embeddings).cpu().numpy()
+    gt = torch.cat(gt).cpu().numpy()
+
+    model_results = np.ones(shape=(nb_neigh, 2))
+    model_stats = []
     for it in range(1, nb_neigh+1):
         results = []
-        gt = []
-        embeddings = []
-        with torch.no_grad():
-            # collect all embeddings
-            for img, path in loader:
-                labels = pd.Series(path)
-                labels = labels.str.split("/").str.get(-1).str.split("-")
-                labels = pd.DataFrame({'shape': labels.str.get(0), 
-                                       'texture': labels.str.get(1)})
-                labels['texture'] = labels['texture'].str.replace(r'\.png$', '', regex=True)
-                labels['shape'], labels['texture'] = labels['shape'].apply(remove_int), labels['texture'].apply(remove_int)
-                gt.append(labels.replace(embed_map).to_numpy())
-
-                embeddings.append(torch.squeeze(model(img.to(device), return_embed=True)).detach().cpu().numpy())
-
-            embeddings = np.vstack(embeddings)
-            gt = np.vstack(gt)
-
-            # eval with KNN
-            for idx in range(len(embeddings)):
-                train_embeddings = np.delete(np.asarray(embeddings), idx, axis=0)
-                test_embedding = np.expand_dims(embeddings[idx], axis=0)
-                train_gt = np.delete(gt, idx, axis=0)
-                test_gt = gt[idx]
-
-                # Fit for all but this embedding
-                # TODO: which metric to use, using cosine <=> normalizing
-                neigh_shape = KNN(n_neighbors=it, metric=metric)
-                neigh_shape.fit(X=train_embeddings, y=train_gt[:, 0])
-                neigh_texture = KNN(n_neighbors=it, metric=metric)
-                neigh_texture.fit(X=train_embeddings, y=train_gt[:, 1])
-
-                # Predict on this embedding
-                pred_shape = np.squeeze(neigh_shape.predict(test_embedding))
-                pred_texture = np.squeeze(neigh_texture.predict(test_embedding))
-
-                results.append(np.array([pred_shape, pred_texture, test_gt[0], test_gt[1]]))
-
-        results = pd.DataFrame(results, columns=["Predicted Shape", "Predicted Texture", "Shape", "Texture"])
-        correct_shape = results.loc[results['Predicted Shape'] == results['Shape']]
-        correct_texture = results.loc[results['Predicted Texture'] == results['Texture']]
-        
-        nb_shape = len(correct_shape.index)
-        nb_texture = len(correct_texture.index)
-        shape_bias = nb_shape / (nb_shape + nb_texture)
-        
-        overlap = find_overlap(correct_shape.index, correct_texture.index)
-        accuracy = (nb_shape + nb_texture - overlap) / len(loader.dataset)
+        # eval with KNN
+        for idx in range(len(embeddings)):
+            train_embeddings = np.delete(np.asarray(embeddings), idx, axis=0)
+            test_embedding = np.expand_dims(embeddings[idx], axis=0)
+            train_gt = np.delete(gt, idx, axis=0)
+
+            # Fit for all but this embedding
+            # TODO: which metric to use, using cosine <=> normalizing
+            neigh_shape = KNN(n_neighbors=it, metric=metric)
+            neigh_shape.fit(X=train_embeddings, y=train_gt[:, 0])
+            neigh_texture = KNN(n_neighbors=it, metric=metric)
+            neigh_texture.fit(X=train_embeddings, y=train_gt[:, 1])
+
+            # Predict on this embedding
+            pred_shape = np.squeeze(neigh_shape.predict(test_embedding))
+            pred_texture = np.squeeze(neigh_texture.predict(test_embedding))
+
+            results.append(np.array([pred_shape, pred_texture]))
+
+        results = np.asarray(results)
+        stats = bias_statistics(shape=gt[:, 0], texture=gt[:, 1], pred_shape=results[:, 0], pred_texture=results[:, 1], 
+                                nb_classes=len(GEIRHOS_CATEGORIES))
+        shape_bias, accuracy = stats['shape_bias'], stats['accuracy']
+        model_stats.append(stats)
 
         model_results[it-1, 0], model_results[it-1, 1] = shape_bias, accuracy
 
@@ -422,69 +423,43 @@ def eval_bias_embed(model, loader, nb_neigh=5, metric='cosine', is_vit=False,
     if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
     if verbose: print(msg)
     
-    wandb.log({'shape bias knn':shape_bias})
+    log_metrics({'shape bias knn':shape_bias})
+    if per_category: return model_bias_avg, model_acc_avg, model_stats
     return model_bias_avg, model_acc_avg
 
 def eval_edge_sil_embed(model, loader, nb_neigh=5, metric='cosine', is_vit=False,
-                        log=True, verbose=False, logger=None, epoch=0, device='cuda:0', type='Edge'):
-    embed_map = {
-        "knife"    : 0, 
-        "keyboard" : 1, 
-        "elephant" : 2, 
-        "bicycle"  : 3, 
-        "airplane" : 4,
-        "clock"    : 5, 
-        "oven"     : 6, 
-        "chair"    : 7, 
-        "bear"     : 8, 
-        "boat"     : 9, 
-        "cat"      : 10, 
-        "bottle"   : 11,
-        "truck"    : 12, 
-        "car"      : 13,
-        "bird"     : 14, 
-        "dog"      : 15
-    }
+                        log=True, verbose=False, logger=None, epoch=0, device='cuda:0', type='Edge', timer=None):
     
-    model_results = np.ones(shape=(nb_neigh, 1))
+    # collect all embeddings, once for all numbers of neighbors
+    # labels were parsed once by the dataset, ids index GEIRHOS_CATEGORIES
     model.eval()
+    embeddings, gt = [], []
+    with torch.no_grad():
+        for img, shape, _ in timed(DevicePrefetcher(loader, device), timer):
+            embeddings.append(model(img, return_embed=True))
+            gt.append(shape[:, None])
+    embeddings = torch.cat(embeddings).cpu().numpy()
+    gt = torch.cat(gt).cpu().numpy()
+
+    model_results = np.ones(shape=(nb_neigh, 1))
     for it in range(1, nb_neigh+1):
         results = []
-        gt = []
-        embeddings = []
-        with torch.no_grad():
-            # collect all embeddings
-            for img, path in loader:
-                labels = pd.Series(path)
-                labels = labels.str.split("/").str.get(-1)
-                labels = pd.DataFrame({'labels': labels})
-                labels['labels'] = labels['labels'].str.replace(r'\.png$', '', regex=True).apply(remove_int)
-                
-                gt.append(labels.replace(embed_map).to_numpy())
-                embeddings.append(torch.squeeze(model(img.to(device), return_embed=True)).detach().cpu().numpy())
-
-            embeddings = np.vstack(embeddings)
-            gt = np.vstack(gt)
-
-            # eval with KNN
-            for idx in range(len(embeddings)):
-                train_embeddings = np.delete(np.asarray(embeddings), idx, axis=0)
-                test_embedding = np.expand_dims(embeddings[idx], axis=0)
-                train_gt = np.delete(gt, idx, axis=0)
-                test_gt = gt[idx]
-
-                # Fit for all but this embedding
-                neigh = KNN(n_neighbors=it, metric=metric)
-                neigh.fit(X=train_embeddings, y=train_gt.ravel())
-                
-                # Predict on this embedding
-                pred = np.squeeze(neigh.predict(test_embedding))
+        # eval with KNN
+        for idx in range(len(embeddings)):
+            train_embeddings = np.delete(np.asarray(embeddings), idx, axis=0)
+            test_embedding = np.expand_dims(embeddings[idx], axis=0)
+            train_gt = np.delete(gt, idx, axis=0)
+
+            # Fit for all but this embedding
+            neigh = KNN(n_neighbors=it, metric=metric)
+            neigh.fit(X=train_embeddings, y=train_gt.ravel())
+            
+            # Predict on this embedding
+            pred = np.squeeze(neigh.predict(test_embedding))
 
-                results.append(np.array([pred, test_gt.item()]))
+            results.append(pred)
 
-        results = pd.DataFrame(results, columns=["Predicted", "Ground Truth"])
-        correct = results.loc[results['Predicted'] == results['Ground Truth']]
-        accuracy = len(correct.index) / len(loader.dataset)
+        accuracy = np.count_nonzero(np.asarray(results) == gt[:, 0]) / len(loader.dataset)
 
         model_results[it-1] = accuracy
 
@@ -494,29 +469,28 @@ def eval_edge_sil_embed(model, loader, nb_neigh=5, metric='cosine', is_vit=False
     if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
     if verbose: print(msg)
     
-    wandb.log({'{} knn'.format(type) : accuracy})
+    log_metrics({'{} knn'.format(type) : accuracy})
     return model_acc_avg
 
 def eval_views_embed_dist(epoch, model=nn.Module, is_vit=False, test_loader=DataLoader, 
-                        save_models=False, save_path=None, verbose=False, log=True, logger=None, device='cuda:0'):
+                        save_models=False, save_path=None, verbose=False, log=True, logger=None, device='cuda:0', timer=None):
     # Testing the encoder with embedding distances
     
     '''if not is_vit: model.fc = nn.Identity()
     else: model.head = nn.Identity()'''
     
     model.eval()
-    avg_dist = 0
+    metrics = MetricsAccumulator(device=device)
     with torch.no_grad():
-        for inputs, _ in test_loader:
+        for inputs, _ in timed(DevicePrefetcher(test_loader, device), timer):
             nb_views = len(inputs)
             batch_size = len(inputs[0])
-            inputs = torch.cat([view for view in inputs], dim=0).to(device) # won't work if loader does not load 2+ views
+            inputs = torch.cat([view for view in inputs], dim=0) # won't work if loader does not load 2+ views
             out = model(inputs, return_embed=True)
 
-            for h in out.reshape(nb_views, batch_size, -1).transpose(0, 1):
-                dist_vec = pdist(h.detach().cpu().numpy(), metric='cosine')
-                avg_dist += np.sum(dist_vec)
-    avg_dist /= len(test_loader.dataset)
+            # Distances between the views of each image, all images at once
+            metrics.add('dist', cosine_pdist_sum(out.reshape(nb_views, batch_size, -1).transpose(0, 1)))
+    avg_dist = metrics.get('dist') / len(test_loader.dataset)
 
     msg = '[Epoch %d] Pair embeddings distance testing complete, Avg Distance: %.3f' % (epoch + 1, avg_dist)
     if log: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
@@ -530,54 +504,211 @@ def eval_views_embed_dist(epoch, model=nn.Module, is_vit=False, test_loader=Data
     return avg_dist
 
 
+def evaluate(model, epoch, metrics, loaders, pre_type='supervised', pre_dataset='CIFAR10', nb_classes=10, is_vit=False,
+             finetune=False, save_models=False, logger=None, device='cuda:0', timer=None):
+    """
+    Run the evaluation metrics of main() listed in metrics (see utils.EvalSchedule) and return their results in a dict:
+    pre, dist_batch, shape_bias, bias_acc, edge_acc, sil_acc, down, dist_down, jig_16_acc, dist_jig_16, jig_8_acc,
+    dist_jig_8, dist_3_simclr, dist_gray, dist_hflip, dist_rcrop (only the keys of the metrics run).
+    loaders: dict of the eval loaders built in main(). The jigsaw tests use the downstream classifier,
+    which is finetuned first if finetune, even when down itself is not due.
+    """
+    timer = timer if timer is not None else StageTimer(device=device)
+    results = {}
+
+    # Pretext test
+    if 'pre' in metrics and pre_dataset not in ['noise', 'fractal']:
+        with timer.stage('test_pre'):
+            results['pre'], results['dist_batch'] = test(pre_type=pre_type, model=model, test_loader=loaders['pre_test'], is_vit=is_vit, stage='Pre', saliency=False, saliency_weight=1,
+                                                         save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device, timer=timer)
+
+    # Shape bias with Geirhos method (1200 images in his custom set)
+    if 'bias' in metrics:
+        with timer.stage('bias'):
+            if pre_dataset == 'ImageNet': # standard classification
+                results['shape_bias'], results['bias_acc'] = eval_bias(model=model, loader=loaders['geirhos'], mapping=ImageNetProbabilitiesTo16ClassesMapping(),
+                                                                       log=True, verbose=False, logger=logger, epoch=epoch, device=device, timer=timer)
+            else: # KNN classification of embeddings
+                results['shape_bias'], results['bias_acc'] = eval_bias_embed(model=model, loader=loaders['geirhos'], nb_neigh=5, metric='cosine',
+                                                                             is_vit=is_vit, log=True, verbose=False, logger=logger, epoch=epoch, device=device, timer=timer)
+    if 'edge_sil' in metrics and pre_dataset != 'ImageNet':
+        with timer.stage('edge'):
+            results['edge_acc'] = eval_edge_sil_embed(model=model, loader=loaders['geirhos_edge'], nb_neigh=5, metric='cosine',
+                                                      is_vit=is_vit, log=True, verbose=False, logger=logger, epoch=epoch, device=device, type='Edge', timer=timer)
+        with timer.stage('sil'):
+            results['sil_acc'] = eval_edge_sil_embed(model=model, loader=loaders['geirhos_sil'], nb_neigh=5, metric='cosine',
+                                                     is_vit=is_vit, log=True, verbose=False, logger=logger, epoch=epoch, device=device, type='Sil', timer=timer)
+
+    # Downstream
+    if 'down' in metrics or 'jigsaw' in metrics:
+        if not is_vit: classifier = nn.Linear(in_features=model.fc.in_features, out_features=nb_classes).to(device)
+        else: classifier = nn.Linear(in_features=model.head.in_features, out_features=nb_classes).to(device)
+
+        # Finetune on downstream task
+        if finetune:
+            with timer.stage('finetune'):
+                down_finetune(model=model, finetune_epochs=5, pre_type=pre_type, train_loader=loaders['down_train'], saliency=False, saliency_weight=1,
+                              down_lr=0.001, classifier=classifier, is_vit=is_vit,
+                              log_interval=100, save_models=False, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device, timer=timer)
+
+    # Test on downstream task
+    if 'down' in metrics:
+        with timer.stage('test_down'):
+            results['down'], results['dist_down'] = test(pre_type=pre_type, model=model, test_loader=loaders['down_test'], classifier=classifier, is_vit=is_vit, stage='Down', saliency=False, saliency_weight=1,
+                                                         save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device, timer=timer)
+
+    # Test on downstream jigsaw mixed data
+    if 'jigsaw' in metrics:
+        with timer.stage('test_jig16'):
+            results['jig_16_acc'], results['dist_jig_16'] = test(pre_type=pre_type, model=model, test_loader=loaders['jig_16'], classifier=classifier, is_vit=is_vit, stage='Down',
+                                                                 save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device, jig=True, timer=timer)
+        with timer.stage('test_jig8'):
+            results['jig_8_acc'], results['dist_jig_8'] = test(pre_type=pre_type, model=model, test_loader=loaders['jig_8'], classifier=classifier, is_vit=is_vit, stage='Down',
+                                                               save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device, jig=True, timer=timer)
+
+    # Views Embeddings distance
+    if 'distances' in metrics:
+        for name, loader in [('dist_3_simclr', 'views_dist'), ('dist_gray', 'gray_pair'), ('dist_hflip', 'hflip_pair'), ('dist_rcrop', 'rcrop_pair')]:
+            with timer.stage(name):
+                results[name] = eval_views_embed_dist(model=model, is_vit=is_vit, test_loader=loaders[loader],
+                                                      save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device, timer=timer)
+
+    return results
+
+
+class EvalWorker(object):
+    """
+    Run evaluate() in a background thread on snapshots of the model weights, so pretext training does not wait for it.
+
+    submit() copies the weights to host memory and queues them (it blocks while max_pending snapshots are already
+    waiting), the worker loads each snapshot into its own copy of the model and evaluates it on a side cuda stream.
+    collect() returns the finished (epoch, metrics, results, timer), epoch being the source epoch of the snapshot,
+    and close() waits for the queued evaluations. A thread rather than a process, so the eval loaders (in-memory
+    probe sets on device, transform caches) are shared as they are. eval_kwargs are passed to evaluate().
+    The thread shares the global torch RNG with training (loader shuffling and worker seeds, classifier init and
+    augmentations of the evaluations draw from it), so with async eval training is not reproducible from its seed.
+    """
+    def __init__(self, model, device='cuda:0', max_pending=1, **eval_kwargs):
+        self.model = copy.deepcopy(model)
+        self.device = torch.device(device)
+        self.eval_kwargs = eval_kwargs
+        self.todo = queue.Queue(maxsize=max_pending)
+        self.done = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, epoch, metrics, model):
+        state = {key: value.detach().to('cpu', copy=True) for key, value in model.state_dict().items()}
+        self.todo.put((epoch, metrics, state))
+
+    def _run(self):
+        stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        while True:
+            item = self.todo.get()
+            if item is None:
+                return
+            epoch, metrics, state = item
+            try:
+                with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                    self.model.load_state_dict(state)
+                    timer = StageTimer(device=self.device)
+                    results = evaluate(self.model, epoch, metrics, device=self.device, timer=timer, **self.eval_kwargs)
+                self.done.put((epoch, metrics, results, timer))
+            except Exception as e:
+                self.done.put(e)
+
+    def collect(self):
+        finished = []
+        while True:
+            try: item = self.done.get_nowait()
+            except queue.Empty: return finished
+            if isinstance(item, Exception): raise item
+            finished.append(item)
+
+    def close(self):
+        self.todo.put(None)
+        self.thread.join()
+        return self.collect()
+
+
 def main(models2compare=[], train_epochs=10, pre_type='supervised', pre_dataset='CIFAR10', aug_pre=False,
             test_interval=5, finetune=False, down_dataset='CIFAR10', 
-            save_models=False, experiment_id='test1_elior', modelnames=[], checkpoint_names=None):
+            save_models=False, experiment_id='test1_elior', modelnames=[], checkpoint_names=None, profile_steps=0, eval_schedule=None,
+            async_eval=False, metrics_backends=('wandb',), wandb_mode=None, results_path=os.path.join('scores', 'results.sqlite'), run_id=None,
+            pre_lr=0.001, saliency=False, saliency_weight=1, pre_data_kwargs=None, device=None, early_stopping=None,
+            checkpoint_interval=None, checkpoint_path='model'):
         
         """
-        Returns: score_table: shape = (nb of models to compare, nb of logged epochs)
-                    score_table indices: name of models
-                    score_table columns: logged epochs
-                    inside each element: [pretext_test, bias_percentage, downstream_test, embed_pair_dist]
-                    access a score: score_table.loc['model name', 'epoch nb'][idx]
+        profile_steps: capture that many pretext training steps with torch.profiler (Chrome trace in out/<experiment_id>/traces).
+        eval_schedule: utils.EvalSchedule giving the interval or time budget of each metric, all metrics every test_interval epochs by default.
+        async_eval: evaluate snapshots of the weights in an EvalWorker while training continues, results are logged tagged with their eval_epoch.
+                    The evaluations share the global RNG with training, runs are not reproducible with async_eval.
+        metrics_backends: backends of the utils.MetricsSink the metrics are queued to ('wandb', 'jsonl', 'parquet', 'none'),
+                          files in out/<experiment_id>/metrics. wandb_mode: e.g. 'offline' to log to wandb without network.
+        results_path: utils.ResultsStore the results are appended to during training, as rows of run run_id (default: experiment_id, start time and process id).
+        pre_lr, saliency, saliency_weight: pretext training settings, see pretext_train.
+        pre_data_kwargs: extra load_data arguments of the pretext loaders, e.g. dict(n_views=2, noise_path=load_noise(...)).
+        device: defaults to cuda:0 when available.
+        early_stopping: utils.SuccessiveHalving on results_path, stops the training of a model that falls behind the others at a rung.
+        checkpoint_interval: save a resumable checkpoint of each model every checkpoint_interval pretext batches, to <checkpoint_path>/<model name>_last.pth.
+        checkpoint_names: checkpoints loaded from checkpoint_path, e.g. [name + '_last' for name in modelnames] resumes an interrupted run
+                          at the batch it was saved (model, optimizer state of that epoch, sampler position).
+        Returns: score_table: the results of this run, ResultsStore.table
+                    score_table indices: (name of model, logged epoch)
+                    score_table columns: metrics (pre, shape_bias, down, dist_3_simclr, ...), nan for metrics not run that epoch
+                    access a score: score_table.loc[('model name', epoch nb), 'metric']
         """
 
         assert len(models2compare) == len(modelnames), 'Provide a list of model names with same length as list of models to be tested'
         if checkpoint_names is not None: assert len(models2compare) == len(checkpoint_names), 'Provide a list of model checkpoint names with same length as list of models to be tested'
-        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+        device = torch.device(device if device is not None else 'cuda:0' if torch.cuda.is_available() else 'cpu')
+        if checkpoint_interval: os.makedirs(checkpoint_path, exist_ok=True)
 
         # Pre and Down Dataloader
-        pre_train, pre_test = load_data(dataset=pre_dataset, stage='pre', finetune=finetune, aug=aug_pre) # TODO: cifar train with simCLR aug
-        down_train, down_test = load_data(dataset=down_dataset, stage='down', finetune=finetune)
+        pre_train, pre_test = load_data(dataset=pre_dataset, stage='pre', finetune=finetune, aug=aug_pre, **(pre_data_kwargs or {})) # TODO: cifar train with simCLR aug
+        down_train, down_test = load_data(dataset=down_dataset, stage='down', finetune=finetune, tensor_store=True) # test split preprocessed once
         
         # Custom Geirhos Dataloaders
         bias_data_path = load_geirhos_transfer_pre(conflict_only=True)
         edge_data_path = load_geirhos_edge_silhouette(type='edge')
         sil_data_path = load_geirhos_edge_silhouette(type='sil')
-        geirhos_bs = 256 if device=='cuda:0' else 1
-        geirhos_bias_ds = MyDataset(bias_data_path, transforms=transforms.Compose([transforms.Resize(32),
+        geirhos_bs = 256 if device.type == 'cuda' else 1
+        geirhos_bias_ds = GeirhosDataset(bias_data_path, decode_size=32, transforms=transforms.Compose([transforms.Resize(32),
                                                                              transforms.ToTensor(),
                                                                              transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))]))
-        geirhos_edge_ds = MyDataset(edge_data_path, transforms=transforms.Compose([transforms.Resize(32),
+        geirhos_edge_ds = GeirhosDataset(edge_data_path, decode_size=32, transforms=transforms.Compose([transforms.Resize(32),
                                                                              transforms.ToTensor(),
                                                                              transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))]))
-        geirhos_sil_ds = MyDataset(sil_data_path, transforms=transforms.Compose([transforms.Resize(32),
+        geirhos_sil_ds = GeirhosDataset(sil_data_path, decode_size=32, transforms=transforms.Compose([transforms.Resize(32),
                                                                              transforms.ToTensor(),
                                                                              transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))]))
-        geirhos_loader = torch.utils.data.DataLoader(geirhos_bias_ds, batch_size=geirhos_bs, num_workers=0, shuffle=False, pin_memory=False)
-        geirhos_edge_loader = torch.utils.data.DataLoader(geirhos_edge_ds, batch_size=geirhos_bs, num_workers=0, shuffle=False, pin_memory=False)
-        geirhos_sil_loader = torch.utils.data.DataLoader(geirhos_sil_ds, batch_size=geirhos_bs, num_workers=0, shuffle=False, pin_memory=False)
+        # Small probe sets, held in memory on device
+        geirhos_loader = memory_loader(geirhos_bias_ds, 'geirhos', 'eval', bs=geirhos_bs, in_memory=True, device=device)
+        geirhos_edge_loader = memory_loader(geirhos_edge_ds, 'geirhos', 'eval', bs=geirhos_bs, in_memory=True, device=device)
+        geirhos_sil_loader = memory_loader(geirhos_sil_ds, 'geirhos', 'eval', bs=geirhos_bs, in_memory=True, device=device)
 
         # Pair Embedding Distances Dataloader
+        # Deterministic views cached when worth it: the split must fit in the cache (in-order passes evict everything from a
+        # smaller LRU) and its images be costly to prepare. ImageNet-O: 600 val images resized from full resolution, ~40MB.
+        # Not ImageNet (50000 val views at 224px), nor tiny/CIFAR (64/32px, cheaper to transform again than to cache).
+        pair_cache = {'ImageNetO': 2000}.get(down_dataset, 0)
         _ , views_dist_loader = load_data(dataset=down_dataset, stage='down', finetune=False, n_views=3)
-        _ , gray_pair_dist_loader = load_data(down_dataset, ('gray', 1), stage='down', finetune=False, n_views=2, spe_pair=True) # ensure other sample is augmented
-        _ , hflip_pair_dist_loader = load_data(down_dataset, ('hflip', 1), stage='down', finetune=False, n_views=2, spe_pair=True) # ensure other sample is augmented
-        _ , rdm_rcrop_pair_dist_loader = load_data(down_dataset, ('crop', 1), stage='down', finetune=False, n_views=2, spe_pair=True)
+        _ , gray_pair_dist_loader = load_data(down_dataset, ('gray', 1), stage='down', finetune=False, n_views=2, spe_pair=True, transform_cache=pair_cache) # ensure other sample is augmented
+        _ , hflip_pair_dist_loader = load_data(down_dataset, ('hflip', 1), stage='down', finetune=False, n_views=2, spe_pair=True, transform_cache=pair_cache) # ensure other sample is augmented
+        _ , rdm_rcrop_pair_dist_loader = load_data(down_dataset, ('crop', 1), stage='down', finetune=False, n_views=2, spe_pair=True, transform_cache=pair_cache)
 
         # Jigsaw Dataloader
         _ , jig_loader_16 = load_data(down_dataset, stage='down', jigsaw_ps=16)
         _ , jig_loader_8 = load_data(down_dataset, stage='down', jigsaw_ps=8)
 
+        eval_loaders = {
+            'pre_test': pre_test, 'down_train': down_train, 'down_test': down_test,
+            'geirhos': geirhos_loader, 'geirhos_edge': geirhos_edge_loader, 'geirhos_sil': geirhos_sil_loader,
+            'views_dist': views_dist_loader, 'gray_pair': gray_pair_dist_loader, 'hflip_pair': hflip_pair_dist_loader, 'rcrop_pair': rdm_rcrop_pair_dist_loader,
+            'jig_16': jig_loader_16, 'jig_8': jig_loader_8,
+        }
+        if eval_schedule is None: eval_schedule = EvalSchedule(default_interval=test_interval)
+
         # Init logger
         logger = create_logger(experiment_id)
         logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + 'Starting {} pre-learning on {}, testing on {}'.format(pre_type, pre_dataset, down_dataset))
@@ -590,19 +721,43 @@ def main(models2compare=[], train_epochs=10, pre_type='supervised', pre_dataset=
             'tiny'     : 200,
             'ImageNetO': 200,
         }
-        scores = []
+        store = ResultsStore(results_path)
+        if run_id is None: run_id = '{}_{}_{}'.format(experiment_id, time.strftime('%Y-%m-%d-%H-%M-%S'), os.getpid())
+        logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + 'Results of run {} stored in {}'.format(run_id, results_path))
+
+        def save_results(epoch, metrics, results, distances):
+            log_metrics({key: results[key] for key in ['jig_16_acc', 'dist_jig_16', 'jig_8_acc', 'dist_jig_8', 'dist_batch',
+                                                     'dist_3_simclr', 'dist_gray', 'dist_hflip', 'dist_rcrop'] if key in results})
+            print(', '.join('%s: %.3f' % (key, results[key]) for key in ['dist_batch', 'dist_down', 'dist_gray', 'dist_hflip', 'dist_rcrop'] if key in results))
+
+            store.add(run_id, modelnames[scores_idx], epoch+1, results)
+            if 'distances' in metrics and pre_dataset not in ['noise', 'fractal']:
+                distances[epoch+1] = [results.get(key, np.nan) for key in ['dist_batch', 'dist_down', 'dist_gray', 'dist_hflip', 'dist_rcrop']]
+            log_metrics({'epoch':epoch+1})
+
+        def save_async_results(finished):
+            # Results of the worker, tagged with the epoch of their weights snapshot
+            for epoch, metrics, results, eval_timer in finished:
+                log_metrics(dict({'eval/' + key: value for key, value in results.items()}, eval_epoch=epoch+1))
+                save_results(epoch, metrics, results, distances)
+                schedule.update(eval_timer.summary())
+                log_metrics(eval_timer.log(logger=logger, epoch=epoch))
+
         scores_idx = 0
-        scores_epochs = []
         for model in models2compare:
-            scores.append([])
-            distances = []
+            distances = {}
+            schedule = copy.deepcopy(eval_schedule) # budgets are spent per model
             start_epoch = 0
+            optimizer_state = None
 
             if checkpoint_names is not None:
-                model.load_state_dict(torch.load(os.path.join('model', checkpoint_names[scores_idx] + '.pth')))
+                saved_epoch, optimizer_state = load_checkpoint(os.path.join(checkpoint_path, checkpoint_names[scores_idx] + '.pth'), model, pre_train)
                 str_epoch = r'_e(\d+)_'
                 match = re.search(str_epoch, checkpoint_names[scores_idx])
-                if match:
+                if saved_epoch is not None: # resumable checkpoint, the sampler resumes where it stopped
+                    start_epoch = getattr(pre_train.sampler, 'epoch', saved_epoch) # next epoch if saved on the last batch
+                    if start_epoch != saved_epoch: optimizer_state = None
+                elif match:
                     start_epoch = int(match.group(1))
                 logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + 'Loaded model: {} at epoch: {}'.format(checkpoint_names[scores_idx], start_epoch))
 
@@ -612,120 +767,85 @@ def main(models2compare=[], train_epochs=10, pre_type='supervised', pre_dataset=
             else: is_vit = False
             
             # init wandb log
-            wandb.init(entity='eliorb', project=experiment_id, name=modelnames[scores_idx])
+            if 'wandb' in metrics_backends: wandb.init(entity='eliorb', project=experiment_id, name=modelnames[scores_idx], mode=wandb_mode)
+            sink = MetricsSink(metrics_backends, path=os.path.join('out', experiment_id, 'metrics', modelnames[scores_idx]))
+            set_metrics_sink(sink)
             logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + 'Start of {}'.format(modelnames[scores_idx]))
+            # Per-stage wall time, throughput and data wait, logged every epoch
+            timer = StageTimer(device=device, profile_steps=profile_steps,
+                               trace_dir=os.path.join('out', experiment_id, 'traces', modelnames[scores_idx]))
+            eval_kwargs = dict(loaders=eval_loaders, pre_type=pre_type, pre_dataset=pre_dataset, nb_classes=class_name_2_nb_classes[down_dataset],
+                               is_vit=is_vit, finetune=finetune, save_models=save_models, logger=logger)
+            worker = EvalWorker(model, device=device, **eval_kwargs) if async_eval else None
             for epoch in range(start_epoch, train_epochs+1):
+                # Epoch-seeded shuffling: same order for an epoch whether training was resumed or not
+                if hasattr(pre_train.sampler, 'set_epoch') and pre_train.sampler.epoch != epoch:
+                    pre_train.sampler.set_epoch(epoch)
+                if hasattr(pre_train.dataset, 'set_epoch'): # e.g. procedural images drawn anew every epoch
+                    pre_train.dataset.set_epoch(epoch)
                 
                 save_path = os.path.join('model', '{}_{}_pre.pth'.format(modelnames[scores_idx], epoch+1))
                 
                 # Train on pretext task
-                model = pretext_train(pre_type=pre_type, train_loader=pre_train, model=model, pre_lr=0.001, saliency=False, saliency_weight=1,
-                                      log_interval=100, save_models=save_models, save_path=save_path, verbose=False, log=True, logger=logger, epoch=epoch, device=device)
-                
-                # Test
-                if epoch % test_interval == 0:
-                    
-                    # Pretext test
-                    if pre_dataset not in ['noise', 'fractal']:
-                        result_pre, dist_pre = test(pre_type=pre_type, model=model, test_loader=pre_test, is_vit=is_vit, stage='Pre', saliency=False, saliency_weight=1,
-                                                    save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device)
-
-                    
-                    # Shape bias with Geirhos method (1200 images in his custom set)
-                    if pre_dataset == 'ImageNet': # standard classification
-                        result_bias, result_acc = eval_bias(model=model, loader=geirhos_loader, mapping=ImageNetProbabilitiesTo16ClassesMapping(),
-                                                            log=True, verbose=False, logger=logger, epoch=epoch, device=device)
-                    else: # KNN classification of embeddings
-                        result_bias, result_acc = eval_bias_embed(model=model, loader=geirhos_loader, nb_neigh=5, metric='cosine',
-                                                                  is_vit=is_vit, log=True, verbose=False, logger=logger, epoch=epoch, device=device)
-                        edge_acc = eval_edge_sil_embed(model=model, loader=geirhos_edge_loader, nb_neigh=5, metric='cosine', 
-                                                       is_vit=is_vit, log=True, verbose=False, logger=logger, epoch=epoch, device=device, type='Edge')
-                        sil_acc = eval_edge_sil_embed(model=model, loader=geirhos_sil_loader, nb_neigh=5, metric='cosine', 
-                                                       is_vit=is_vit, log=True, verbose=False, logger=logger, epoch=epoch, device=device, type='Sil')
-
-                    # Downstream
-                    out_features = class_name_2_nb_classes[down_dataset]
-                    if not is_vit: classifier = nn.Linear(in_features=model.fc.in_features, out_features=out_features).to(device)
-                    else: classifier = nn.Linear(in_features=model.head.in_features, out_features=out_features).to(device)
-
-                    # Finetune on downstream task
-                    if finetune:
-                        down_finetune(model=model, finetune_epochs=5, pre_type=pre_type, train_loader=down_train, saliency=False, saliency_weight=1,
-                                      down_lr=0.001, classifier=classifier, is_vit=is_vit, 
-                                      log_interval=100, save_models=False, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device)
+                with timer.stage('pretext_train'):
+                    model = pretext_train(pre_type=pre_type, train_loader=pre_train, model=model, pre_lr=pre_lr, saliency=saliency, saliency_weight=saliency_weight,
+                                          log_interval=100, save_models=save_models, save_path=save_path, verbose=False, log=True, logger=logger, epoch=epoch, device=device, timer=timer,
+                                          checkpoint_interval=checkpoint_interval, checkpoint_path=os.path.join(checkpoint_path, '{}_last.pth'.format(modelnames[scores_idx])),
+                                          optimizer_state=optimizer_state)
+                optimizer_state = None # only for the resumed epoch
                 
-                    # Test on downstream task
-                    result_down, dist_down = test(pre_type=pre_type, model=model, test_loader=down_test, classifier=classifier, is_vit=is_vit, stage='Down',saliency=False, saliency_weight=1,
-                                                  save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device)
-
-                    # Test on downstream jigsaw mixed data
-                    result_down_jig16, dist_down_jig16 = test(pre_type=pre_type, model=model, test_loader=jig_loader_16, classifier=classifier, is_vit=is_vit, stage='Down',
-                                                              save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device, jig=True)
-                    result_down_jig8, dist_down_jig8 = test(pre_type=pre_type, model=model, test_loader=jig_loader_8, classifier=classifier, is_vit=is_vit, stage='Down',
-                                                  save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device, jig=True)
-
-                    # Views Embeddings distance 
-                    result_3simclr_dist = eval_views_embed_dist(model=model, is_vit=is_vit, test_loader=views_dist_loader, 
-                                                       save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device)
-                    result_pair_dist_gray = eval_views_embed_dist(model=model, is_vit=is_vit, test_loader=gray_pair_dist_loader, 
-                                                       save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device)
-                    result_pair_dist_hflip = eval_views_embed_dist(model=model, is_vit=is_vit, test_loader=hflip_pair_dist_loader, 
-                                                       save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device)
-                    result_pair_dist_rdm_crop = eval_views_embed_dist(model=model, is_vit=is_vit, test_loader=rdm_rcrop_pair_dist_loader, 
-                                                       save_models=save_models, save_path=None, verbose=False, log=True, logger=logger, epoch=epoch, device=device)
-                    
-                    wandb.log({
-                        "jig_16_acc":result_down_jig16,
-                        "dist_jig_16":dist_down_jig16,
-                        "jig_8_acc":result_down_jig8,
-                        "dist_jig_8":dist_down_jig8,
-                        
-                        "dist_batch":dist_pre,
-                        "dist_3_simclr":result_3simclr_dist,
-                        "dist_gray":result_pair_dist_gray,
-                        "dist_hflip":result_pair_dist_hflip,
-                        "dist_rcrop":result_pair_dist_rdm_crop,
-                    })
-                    print('Pre: %.3f, Down: %.3f, Gray: %.3f, Hflip: %.3f, Rcrop: %.3f' % (dist_pre, dist_down, result_pair_dist_gray, result_pair_dist_hflip, result_pair_dist_rdm_crop))
-
-                    # Save all results
-                    if pre_dataset not in ['noise', 'fractal']:
-                        scores[scores_idx].append([result_pre, result_bias, result_down, result_3simclr_dist])
-                        distances.append([dist_pre, dist_down, result_pair_dist_gray, result_pair_dist_hflip, result_pair_dist_rdm_crop])
-                    else :
-                        scores[scores_idx].append([result_bias, result_down, result_3simclr_dist])
-                    if scores_idx == 0: 
-                        scores_epochs.append(epoch+1)
-                        wandb.log({'epoch':epoch+1})
+                # Test, metrics due this epoch
+                metrics = schedule.due(epoch)
+                if metrics and worker is not None:
+                    worker.submit(epoch, metrics, model)
+                elif metrics:
+                    results = evaluate(model, epoch, metrics, device=device, timer=timer, **eval_kwargs)
+                    save_results(epoch, metrics, results, distances)
+
+                schedule.update(timer.summary())
+                log_metrics(timer.log(logger=logger, epoch=epoch))
+                if worker is not None: save_async_results(worker.collect())
+
+                if early_stopping is not None and early_stopping.should_stop(run_id, modelnames[scores_idx], epoch+1):
+                    logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + 'Stopped {} at epoch {}, not in the top 1/{} of its successive halving rung'.format(
+                        modelnames[scores_idx], epoch+1, early_stopping.eta))
+                    break
 
                 '''scheduler.step()'''
+
+            if worker is not None: save_async_results(worker.close())
         
             ### Specific distance analysis, temp so not in visualize
-            distances = np.vstack(distances)
-            labels = ['pre', 'down', 'gray', 'hflip', 'rcrop']
-            fig, ax1 = plt.subplots()
-            ax1.plot(scores_epochs, distances[:, 0], 'g', label='pre')
-            ax1.plot(scores_epochs, distances[:, 1], 'k', label='down')
-            ax2 = ax1.twinx()
-            ax2.plot(scores_epochs, distances[:, 2], 'b', label='gray')
-            ax2.plot(scores_epochs, distances[:, 3], 'r', label='hflip')
-            ax2.plot(scores_epochs, distances[:, 4], 'orange', label='rcrop')
-
-            lines, labels = ax1.get_legend_handles_labels()
-            lines2, labels2 = ax2.get_legend_handles_labels()
-            ax2.legend(lines + lines2, labels + labels2, loc='center right')
-            plt.title('{}__distances_on_CIFAR10'.format(modelnames[scores_idx]))
-            ax1.set_xlabel('Epochs')
-            ax1.set_ylabel('Distance (non augmented same batch)')
-            ax2.set_ylabel('Distance (pair of aug/non-aug)')
-            plt.tight_layout()
-            plt.savefig(os.path.join('scores', '{}_distances_on_CIFAR10.png'.format(modelnames[scores_idx])), dpi=300)
+            if distances:
+                dist_epochs = list(distances)
+                distances = np.vstack(list(distances.values()))
+                labels = ['pre', 'down', 'gray', 'hflip', 'rcrop']
+                fig, ax1 = plt.subplots()
+                ax1.plot(dist_epochs, distances[:, 0], 'g', marker='.', label='pre') # nan (gaps) when the metric was not due
+                ax1.plot(dist_epochs, distances[:, 1], 'k', marker='.', label='down')
+                ax2 = ax1.twinx()
+                ax2.plot(dist_epochs, distances[:, 2], 'b', label='gray')
+                ax2.plot(dist_epochs, distances[:, 3], 'r', label='hflip')
+                ax2.plot(dist_epochs, distances[:, 4], 'orange', label='rcrop')
+
+                lines, labels = ax1.get_legend_handles_labels()
+                lines2, labels2 = ax2.get_legend_handles_labels()
+                ax2.legend(lines + lines2, labels + labels2, loc='center right')
+                plt.title('{}__distances_on_CIFAR10'.format(modelnames[scores_idx]))
+                ax1.set_xlabel('Epochs')
+                ax1.set_ylabel('Distance (non augmented same batch)')
+                ax2.set_ylabel('Distance (pair of aug/non-aug)')
+                plt.tight_layout()
+                plt.savefig(os.path.join('scores', '{}_distances_on_CIFAR10.png'.format(modelnames[scores_idx])), dpi=300)
             ### Specific distance analysis, temp so not in visualize
 
+            logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + 'Stage trace saved to {}'.format(timer.save_trace()))
             scores_idx += 1
-            wandb.finish()
+            sink.close() # written before the run is finished
+            set_metrics_sink(None)
+            if 'wandb' in metrics_backends: wandb.finish()
 
-        score_table = pd.DataFrame(scores, index=modelnames, columns=scores_epochs)
+        score_table = store.table(run=run_id)
 
         return score_table
 
@@ -748,8 +868,7 @@ if __name__ == '__main__':
 
     scores = main(models2compare=models_to_compare, train_epochs=100, test_interval=5, 
                   save_models=False, experiment_id='test_both_aug', modelnames=model_names)
-    pd.DataFrame(scores.T).to_excel(os.path.join('scores', 'FULL.xlsx'))
-    visualize(scores, model_names, save=True, pre_data='not_noise')
+    visualize(scores, model_names, save=True)
 
 '''
 Notes:
@@ -761,6 +880,11 @@ Notes:
 
     # Pre Noise Dataloader
     contrastive_path = load_noise('stylegan-oriented', 'feature_vis-random') # 1+ folders to use in train
+    # or a fixed number of images, e.g. for dataset size sweeps, split evenly or with per-family proportions
+    contrastive_path = load_noise('stylegan-oriented', 'feature_vis-random', size=50000)
+    contrastive_path = load_noise(size=50000, proportions={'stylegan-oriented': 0.75, 'feature_vis-random': 0.25})
+    # or generated on the fly, without disk reads
+    contrastive_path = ProceduralNoiseDataset(('dead_leaves-mixed', 'stat-spectrum_color'), size=105000)
     pre_train_cont, pre_test_cont = load_data(dataset='noise', bs=64, n_views=2, noise_path=contrastive_path, 
                                                 resize_image=False, shuffle_noise=True)
     # Call main
@@ -769,12 +893,35 @@ Notes:
     
     # Fractal
     fractal_path = load_fractal()
-    pre_train_cont, pre_test_cont = load_data(dataset='fractal', bs=64, n_views=2, noise_path=fractal_path, 
+    # or rendered from IFS parameters, searched once
+    save_ifs_params(FRACTAL_PARAMS_PATH, *search_ifs_categories(1000))
+    fractal_path = FractalDataset(nb_instances=100, cache_path=os.path.join('data', 'fractal_renders.npy')) # renders kept on disk, rendered by load_data on first use
+    pre_train_cont, pre_test_cont = load_data(dataset='fractal', bs=64, n_views=2, fractal_path=fractal_path, 
                                                 resize_image=False, shuffle_noise=True)
     # Call main
     scores = main(models2compare=models_to_compare, train_epochs=20, test_interval=2, pre_type='contrastive', 
                   pre_dataset='fractal', finetune=True, save_models=False, experiment_id='fractal_tiny', modelnames=model_names)
 
+    # Sparse evaluation: cheap probes every epoch, the downstream probe within ~10% of the training time
+    schedule = EvalSchedule(intervals={'bias': 1, 'edge_sil': 1, 'distances': 2, 'jigsaw': 10}, budgets={'down': 0.1}, default_interval=5)
+    scores = main(models2compare=models_to_compare, train_epochs=100, eval_schedule=schedule, 
+                  save_models=False, experiment_id='sparse_eval', modelnames=model_names)
+    # same, evaluated on weight snapshots in a background worker while training continues
+    scores = main(models2compare=models_to_compare, train_epochs=100, eval_schedule=schedule, async_eval=True,
+                  save_models=False, experiment_id='sparse_eval_async', modelnames=model_names)
+
+# Sweeps over models, pretext settings and augmentations: sweep.py, e.g.
+    python sweep.py --name lr_sal --grid model=vit,resnet18 lr=0.001,0.0003 saliency_weight=0,1 --devices cuda:0 cuda:1
+    # Successive halving early stopping needs at least eta models per rung, i.e. a sweep: stop the trials that fall 
+    # behind at epochs 5, 15, 45... (shape bias and downstream accuracy)
+    python sweep.py --name asha --random 60 --space model=vit,resnet18 lr=log:1e-4:1e-2 --epochs 100 --asha-eta 3 --asha-min-epochs 5
+
+# Results of all runs, appended to scores/results.sqlite
+    store = ResultsStore()
+    store.table(run=store.runs()[-1]) # last run, as returned by main
+    store.query(metric='shape_bias').groupby(['run', 'model'])['value'].max()
+    store.plot(['shape_bias', 'down'], run=[run for run in store.runs() if run.startswith('sparse_eval')], save_path=os.path.join('scores', 'sparse_eval.png'))
+
 
 # Integrate Checkpoints?
 
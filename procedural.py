@@ -0,0 +1,311 @@
+import copy
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+from PIL import Image
+
+'''
+Procedural pretraining images, generated on the fly instead of read from data/noise.
+Every image only depends on (seed, epoch, index), so a dataset is reproducible whatever the loader workers.
+'''
+
+PROCEDURAL_FAMILIES = [
+    'dead_leaves-squares',
+    'dead_leaves-oriented',
+    'dead_leaves-mixed',
+    'stat-spectrum',
+    'stat-spectrum_color',
+]
+
+def power_law_radii(rng, n, r_min, r_max, alpha=3.):
+    '''
+    n radii of density r^-alpha on [r_min, r_max], by inverse transform sampling.
+    '''
+    u = rng.random(n)
+    a, b = r_min ** (1 - alpha), r_max ** (1 - alpha)
+    return (a + u * (b - a)) ** (1 / (1 - alpha))
+
+def dead_leaves(rng, size=64, shape='squares', r_min=0.02, r_max=0.5, chunk=128, max_shapes=4096):
+    '''
+    Dead leaves image: shapes of power-law sizes and random colors occluding each other.
+    Shapes are drawn front to back by chunks, a chunk is rasterized at once with broadcasting
+    and only fills the pixels not yet covered, until the image is covered.
+
+    shape: 'squares' (axis aligned), 'oriented' (rotated rectangles) or 'mixed' (rotated rectangles and disks)
+    r_min, r_max: range of the shape radii, relative to size
+    '''
+    ys, xs = np.mgrid[0:size, 0:size].astype(np.float32).reshape(2, -1) + 0.5
+    img = np.zeros((size * size, 3), dtype=np.uint8)
+    todo = np.arange(size * size) # flat indices of the uncovered pixels
+
+    for _ in range(0, max_shapes, chunk):
+        r = power_law_radii(rng, chunk, r_min * size, r_max * size).astype(np.float32)[:, None]
+        cx, cy = (rng.random((2, chunk, 1)) * size).astype(np.float32)
+        colors = rng.integers(0, 256, (chunk, 3), dtype=np.uint8)
+        # (chunk, nb uncovered pixels), shrinks as the image gets covered
+        dx, dy = xs[todo] - cx, ys[todo] - cy
+
+        if shape == 'squares':
+            inside = (np.abs(dx) < r) & (np.abs(dy) < r)
+        else:
+            theta = (rng.random((chunk, 1)) * np.pi).astype(np.float32)
+            aspect = (rng.random((chunk, 1)) * 0.8 + 0.2).astype(np.float32)
+            u = dx * np.cos(theta) + dy * np.sin(theta)
+            v = -dx * np.sin(theta) + dy * np.cos(theta)
+            inside = (np.abs(u) < r) & (np.abs(v) < r * aspect)
+            if shape == 'mixed':
+                disk = rng.random(chunk) < 0.5
+                inside[disk] = (dx[disk] ** 2 + dy[disk] ** 2) < r[disk] ** 2
+
+        hit = inside.any(axis=0)
+        # Front-most shape of the chunk covering each newly covered pixel
+        img[todo[hit]] = colors[inside[:, hit].argmax(axis=0)]
+        todo = todo[~hit]
+        if len(todo) == 0:
+            break
+
+    img[todo] = rng.integers(0, 256, 3, dtype=np.uint8) # background, if shapes ran out
+    return img.reshape(size, size, 3)
+
+def spectrum_noise(rng, size=64, color=False, slope_range=(0.5, 3.5)):
+    '''
+    Gaussian noise with a random 1/f^slope amplitude spectrum, as in the stat-spectrum families.
+    Grayscale (one channel repeated three times), or with color=True three channels sharing the slope,
+    mixed with a random color matrix.
+    '''
+    slope = rng.uniform(*slope_range)
+    fy = np.fft.fftfreq(size)[:, None]
+    fx = np.fft.rfftfreq(size)[None, :]
+    f = np.sqrt(fx ** 2 + fy ** 2)
+    f[0, 0] = 1. / size # avoid the division by 0, the mean is reset below anyway
+    amplitude = f ** -slope
+
+    phase = np.fft.rfft2(rng.standard_normal((3 if color else 1, size, size)))
+    img = np.fft.irfft2(phase * amplitude, s=(size, size))
+    if color:
+        img = np.einsum('ij,jhw->ihw', rng.standard_normal((3, 3)), img)
+
+    # Per channel standardization, then map +-2 std to [0, 255]
+    img = (img - img.mean(axis=(1, 2), keepdims=True)) / (img.std(axis=(1, 2), keepdims=True) + 1e-8)
+    img = np.repeat(img, 3 // len(img), axis=0)
+    return (np.clip(img * 0.25 + 0.5, 0, 1) * 255).astype(np.uint8).transpose(1, 2, 0)
+
+def generate_noise(family, rng, size=64):
+    '''
+    One image of a procedural family, as an (size, size, 3) uint8 array.
+    '''
+    kind, variant = family.split('-')
+    if kind == 'dead_leaves':
+        return dead_leaves(rng, size=size, shape=variant)
+    elif kind == 'stat':
+        return spectrum_noise(rng, size=size, color=variant == 'spectrum_color')
+    raise ValueError('Unknown procedural family: {}, available: {}'.format(family, PROCEDURAL_FAMILIES))
+
+class ProceduralNoiseDataset(torch.utils.data.Dataset):
+    '''
+    Drop-in for Dataset_no_label on noise images, generating them instead of reading them.
+    Index idx is an image of families[idx % len(families)], seeded with (seed, epoch, idx): set_epoch draws new
+    images every epoch. The epoch is held in shared memory, so persistent loader workers see it.
+    Pass it as load_data(dataset='noise', noise_path=ProceduralNoiseDataset(...)), load_data sets its transforms
+    and gives the validation split a fixed_copy().
+    '''
+    def __init__(self, families=PROCEDURAL_FAMILIES, size=105000, img_size=64, seed=42, transforms=None):
+        for family in families:
+            assert family in PROCEDURAL_FAMILIES, 'Unknown procedural family: {}'.format(family)
+        self.families = list(families)
+        self.size = size
+        self.img_size = img_size
+        self.seed = seed
+        self.transforms = transforms
+        self.epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    def __len__(self):
+        return self.size
+
+    def set_epoch(self, epoch):
+        self.epoch[0] = epoch
+
+    def fixed_copy(self):
+        '''
+        Copy with its own epoch, left at 0: the same images every epoch, e.g. for a validation split.
+        '''
+        dataset = copy.copy(self)
+        dataset.epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+        return dataset
+
+    def __getitem__(self, idx):
+        rng = np.random.default_rng([self.seed, int(self.epoch[0]), idx])
+        img = Image.fromarray(generate_noise(self.families[idx % len(self.families)], rng, self.img_size))
+        return self.transforms(img) if self.transforms is not None else img # no labels for this dataset
+
+
+'''
+FractalDB-style fractals: a category is an iterated function system (IFS) of 2 to 4 affine maps,
+its instances perturb one parameter of the system, images are rendered with the chaos game.
+'''
+
+FRACTAL_PARAMS_PATH = os.path.join("data", "fractal_ifs.npz")
+
+def render_ifs(maps, choices, starts, size=64):
+    '''
+    Render a batch of IFS point clouds at once with the chaos game.
+
+    maps: (B, K, 2, 3) affine maps [A | t]
+    choices: (B, T, P) long map index of each of the P chains at each of the T steps
+    starts: (B, P, 2) starting points of the chains
+    Returns (B, size, size) uint8 images, 255 where points of the attractor fell.
+    The first steps are a burn-in, the chains have not reached the attractor yet.
+    '''
+    B, T, P = choices.shape
+    batch = torch.arange(B, device=maps.device)[:, None]
+    burn_in = min(16, T // 4)
+
+    pts, cloud = starts, []
+    for t in range(T):
+        m = maps[batch, choices[:, t]] # (B, P, 2, 3)
+        pts = (m[..., :2] @ pts.unsqueeze(-1)).squeeze(-1) + m[..., 2]
+        if t >= burn_in:
+            cloud.append(pts)
+    cloud = torch.cat(cloud, dim=1) # (B, N, 2)
+
+    # Fit each cloud in the image, keeping its aspect ratio
+    low, high = cloud.amin(dim=1, keepdim=True), cloud.amax(dim=1, keepdim=True)
+    scale = (high - low).amax(dim=2, keepdim=True).clamp(min=1e-8)
+    xy = ((cloud - low) / scale * (size - 1)).round().long().clamp(0, size - 1)
+
+    # Rasterize all clouds with one scatter-add on the flattened batch of images
+    flat = (batch * size + xy[..., 1]) * size + xy[..., 0]
+    counts = torch.zeros(B * size * size, device=maps.device)
+    counts.index_add_(0, flat.flatten(), torch.ones(flat.numel(), device=maps.device))
+
+    return ((counts > 0).to(torch.uint8) * 255).view(B, size, size)
+
+def chaos_game_draws(rng, probs, nb_steps=64, nb_chains=1024):
+    '''
+    Random draws of one render: map choices (nb_steps, nb_chains) and starting points (nb_chains, 2).
+    '''
+    choices = rng.choice(len(probs), size=(nb_steps, nb_chains), p=probs)
+    return choices, rng.random((nb_chains, 2)) * 2 - 1
+
+def fill_rate(imgs):
+    '''
+    Ratio of pixels covered by the fractal, FractalDB's criterion for a valid category.
+    '''
+    return (imgs > 0).flatten(1).float().mean(dim=1)
+
+def search_ifs_categories(nb_categories, seed=42, max_maps=4, min_fill=0.2, size=64, batch_size=256, device='cpu'):
+    '''
+    FractalDB category search: draw random IFS (parameters in [-1, 1], contractive maps only, 
+    probabilities proportional to |det A|) and keep the ones whose render fills at least min_fill of the image.
+    Returns maps (C, max_maps, 2, 3) and probs (C, max_maps) as numpy arrays.
+    '''
+    rng = np.random.default_rng(seed)
+    kept_maps, kept_probs = [], []
+    while len(kept_maps) < nb_categories:
+        nb_maps = rng.integers(2, max_maps + 1, batch_size)
+        maps = rng.uniform(-1, 1, (batch_size, max_maps, 2, 3))
+        contractive = np.linalg.norm(maps[..., :2], ord=2, axis=(2, 3)) < 1
+        used = np.arange(max_maps)[None] < nb_maps[:, None]
+        valid = (contractive | ~used).all(axis=1)
+
+        probs = np.abs(np.linalg.det(maps[..., :2])) * used
+        probs = probs / probs.sum(axis=1, keepdims=True)
+        maps, probs = maps[valid], probs[valid]
+
+        draws = [chaos_game_draws(rng, p) for p in probs]
+        imgs = render_ifs(torch.tensor(maps, dtype=torch.float32, device=device),
+                          torch.tensor(np.stack([d[0] for d in draws]), device=device),
+                          torch.tensor(np.stack([d[1] for d in draws]), dtype=torch.float32, device=device), size=size)
+        keep = (fill_rate(imgs) >= min_fill).cpu().numpy()
+        kept_maps += list(maps[keep])
+        kept_probs += list(probs[keep])
+
+    return np.stack(kept_maps[:nb_categories]), np.stack(kept_probs[:nb_categories])
+
+def save_ifs_params(path, maps, probs):
+    np.savez(path, maps=maps, probs=probs)
+
+def load_ifs_params(path=FRACTAL_PARAMS_PATH):
+    params = np.load(path)
+    return params['maps'], params['probs']
+
+class FractalDataset(torch.utils.data.Dataset):
+    '''
+    FractalDB-style images rendered on demand from IFS parameters, drop-in for Dataset_no_label on FractalDB files.
+    Index idx is instance idx % nb_instances of category idx // nb_instances: instance 0 is the category's
+    IFS, the others scale one of its parameters by a weight in [0.8, 1.2]. Everything is seeded with (seed, idx).
+    Pass it as load_data(dataset='fractal', fractal_path=FractalDataset(...)), load_data sets its transforms and
+    calls prerender() if there is no valid cache yet, items are only rendered one by one outside load_data.
+
+    cache_path: .npy file of all renders (held in memory if None), written by prerender() and then read instead of
+    rendering. Its settings (IFS parameters, nb_instances, img_size, seed, nb_steps, nb_chains) are saved next to it
+    (<cache_path>.json), a cache of other settings is not used (prerender() overwrites it).
+    '''
+    def __init__(self, params_path=FRACTAL_PARAMS_PATH, nb_instances=1000, img_size=64, seed=42, 
+                 nb_steps=64, nb_chains=1024, cache_path=None, transforms=None):
+        self.maps, self.probs = load_ifs_params(params_path)
+        self.nb_instances = nb_instances
+        self.img_size = img_size
+        self.seed = seed
+        self.nb_steps = nb_steps
+        self.nb_chains = nb_chains
+        self.cache_path = cache_path
+        self.transforms = transforms
+        self.signature = {'params': hashlib.sha1(self.maps.tobytes() + self.probs.tobytes()).hexdigest(), 'nb_instances': nb_instances,
+                          'img_size': img_size, 'seed': seed, 'nb_steps': nb_steps, 'nb_chains': nb_chains}
+        self.cache = None
+        if cache_path is not None and os.path.exists(cache_path + '.json'):
+            with open(cache_path + '.json') as f:
+                if json.load(f) == self.signature:
+                    self.cache = np.load(cache_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.maps) * self.nb_instances
+
+    def instance(self, idx):
+        '''
+        IFS of image idx and the random draws to render it.
+        '''
+        rng = np.random.default_rng([self.seed, idx])
+        category, instance = divmod(idx, self.nb_instances)
+        maps, probs = self.maps[category].copy(), self.probs[category]
+        if instance > 0:
+            used = np.flatnonzero(probs)
+            maps[rng.choice(used), rng.integers(2), rng.integers(3)] *= rng.uniform(0.8, 1.2)
+        choices, starts = chaos_game_draws(rng, probs, self.nb_steps, self.nb_chains)
+        return maps, choices, starts
+
+    def render(self, indices, device='cpu'):
+        '''
+        Render the images of indices as one batch, (len(indices), img_size, img_size) uint8.
+        '''
+        maps, choices, starts = zip(*[self.instance(idx) for idx in indices])
+        return render_ifs(torch.tensor(np.stack(maps), dtype=torch.float32, device=device),
+                          torch.tensor(np.stack(choices), device=device),
+                          torch.tensor(np.stack(starts), dtype=torch.float32, device=device), size=self.img_size).cpu().numpy()
+
+    def prerender(self, batch_size=256, device='cpu'):
+        '''
+        Render every image by batches into cache_path (in memory if None) and use it from then on.
+        '''
+        if self.cache_path is not None:
+            if os.path.exists(self.cache_path + '.json'): # incomplete until the settings are written again
+                os.remove(self.cache_path + '.json')
+            cache = np.lib.format.open_memmap(self.cache_path, mode='w+', dtype=np.uint8, shape=(len(self), self.img_size, self.img_size))
+        else:
+            cache = np.empty((len(self), self.img_size, self.img_size), dtype=np.uint8)
+        for start in range(0, len(self), batch_size):
+            cache[start:start + batch_size] = self.render(range(start, min(start + batch_size, len(self))), device)
+        if self.cache_path is not None:
+            cache.flush()
+            # Written last, marks the cache as complete
+            with open(self.cache_path + '.json', 'w') as f:
+                json.dump(self.signature, f)
+        self.cache = cache
+
+    def __getitem__(self, idx):
+        img = self.cache[idx] if self.cache is not None else self.render([idx])[0]
+        img = Image.fromarray(np.asarray(img)).convert('RGB')
+        return self.transforms(img) if self.transforms is not None else img # no labels for this dataset
@@ -273,38 +273,42 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def _forward_impl(self, x: Tensor, return_embed=False, return_intermediate=False) -> Tensor:
+    def _forward_impl(self, x: Tensor, return_embed=False, return_intermediate=False, return_both=False) -> Tensor:
         intermediate_acts = []
+        # Activations are only copied to the host when requested
+        keep = (lambda t: intermediate_acts.append(t.detach().cpu())) if return_intermediate else (lambda t: None)
         # See note [TorchScript super()]
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
         x = self.maxpool(x)
-        intermediate_acts.append(x.detach().cpu())
+        keep(x)
 
         x = self.layer1(x)
-        intermediate_acts.append(x.detach().cpu())
+        keep(x)
         x = self.layer2(x)
-        intermediate_acts.append(x.detach().cpu())
+        keep(x)
         x = self.layer3(x)
-        intermediate_acts.append(x.detach().cpu())
+        keep(x)
         x = self.layer4(x)
-        intermediate_acts.append(x.detach().cpu())
+        keep(x)
 
         x = self.avgpool(x)
         x = torch.flatten(x, 1)
         if return_embed:
             return x
+        if return_both:
+            return x, self.fc(x)
         x = self.fc(x)
-        intermediate_acts.append(x.detach().cpu())
+        keep(x)
 
         if return_intermediate:
             return x, intermediate_acts
 
         return x
 
-    def forward(self, x: Tensor, return_embed=False, return_intermediate=False) -> Tensor:
-        return self._forward_impl(x, return_embed=return_embed, return_intermediate=return_intermediate)
+    def forward(self, x: Tensor, return_embed=False, return_intermediate=False, return_both=False) -> Tensor:
+        return self._forward_impl(x, return_embed=return_embed, return_intermediate=return_intermediate, return_both=return_both)
 
 
 def _resnet(
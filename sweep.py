@@ -0,0 +1,223 @@
+'''
+Sweeps of main() over models, pretext settings and augmentations, the trials run in a local process pool.
+
+    python sweep.py --name lr_sal --grid model=vit,resnet18 pre_type=supervised,contrastive lr=0.001,0.0003 --devices cuda:0 cuda:1
+    python sweep.py --name rdm --random 20 --space model=vit,resnet18 lr=log:1e-4:1e-2 saliency_weight=0,0.5,1 --devices cuda:0 --per-device 2
+    python sweep.py --name noise --grid pre_dataset=noise noise=stylegan-oriented,stylegan-oriented+feature_vis-random
+    python sweep.py --name asha --random 60 --space model=vit,resnet18 lr=log:1e-4:1e-2 --epochs 100 --asha-eta 3 --asha-min-epochs 5
+
+Space keys: model (vit, resnet18, resnet50), pre_type, pre_dataset, aug_pre, noise (families joined by +),
+saliency_weight (0: no saliency guidance) and lr. Values are comma-separated choices, or for --random,
+log:low:high / uniform:low:high ranges. Each trial calls main() on one model, on a device of --devices,
+and appends its results to the shared results store (--results) as run <name>_<start time>/<trial>, trial
+parameters are added to out/<name>/trials.json (see load_trials). Dataset caches (downloads, noise manifests, tensor
+stores, reduced images) are built once by the parent before the trials start, the trials only read them.
+With --asha-eta, trials falling behind the others of the sweep at a rung are stopped (utils.SuccessiveHalving),
+and their pool slot goes to the next trial, so many trials can be started for the cost of a few full ones.
+'''
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import torch
+
+from utils import SuccessiveHalving
+
+SPACE_KEYS = ['model', 'pre_type', 'pre_dataset', 'aug_pre', 'noise', 'saliency_weight', 'lr']
+DEFAULTS = {'model': 'vit', 'pre_type': 'supervised', 'pre_dataset': 'CIFAR10', 'aug_pre': False, 'noise': None,
+            'saliency_weight': 0, 'lr': 0.001}
+
+def _parse_value(value):
+    if value.lower() in ['true', 'false']:
+        return value.lower() == 'true'
+    for cast in [int, float]:
+        try: return cast(value)
+        except ValueError: pass
+    return value
+
+def parse_space(items):
+    '''
+    key=v1,v2,... items to a dict of key: list of choices, or key: (scale, low, high) for log:/uniform: ranges.
+    '''
+    space = {}
+    for item in items:
+        key, _, values = item.partition('=')
+        assert key in SPACE_KEYS, 'Unknown sweep parameter {}, choose from {}'.format(key, SPACE_KEYS)
+        if values.split(':')[0] in ['log', 'uniform']:
+            scale, low, high = values.split(':')
+            space[key] = (scale, float(low), float(high))
+        else:
+            space[key] = [_parse_value(value) for value in values.split(',')]
+    return space
+
+def grid_trials(space):
+    for key, values in space.items():
+        assert isinstance(values, list), 'Ranges ({}) need a random sweep'.format(key)
+    keys = list(space)
+    return [dict(DEFAULTS, **dict(zip(keys, values))) for values in itertools.product(*[space[key] for key in keys])]
+
+def random_trials(space, nb_trials, seed=0):
+    rng = np.random.default_rng(seed)
+    trials = []
+    for _ in range(nb_trials):
+        params = dict(DEFAULTS)
+        for key, values in space.items():
+            if isinstance(values, list):
+                params[key] = values[rng.integers(len(values))]
+            elif values[0] == 'log':
+                params[key] = float(np.exp(rng.uniform(np.log(values[1]), np.log(values[2]))))
+            else:
+                params[key] = float(rng.uniform(values[1], values[2]))
+        trials.append(params)
+    return trials
+
+def trial_name(idx, params):
+    return '{:03d}_{}'.format(idx, params['model'])
+
+def load_trials(name):
+    '''
+    Parameters of the trials of all the runs of sweep name, indexed by their run in the results store.
+    '''
+    with open(os.path.join('out', name, 'trials.json')) as f:
+        return pd.DataFrame.from_dict(json.load(f), orient='index')
+
+def build_model(name, nb_classes=10):
+    from sot_torchvision_models import resnet18, resnet50
+    from sot_modif_resnet import modify_resnet_model
+    from vit_models import ViT
+    if name == 'vit':
+        return ViT(hidden=512, mlp_hidden=512*4, img_size=32, patch=8)
+    elif name == 'resnet18':
+        return modify_resnet_model(resnet18(num_classes=nb_classes))
+    elif name == 'resnet50':
+        return modify_resnet_model(resnet50(num_classes=nb_classes))
+    raise ValueError('Unknown model: {}'.format(name))
+
+def pre_data_kwargs(params):
+    # load_data arguments of the pretext loaders of a trial
+    from data import load_noise
+    kwargs = {}
+    if params['pre_type'] == 'contrastive':
+        kwargs['n_views'] = 2
+    if params['pre_dataset'] == 'noise':
+        families = params['noise'].split('+') if params['noise'] else []
+        kwargs.update(noise_path=load_noise(*families), resize_image=False, shuffle_noise=True)
+    return kwargs
+
+def warm_caches(trials, down_dataset='CIFAR10'):
+    '''
+    Build the dataset caches the trials read (downloads, noise manifests, the downstream tensor store) once.
+    '''
+    from data import load_data
+    done = set()
+    for params in trials:
+        key = (params['pre_dataset'], params['pre_type'], params['aug_pre'], params['noise'])
+        if key in done: continue
+        load_data(dataset=params['pre_dataset'], stage='pre', aug=params['aug_pre'], **pre_data_kwargs(params))
+        done.add(key)
+    load_data(dataset=down_dataset, stage='down', tensor_store=True)
+
+_DEVICE = None
+
+def _init_worker(devices, nb_threads):
+    # One device per pool process, for all the trials it runs
+    global _DEVICE
+    _DEVICE = devices.get()
+    torch.set_num_threads(nb_threads)
+
+def run_trial(name, run_id, params, settings):
+    '''
+    Train and evaluate the model of a trial with main(), on the device of this pool process.
+    Returns the run and its last score of each metric, or the error if the trial failed.
+    '''
+    from main import main
+    try:
+        for folder in ['scores', 'model']:
+            os.makedirs(folder, exist_ok=True)
+        score_table = main(models2compare=[build_model(params['model'])], modelnames=[run_id.split('/')[-1]], experiment_id=name, run_id=run_id,
+                           pre_type=params['pre_type'], pre_dataset=params['pre_dataset'], aug_pre=params['aug_pre'],
+                           pre_lr=params['lr'], saliency=params['saliency_weight'] > 0, saliency_weight=params['saliency_weight'],
+                           pre_data_kwargs=pre_data_kwargs(params), device=_DEVICE, **settings)
+        return run_id, score_table.ffill().iloc[-1].to_dict(), None
+    except Exception:
+        return run_id, {}, traceback.format_exc()
+
+def run_sweep(name, trials, devices, per_device=1, settings=None, trial_fn=run_trial):
+    '''
+    Run trial_fn(name, run_id, params, settings) for each trial in a pool of per_device processes per device.
+    Runs are prefixed with the sweep start time, so running a sweep again does not mix its rows with the previous ones.
+    Returns {run_id: (scores, error)}.
+    '''
+    os.makedirs(os.path.join('out', name), exist_ok=True)
+    prefix = '{}_{}'.format(name, time.strftime('%Y-%m-%d-%H-%M-%S'))
+    runs = {'{}/{}'.format(prefix, trial_name(idx, params)): params for idx, params in enumerate(trials)}
+    trials_path = os.path.join('out', name, 'trials.json')
+    previous = {}
+    if os.path.exists(trials_path):
+        with open(trials_path) as f:
+            previous = json.load(f)
+    with open(trials_path, 'w') as f:
+        json.dump(dict(previous, **runs), f, indent=2)
+
+    ctx = multiprocessing.get_context('spawn') # cuda can not be used in forked processes
+    slots = ctx.Queue()
+    for device in devices:
+        for _ in range(per_device): slots.put(device)
+    nb_workers = len(devices) * per_device
+    nb_threads = max(1, (os.cpu_count() or 1) // nb_workers)
+
+    finished = {}
+    with ProcessPoolExecutor(max_workers=nb_workers, mp_context=ctx, initializer=_init_worker, initargs=(slots, nb_threads)) as pool:
+        futures = [pool.submit(trial_fn, name, run_id, params, settings or {}) for run_id, params in runs.items()]
+        for future in as_completed(futures):
+            run_id, scores, error = future.result()
+            finished[run_id] = (scores, error)
+            status = 'failed:\n' + error if error else ', '.join('{}: {:.3f}'.format(k, v) for k, v in scores.items())
+            print(time.strftime('%Y-%m-%d-%H-%M') + ' - [{}/{}] {} {}'.format(len(finished), len(runs), run_id, status))
+    return finished
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep main() over models, pretext settings and augmentations')
+    parser.add_argument('--name', required=True, help='sweep name: runs <name>_<start time>/<trial> in the results store, wandb project')
+    parser.add_argument('--grid', nargs='*', default=None, metavar='KEY=VALUES')
+    parser.add_argument('--random', type=int, default=None, metavar='NB_TRIALS', help='sample trials from the space of --space')
+    parser.add_argument('--space', nargs='*', default=[], metavar='KEY=VALUES')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--devices', nargs='+', default=['cuda:%d' % i for i in range(torch.cuda.device_count())] or ['cpu'])
+    parser.add_argument('--per-device', type=int, default=1, help='trials run at the same time on each device')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--test-interval', type=int, default=5)
+    parser.add_argument('--down-dataset', default='CIFAR10')
+    parser.add_argument('--finetune', action='store_true')
+    parser.add_argument('--backends', nargs='+', default=['jsonl'], help='metrics backends of the trials, see utils.MetricsSink')
+    parser.add_argument('--results', default=os.path.join('scores', 'results.sqlite'))
+    parser.add_argument('--asha-eta', type=int, default=None, help='successive halving early stopping, keeping the top 1/eta at each rung')
+    parser.add_argument('--asha-min-epochs', type=int, default=5, help='first rung, next ones at min_epochs * eta^k')
+    parser.add_argument('--asha-weights', nargs='*', default=['shape_bias=1', 'down=0.01'], metavar='METRIC=WEIGHT',
+                        help='rung score, weighted sum of the last metric values')
+    args = parser.parse_args()
+
+    assert (args.grid is None) != (args.random is None), 'Choose one of --grid and --random'
+    if args.grid is not None:
+        trials = grid_trials(parse_space(args.grid))
+    else:
+        trials = random_trials(parse_space(args.space), args.random, seed=args.seed)
+
+    print('{} trials on {}'.format(len(trials), ', '.join(args.devices)))
+    warm_caches(trials, down_dataset=args.down_dataset)
+    settings = dict(train_epochs=args.epochs, test_interval=args.test_interval, down_dataset=args.down_dataset, finetune=args.finetune,
+                    metrics_backends=tuple(args.backends), results_path=args.results)
+    if args.asha_eta is not None:
+        weights = {metric: float(weight) for metric, weight in (item.split('=') for item in args.asha_weights)}
+        settings['early_stopping'] = SuccessiveHalving(args.results, weights=weights, # trials compared within this sweep run
+                                                       min_epochs=args.asha_min_epochs, eta=args.asha_eta, max_epochs=args.epochs)
+    finished = run_sweep(args.name, trials, args.devices, per_device=args.per_device, settings=settings)
+    print('{} trials failed'.format(sum(error is not None for _, error in finished.values())))
@@ -1,12 +1,20 @@
 import logging
+import logging.handlers
 import os
-import openpyxl
+import sqlite3
+import contextlib
 
 import time
+import json
+import queue
+import atexit
+import threading
+from contextlib import contextmanager
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 def create_logger(experiment_id: str) -> logging.Logger:
     """ 
@@ -27,13 +35,176 @@ def create_logger(experiment_id: str) -> logging.Logger:
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
     
+    # Already set up by a previous call (the file and console handlers are behind the queue)
+    if any(isinstance(handler, logging.handlers.QueueHandler) for handler in logger.handlers):
+        return logger
+
     # only add a stream handler if there isn't already one
     if len(logger.handlers) == 1: # <-- file handler is the existing handler
         console = logging.StreamHandler()
         logger.addHandler(console)
 
+    # Handlers write from a background thread, a log call only queues the record
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+
     return logger
 
+class WandbBackend(object):
+    def write(self, records):
+        import wandb
+        for record in records:
+            record = {key: value for key, value in record.items() if key != 'time'}
+            wandb.log(record, step=record.pop('step', None))
+
+    def close(self):
+        pass
+
+class JsonlBackend(object):
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a')
+
+    def write(self, records):
+        self.file.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ParquetBackend(object):
+    # One part file per flush, read back with pd.read_parquet(path)
+    def __init__(self, path):
+        try: import pyarrow
+        except ImportError: raise ImportError('The parquet metrics backend requires pyarrow (pip install pyarrow)')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.nb_parts = len([f for f in os.listdir(path) if f.endswith('.parquet')])
+
+    def write(self, records):
+        pd.DataFrame(records).to_parquet(os.path.join(self.path, 'part-%05d.parquet' % self.nb_parts))
+        self.nb_parts += 1
+
+    def close(self):
+        pass
+
+class NullBackend(object):
+    def write(self, records):
+        pass
+
+    def close(self):
+        pass
+
+def _to_python(value):
+    # Device tensors are read here, in the sink thread, not in the training loop
+    if torch.is_tensor(value):
+        value = value.detach()
+        return value.item() if value.numel() == 1 else value.cpu().tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+class MetricsSink(object):
+    """
+    Metrics logger that never blocks the caller: log() only queues the record, and a background thread
+    writes the queued records in batches (batch_size records or every flush_interval seconds) to the backends.
+
+    backends: 'wandb' (needs wandb.init, mode='offline' to run without network), 'jsonl' (path.jsonl),
+    'parquet' (part files in the path directory, needs pyarrow) and 'none' (drop everything, for benchmarks).
+    Values may be device tensors, they are only copied to the host by the sink thread. Each record gets a
+    'time' (seconds since epoch) and, if given, a 'step'. A failing backend is reported once and dropped.
+    """
+    BACKENDS = ['wandb', 'jsonl', 'parquet', 'none']
+    _FLUSH, _STOP = object(), object()
+
+    def __init__(self, backends=('wandb',), path=None, batch_size=256, flush_interval=5.):
+        for backend in backends:
+            assert backend in self.BACKENDS, 'Unknown backend {}, choose from {}'.format(backend, self.BACKENDS)
+        assert path is not None or not {'jsonl', 'parquet'} & set(backends), 'Provide a path for the jsonl and parquet backends'
+        self.backends = {}
+        for backend in backends:
+            if backend == 'wandb': self.backends[backend] = WandbBackend()
+            elif backend == 'jsonl': self.backends[backend] = JsonlBackend(path + '.jsonl')
+            elif backend == 'parquet': self.backends[backend] = ParquetBackend(path)
+            else: self.backends[backend] = NullBackend()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.closed = False
+        atexit.register(self.close)
+
+    def log(self, metrics, step=None):
+        record = dict(metrics, time=time.time())
+        if step is not None: record['step'] = step
+        self.queue.put(record)
+
+    def _write(self, records):
+        records = [{key: _to_python(value) for key, value in record.items()} for record in records]
+        for name, backend in list(self.backends.items()):
+            try:
+                backend.write(records)
+            except Exception as e:
+                logging.getLogger().warning('Metrics backend {} failed, disabled: {}'.format(name, e))
+                del self.backends[name]
+
+    def _run(self):
+        records, nb_items, last_write = [], 0, time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=max(self.flush_interval - (time.time() - last_write), 0.01))
+                nb_items += 1
+            except queue.Empty:
+                item = None
+            if item is not None and item is not self._FLUSH and item is not self._STOP:
+                records.append(item)
+            if item in (self._FLUSH, self._STOP) or len(records) >= self.batch_size or time.time() - last_write >= self.flush_interval:
+                if records: self._write(records)
+                records, last_write = [], time.time()
+                for _ in range(nb_items): self.queue.task_done()
+                nb_items = 0
+            if item is self._STOP:
+                return
+
+    def flush(self):
+        """
+        Block until every record logged so far is written.
+        """
+        self.queue.put(self._FLUSH)
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.queue.put(self._STOP)
+        self.thread.join()
+        for backend in self.backends.values():
+            backend.close()
+        self.closed = True
+
+_metrics_sink = None
+
+def set_metrics_sink(sink):
+    """
+    Route log_metrics to sink (None: direct wandb.log calls, the default). Returns the previous sink.
+    """
+    global _metrics_sink
+    previous, _metrics_sink = _metrics_sink, sink
+    return previous
+
+def log_metrics(metrics, step=None):
+    if _metrics_sink is not None:
+        _metrics_sink.log(metrics, step=step)
+        return
+    import wandb
+    wandb.log({key: _to_python(value) for key, value in metrics.items()}, step=step)
+
 def norm_calc(tens=torch.tensor, type='euclidian', div=int):
 
     if type == 'manhattan':
@@ -46,113 +217,439 @@ def norm_calc(tens=torch.tensor, type='euclidian', div=int):
     
     return torch.sum(up_mat) / div
 
-def find_overlap(l1:list, l2:list):
-    overlap = 0
-    cursor = 0
-    for i in range(len(l1)):
-        while cursor < len(l2):
-            if l1[i] == l2[cursor]:
-                overlap += 1
-                cursor += 1
-                break
-            if l1[i] < l2[cursor]:
-                break
-            cursor += 1
+def cosine_pdist_sum(h=torch.tensor):
+    """
+    Sum of pairwise cosine distances, equal to np.sum(pdist(h, metric='cosine')) but computed on h's device.
+
+    h of shape (N, D) or (G, N, D), in which case the sums of the G groups are added together.
+    Uses sum_{i<j} (1 - u_i.u_j) = (N^2 - ||sum_i u_i||^2) / 2 with u the normalized rows,
+    so the N x N distance matrix is never materialized. Returns a 0-dim tensor, no device sync.
+    """
+    u = F.normalize(h.detach().double(), dim=-1)
+    n = u.shape[-2]
+    s = u.sum(dim=-2)
+
+    return torch.sum(n * n - (s * s).sum(dim=-1)) / 2
+
+class MetricsAccumulator(object):
+    """
+    Running sums of per-batch metrics (correct predictions, losses, distances...) kept as device tensors.
+
+    Values are detached before being added, so no autograd graph is held, and nothing is
+    copied to the host until a value is read with get(), i.e. at log intervals and epoch end.
+    """
+    def __init__(self, device='cuda:0'):
+        self.device = device
+        self.totals = {}
+
+    def add(self, name, value):
+        if torch.is_tensor(value):
+            value = value.detach().to(device=self.device, dtype=torch.float64)
+        if name not in self.totals:
+            self.totals[name] = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.totals[name] += value
+
+    def get(self, name):
+        # Single device sync per read
+        if name not in self.totals:
+            return 0.
+        return self.totals[name].item()
+
+    def reset(self):
+        self.totals = {}
+
+def _batch_size(batch):
+    # First tensor of a (possibly nested) batch: inputs, views list, (im_x, im_y)...
+    while isinstance(batch, (list, tuple)) and len(batch) > 0:
+        batch = batch[0]
+    return len(batch) if torch.is_tensor(batch) else 0
+
+class StageTimer(object):
+    """
+    Wall time of named stages, with the data-wait vs compute split of the loops run inside them.
+
+    Wrap a stage with `with timer.stage(name):` and its loader with `timed(loader, timer)`: time spent
+    waiting for the next batch is data wait, the rest of the stage is compute. On cuda the device is
+    synchronized when a stage ends (and after every step if step_sync), so queued kernels are counted.
+    profile_steps > 0 captures that many steps of the first profile_stage loop with torch.profiler.
+    Stages are also recorded as Chrome trace events, written by save_trace (chrome://tracing, Perfetto).
+    """
+    def __init__(self, device='cuda:0', step_sync=False, profile_steps=0, profile_stage='pretext_train', trace_dir=None):
+        self.device = torch.device(device)
+        self.step_sync = step_sync
+        self.profile_steps = profile_steps
+        self.profile_stage = profile_stage
+        self.trace_dir = trace_dir
+        self.origin = time.perf_counter()
+        self.stack = []
+        self.events = []
+        self.totals = {}
+
+    def sync(self):
+        # Current stream only: work queued on other streams (e.g. an EvalWorker's) is not counted in this stage
+        if self.device.type == 'cuda':
+            torch.cuda.current_stream(self.device).synchronize()
+
+    @contextmanager
+    def stage(self, name):
+        self.sync()
+        start = time.perf_counter()
+        self.stack.append(name)
+        try:
+            yield self
+        finally:
+            self.sync()
+            end = time.perf_counter()
+            self.stack.pop()
+            stats = self.totals.setdefault(name, {'wall': 0., 'wait': 0., 'steps': 0, 'samples': 0})
+            stats['wall'] += end - start
+            self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': len(self.stack),
+                                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6})
+
+    def _profiler(self, name):
+        if self.profile_steps <= 0 or name != self.profile_stage:
+            return None, 0
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda': activities.append(torch.profiler.ProfilerActivity.CUDA)
+        trace_dir = self.trace_dir or '.'
+        def export(prof):
+            os.makedirs(trace_dir, exist_ok=True)
+            prof.export_chrome_trace(os.path.join(trace_dir, 'torch_{}.json'.format(name)))
+        prof = torch.profiler.profile(activities=activities, on_trace_ready=export,
+                                      schedule=torch.profiler.schedule(wait=0, warmup=1, active=self.profile_steps, repeat=1))
+        nb_steps, self.profile_steps = 1 + self.profile_steps, 0 # warmup step included, single capture
+        prof.start()
+        return prof, nb_steps
 
-    return overlap
+    def loop(self, iterable):
+        name = self.stack[-1] if self.stack else 'loop'
+        stats = self.totals.setdefault(name, {'wall': 0., 'wait': 0., 'steps': 0, 'samples': 0})
+        prof, nb_profiled = self._profiler(name)
+        it = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try: batch = next(it)
+                except StopIteration: return
+                stats['wait'] += time.perf_counter() - start
+                stats['steps'] += 1
+                stats['samples'] += _batch_size(batch)
+                yield batch
+                if self.step_sync: self.sync()
+                if prof is not None:
+                    prof.step()
+                    nb_profiled -= 1
+                    if nb_profiled == 0:
+                        prof.stop()
+                        prof = None
+        finally:
+            if prof is not None: prof.stop()
+
+    def summary(self):
+        """
+        Per stage: wall time (s), data wait (s), compute (s), steps, samples and throughput (samples/s).
+        """
+        out = {}
+        for name, stats in self.totals.items():
+            wall = stats['wall']
+            out[name] = {'wall': wall, 'data_wait': stats['wait'], 'compute': wall - stats['wait'],
+                         'steps': stats['steps'], 'samples': stats['samples'],
+                         'throughput': stats['samples'] / wall if wall > 0 else 0.}
+        return out
+
+    def log(self, logger=None, epoch=None):
+        """
+        Log the stages timed since the last call, reset the totals and return them flattened for wandb.log.
+        """
+        flat = {}
+        for name, stats in self.summary().items():
+            msg = '{}Stage {}: {:.2f}s'.format('' if epoch is None else '[Epoch %d] ' % (epoch + 1), name, stats['wall'])
+            if stats['steps'] > 0:
+                msg += ', {} steps, {:.1f} samples/s, data wait {:.2f}s ({:.0f}%)'.format(
+                    stats['steps'], stats['throughput'], stats['data_wait'], 100. * stats['data_wait'] / max(stats['wall'], 1e-9))
+            if logger is not None: logger.info(time.strftime('%Y-%m-%d-%H-%M') + ' - ' + msg)
+            flat['time/{}'.format(name)] = stats['wall']
+            flat['data_wait/{}'.format(name)] = stats['data_wait']
+            if stats['steps'] > 0: flat['throughput/{}'.format(name)] = stats['throughput']
+        self.totals = {}
+        return flat
+
+    def save_trace(self, path=None):
+        path = path or os.path.join(self.trace_dir or '.', 'stages.json')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+def timed(iterable, timer=None):
+    """
+    Iterate over a loader, recording the data wait in the current stage of timer (no-op without timer).
+    """
+    if timer is None:
+        return iterable
+    return timer.loop(iterable)
+
+class EvalSchedule(object):
+    """
+    Which evaluation metrics of main() to run at each epoch.
+
+    Metrics: pre (pretext test), bias (Geirhos shape bias), edge_sil (edge and silhouette kNN), down (finetune and
+    downstream test), jigsaw (jigsaw 16/8 tests) and distances (views embedding distances).
+    A metric runs every intervals[metric] epochs (default_interval if not given, never if 0 or None). A metric with a
+    budget instead runs whenever its cumulated eval time stays under budgets[metric] times the cumulated training
+    time, e.g. budgets={'down': 0.1} spends at most ~10% of the training time on the downstream probe.
+    Times come from the StageTimer summaries given to update().
+    """
+    METRIC_STAGES = {
+        'pre': ['test_pre'],
+        'bias': ['bias'],
+        'edge_sil': ['edge', 'sil'],
+        'down': ['finetune', 'test_down'],
+        'jigsaw': ['test_jig16', 'test_jig8'],
+        'distances': ['dist_3_simclr', 'dist_gray', 'dist_hflip', 'dist_rcrop'],
+    }
+    TRAIN_STAGE = 'pretext_train'
+
+    def __init__(self, intervals=None, budgets=None, default_interval=5):
+        intervals, budgets = intervals or {}, budgets or {}
+        unknown = (set(intervals) | set(budgets)) - set(self.METRIC_STAGES)
+        assert not unknown, 'Unknown metrics {}, choose from {}'.format(sorted(unknown), list(self.METRIC_STAGES))
+        self.intervals = {metric: intervals.get(metric, default_interval) for metric in self.METRIC_STAGES}
+        self.budgets = budgets
+        self.train_time = 0.
+        self.spent = {metric: 0. for metric in self.METRIC_STAGES}
+
+    def due(self, epoch):
+        metrics = []
+        for metric, interval in self.intervals.items():
+            if metric in self.budgets:
+                if self.spent[metric] <= self.budgets[metric] * self.train_time: metrics.append(metric)
+            elif interval and epoch % interval == 0:
+                metrics.append(metric)
+        return metrics
+
+    def update(self, summary):
+        self.train_time += summary.get(self.TRAIN_STAGE, {}).get('wall', 0.)
+        for metric, stages in self.METRIC_STAGES.items():
+            self.spent[metric] += sum(summary[stage]['wall'] for stage in stages if stage in summary)
+
+def bias_statistics(shape, texture, pred_shape, pred_texture=None, nb_classes=16):
+    """
+    Shape/texture cue-conflict statistics from integer label arrays, with boolean masks.
+
+    shape, texture: ground truth ids of each image, pred_shape, pred_texture: predicted ids
+    (pred_texture defaults to pred_shape, when a single decision is made per image).
+    Returns a dict with nb_shape, nb_texture, overlap (images that are both a shape and a texture hit),
+    shape_bias, accuracy, and the same counts per category of the image's shape (arrays of nb_classes).
+    """
+    shape, texture = np.asarray(shape), np.asarray(texture)
+    pred_shape = np.asarray(pred_shape)
+    pred_texture = pred_shape if pred_texture is None else np.asarray(pred_texture)
+
+    shape_hit = pred_shape == shape
+    texture_hit = pred_texture == texture
+    both_hit = shape_hit & texture_hit
+
+    nb_shape, nb_texture, overlap = int(shape_hit.sum()), int(texture_hit.sum()), int(both_hit.sum())
+
+    # Per category, same pass over the masks
+    class_shape = np.bincount(shape[shape_hit], minlength=nb_classes)
+    class_texture = np.bincount(shape[texture_hit], minlength=nb_classes)
+    class_overlap = np.bincount(shape[both_hit], minlength=nb_classes)
+    class_total = np.bincount(shape, minlength=nb_classes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        class_bias = class_shape / (class_shape + class_texture)
+        class_acc = (class_shape + class_texture - class_overlap) / class_total
+
+    return {
+        'nb_shape': nb_shape,
+        'nb_texture': nb_texture,
+        'overlap': overlap,
+        'shape_bias': nb_shape / (nb_shape + nb_texture) if nb_shape + nb_texture > 0 else float('nan'),
+        'accuracy': (nb_shape + nb_texture - overlap) / len(shape),
+        'class_nb_shape': class_shape,
+        'class_nb_texture': class_texture,
+        'class_overlap': class_overlap,
+        'class_shape_bias': class_bias,
+        'class_accuracy': class_acc,
+    }
 
 
 def remove_int(s):
     return s.rstrip('0123456789')
 
 
-def visualize(table, models, save=False, pre_data='cifar'):
-    
-    print('\nFirst 5 logged epochs:\n', table.T.head())
-    print('\nLast 5 logged epochs:\n', table.T.tail())
+SCORE_TITLES = {
+    'pre': ('Pretext test accuracy', 'Accuracy (%)'),
+    'shape_bias': ('Shape bias', 'Percentage (%)'),
+    'down': ('Downstream test accuracy', 'Accuracy (%)'),
+    'dist_3_simclr': ('Distance between augmented downstream embedding pairs', 'Distance'),
+}
+
+class ResultsStore(object):
+    """
+    Evaluation results as flat (run, model, epoch, metric, value) rows in a SQLite file, appended as they come.
+
+    Several processes can append to the same file (e.g. the runs of a sweep). query() returns the rows as a
+    DataFrame, table() one column per metric, plot() the metrics over epochs, averaged over the selected runs.
+    """
+    def __init__(self, path=os.path.join('scores', 'results.sqlite')):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS results (run TEXT, model TEXT, epoch INTEGER, metric TEXT, value REAL, time REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS results_run_model ON results (run, model, metric)')
+
+    def _connect(self):
+        return contextlib.closing(sqlite3.connect(self.path, timeout=60))
+
+    def add(self, run, model, epoch, results):
+        """
+        Append the scalar results (dict metric -> value) of a model at an epoch.
+        """
+        now = time.time()
+        rows = [(run, model, int(epoch), metric, float(_to_python(value)), now) for metric, value in results.items()]
+        with self._connect() as db, db:
+            db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def query(self, run=None, model=None, metric=None):
+        """
+        Rows matching the given run, model and metric (a value or a list of values each, None for all).
+        """
+        where, params = [], []
+        for column, values in [('run', run), ('model', model), ('metric', metric)]:
+            if values is None: continue
+            values = [values] if isinstance(values, str) else list(values)
+            where.append('{} IN ({})'.format(column, ', '.join('?' * len(values))))
+            params += values
+        sql = 'SELECT run, model, epoch, metric, value FROM results'
+        if where: sql += ' WHERE ' + ' AND '.join(where)
+        with self._connect() as db:
+            return pd.read_sql_query(sql + ' ORDER BY rowid', db, params=params)
+
+    def runs(self):
+        with self._connect() as db:
+            return [run for run, in db.execute('SELECT DISTINCT run FROM results ORDER BY rowid')]
+
+    def table(self, run=None, model=None, metric=None):
+        """
+        One row per (model, epoch), plus run when run is not a single run, one column per metric (last value logged).
+        """
+        rows = self.query(run, model, metric)
+        index = ['model', 'epoch'] if isinstance(run, str) else ['run', 'model', 'epoch']
+        return rows.pivot_table(index=index, columns='metric', values='value', aggfunc='last')
+
+    def plot(self, metrics, run=None, model=None, save_path=None, show=True):
+        """
+        One panel per metric, a line per model over epochs, mean and std over the selected runs.
+        """
+        rows = self.query(run, model, metrics)
+        stats = rows.groupby(['metric', 'model', 'epoch'])['value'].agg(['mean', 'std']).reset_index()
+        fig, axes = plt.subplots(1, len(metrics), figsize=(7 * len(metrics), 6), squeeze=False)
+        for ax, metric in zip(axes[0], metrics):
+            for name, curve in stats[stats['metric'] == metric].groupby('model'):
+                ax.plot(curve['epoch'], curve['mean'], marker='.', label=name)
+                ax.fill_between(curve['epoch'], curve['mean'] - curve['std'].fillna(0), curve['mean'] + curve['std'].fillna(0), alpha=0.2)
+            title, ylabel = SCORE_TITLES.get(metric, (metric, metric))
+            ax.set_title(title)
+            ax.set_ylabel(ylabel)
+            ax.set_xlabel('Epochs')
+            ax.legend()
+        fig.tight_layout()
+        if save_path is not None: fig.savefig(save_path, dpi=300)
+        if show: plt.show()
+        return fig
+
+
+class SuccessiveHalving(object):
+    """
+    Asynchronous successive halving (ASHA) early stopping of the models trained against a ResultsStore.
+
+    Rungs are at min_epochs * eta^k epochs (below max_epochs). A model is scored at a rung once each of its weights
+    metrics logged so far was evaluated at or after the rung: the score, the weighted sum of their first values from
+    the rung on (default: shape bias and downstream accuracy, in %), is recorded in the store (metric asha_rung) and
+    compared to the scores of the other models of group (runs starting with group) at that rung: the model goes on
+    only if it is in the top 1/eta, or while fewer than eta models reached the rung.
+    group defaults to the experiment of the run: runs '<sweep>/<trial>' are compared within their sweep, other runs
+    only compare their own models, so at least eta models must be trained in the group (e.g. a sweep.py sweep).
+    Stopped models get an asha_stopped row. Only the store path is kept, so it can be passed to sweep processes.
+    """
+    def __init__(self, path=os.path.join('scores', 'results.sqlite'), group=None, weights=None, min_epochs=5, eta=3, max_epochs=None):
+        assert eta >= 2 and min_epochs >= 1, 'eta must be at least 2 and min_epochs at least 1'
+        self.path = path
+        self.group = group
+        self.weights = weights if weights is not None else {'shape_bias': 1., 'down': 0.01}
+        self.min_epochs = min_epochs
+        self.eta = eta
+        self.max_epochs = max_epochs
+
+    def rungs(self, epoch):
+        rung = self.min_epochs
+        while rung <= epoch and (self.max_epochs is None or rung < self.max_epochs):
+            yield rung
+            rung *= self.eta
+
+    def score(self, rows, rung):
+        # Evaluations at or after the rung only, waiting for the first one of every metric (eval intervals may not hit the rung)
+        values = rows[rows['epoch'] >= rung].sort_values('epoch').groupby('metric')['value'].first()
+        if values.empty or len(values) < rows['metric'].nunique():
+            return None
+        return float(sum(weight * values[metric] for metric, weight in self.weights.items() if metric in values.index))
+
+    def in_group(self, runs, run):
+        if self.group is not None:
+            return runs.str.startswith(self.group)
+        if '/' in run: # sweep trial
+            return runs.str.startswith(run[:run.rindex('/') + 1])
+        return runs == run
+
+    def should_stop(self, run, model, epoch):
+        """
+        Record the rungs reached at epoch (1-based, as in the store) and tell if the model should stop training.
+        """
+        store = ResultsStore(self.path)
+        rows = store.query(run=run, model=model, metric=list(self.weights) + ['asha_rung'])
+        recorded = set(rows.loc[rows['metric'] == 'asha_rung', 'epoch'])
+        for rung in self.rungs(epoch):
+            if rung in recorded:
+                continue
+            score = self.score(rows[rows['metric'] != 'asha_rung'], rung)
+            if score is None: # not evaluated yet
+                continue
+            store.add(run, model, rung, {'asha_rung': score})
+
+            rung_scores = store.query(metric='asha_rung')
+            rung_scores = rung_scores[(rung_scores['epoch'] == rung) & self.in_group(rung_scores['run'], run)]['value']
+            if len(rung_scores) < self.eta:
+                continue
+            cutoff = np.sort(rung_scores.values)[::-1][len(rung_scores) // self.eta - 1]
+            if score < cutoff:
+                store.add(run, model, epoch, {'asha_stopped': rung})
+                return True
+        return False
+
+
+def visualize(table, models, save=False, metrics=None):
+    """
+    Plot the evolution of the scores of each model, table as returned by main() (or ResultsStore.table of a run).
+    metrics default to the ones of SCORE_TITLES in the table.
+    """
+    print('\nFirst 5 logged epochs:\n', table.head())
+    print('\nLast 5 logged epochs:\n', table.tail())
+    if metrics is None: metrics = [metric for metric in SCORE_TITLES if metric in table.columns]
 
     for model in models:
         data = table.loc[model]
-        x = data.index
-
-        if pre_data == 'noise':
-            # Separate bias_%, down_acc, pair_e_dist
-            data_np = np.vstack(data)
-            bias, down, pair_dist = data_np[:, 0], data_np[:, 1], data_np[:, 2]
-
-            # Save each independently
-            pd.DataFrame(bias).to_excel(os.path.join('scores', f'{model}'+'__bias_scores.xlsx'))
-            pd.DataFrame(down).to_excel(os.path.join('scores', f'{model}'+'__down_scores.xlsx'))
-            pd.DataFrame(pair_dist).to_excel(os.path.join('scores', f'{model}'+'__pair_dist_scores.xlsx'))
-
-            # Plot evolutions
-            fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(14,6))
-            fig.suptitle('Evolution of scores for {} throughout training'.format(model), fontsize=18)
-
-            ax1.plot(x, bias)
-            ax1.set_title('Shape bias')
-            ax1.set_ylabel('Bias percentage (%)')
-            ax1.set_xlabel('Epochs')
-
-            ax2.plot(x, down)
-            ax2.set_title('Downstream test accuracy')
-            ax2.set_ylabel('Accuracy (%)')
-            ax2.set_xlabel('Epochs')
-
-            ax3.plot(x, pair_dist)
-            ax3.set_title('Distance between augmented downstream embedding pairs')
-            ax3.set_ylabel('Distance')
-            ax3.set_xlabel('Epochs')
-
-            fig.tight_layout()
-            # subplots_adjust(hspace=1.0, wspace=1.0)
-            if save: plt.savefig(os.path.join('scores', 'Results_{}.png'.format(model)), dpi=300)
-            plt.show()
-
-
-        else:
-            # Separate pre_acc, bias_%, down_acc, pair_e_dist
-            data_np = np.vstack(data)
-            pre, bias, down, pair_dist = data_np[:, 0], data_np[:, 1], data_np[:, 2], data_np[:, 3]
-
-            # Save each independently
-            pd.DataFrame(pre).to_excel(os.path.join('scores', f'{model}'+'__pre_scores.xlsx'))
-            pd.DataFrame(bias).to_excel(os.path.join('scores', f'{model}'+'__bias_scores.xlsx'))
-            pd.DataFrame(down).to_excel(os.path.join('scores', f'{model}'+'__down_scores.xlsx'))
-            pd.DataFrame(pair_dist).to_excel(os.path.join('scores', f'{model}'+'__pair_dist_scores.xlsx'))
-
-            # Plot evolutions
-            fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14,6))
-            fig.suptitle('Evolution of scores for {} throughout training'.format(model), fontsize=18)
-            
-            ax1.plot(x, pre)
-            ax1.set_title('Pretext test accuracy')
-            ax1.set_ylabel('Accuracy (%)')
-            ax1.set_xlabel('Epochs')
-
-            ax2.plot(x, bias)
-            ax2.set_title('Shape bias')
-            ax2.set_ylabel('Percentage (%)')
-            ax2.set_xlabel('Epochs')
-
-
-            fig2, (ax3, ax4) = plt.subplots(1, 2, figsize=(14,6))
-            fig2.suptitle('Evolution of scores for {} throughout training'.format(model), fontsize=18)
-            
-            ax3.plot(x, down)
-            ax3.set_title('Downstream test accuracy')
-            ax3.set_ylabel('Accuracy (%)')
-            ax3.set_xlabel('Epochs')
-
-            ax4.plot(x, pair_dist)
-            ax4.set_title('Distance between augmented downstream embedding pairs')
-            ax4.set_ylabel('Distance')
-            ax4.set_xlabel('Epochs')
-
-            fig.tight_layout()
-            fig2.tight_layout()
-            if save: 
-                fig.savefig(os.path.join('scores', 'Results_1_{}.png'.format(model)), dpi=300)
-                fig2.savefig(os.path.join('scores', 'Results_2_{}.png'.format(model)), dpi=300)
-            plt.show()
+        fig, axes = plt.subplots(1, len(metrics), figsize=(7 * len(metrics), 6), squeeze=False)
+        fig.suptitle('Evolution of scores for {} throughout training'.format(model), fontsize=18)
+        for ax, metric in zip(axes[0], metrics):
+            scores = data[metric].dropna() # metrics not evaluated at every epoch
+            ax.plot(scores.index, scores.values, marker='.')
+            title, ylabel = SCORE_TITLES.get(metric, (metric, metric))
+            ax.set_title(title)
+            ax.set_ylabel(ylabel)
+            ax.set_xlabel('Epochs')
 
+        fig.tight_layout()
+        if save: fig.savefig(os.path.join('scores', 'Results_{}.png'.format(model)), dpi=300)
+        plt.show()